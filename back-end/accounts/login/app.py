@@ -1,34 +1,43 @@
 from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import mysql.connector
 from mysql.connector import Error
-import bcrypt
 import uuid
 from datetime import datetime
 import os
-import time
+import threading
+from shared import metrics, db, hashing
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "account_login")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request gets its own and returns it to the pool when it ends
+database = db.Database("account_login")
+database.init_app(app)
 
 def get_db_connection():
-	attempts = 5
-	for attempt in range(attempts):
-		try:
-			db_connection = mysql.connector.connect(
-				host=os.getenv('DB_HOST'),
-				user=os.getenv('DB_USER'),
-				password=os.getenv('DB_PASSWORD'),
-				database=os.getenv('DB_NAME')
-			)
-			return db_connection
-		except Error as e:
-			print(f"Error connecting to MySQL (attempt {attempt + 1}/{attempts}): {e}")
-			time.sleep(2)  # Wait for 2 seconds before retrying
-	return None
+	return database.connection()
+
+# Concurrent /login requests per client address
+LOGINS_PER_IP = int(os.getenv('LOGINS_PER_IP', 4))
+logins_in_flight = {}
+logins_in_flight_lock = threading.Lock()
+
+def acquire_login_slot(address):
+	with logins_in_flight_lock:
+		count = logins_in_flight.get(address, 0)
+		if count >= LOGINS_PER_IP:
+			return False
+		logins_in_flight[address] = count + 1
+		return True
+
+def release_login_slot(address):
+	with logins_in_flight_lock:
+		count = logins_in_flight.get(address, 1) - 1
+		if count > 0:
+			logins_in_flight[address] = count
+		else:
+			logins_in_flight.pop(address, None)
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -38,47 +47,69 @@ def login():
 	if not email or not password:
 		return jsonify({"error": "Email and password are required"}), 400
 
-	connection = get_db_connection()
-	if connection is None:
+	address = request.remote_addr
+	if not acquire_login_slot(address):
+		response = make_response(jsonify({"error": "Too many concurrent login attempts"}), 429)
+		response.headers['Retry-After'] = '1'
+		return response
+	try:
+		return check_login(email, password)
+	except hashing.HashingBusy:
+		return hashing.busy_response("Login service busy, try again shortly")
+	finally:
+		release_login_slot(address)
+
+def check_login(email, password):
+	try:
+		user = database.query_one("SELECT user_id, pass_hash, pass_cost FROM users WHERE email = %s", (email,), dictionary=True)
+	except Error:
 		return jsonify({"error": "Database connection failed"}), 500
+	# bcrypt may queue behind other logins, so no pooled connection is held while it runs;
+	# /validate_cookie shares the pool
+	database.discard()
 
-	cursor = connection.cursor(dictionary=True)
-	cursor.execute("SELECT user_id, pass_hash FROM users WHERE email = %s", (email,))
-	user = cursor.fetchone()
-
-	if user and bcrypt.checkpw(password.encode('utf-8'), user['pass_hash'].encode('utf-8')):
-		# Generate a new cookie
-		new_cookie = str(uuid.uuid4())
-		# Update last_login and cookie in the database
-		cursor.execute("UPDATE users SET last_login = %s, cookie = %s WHERE user_id = %s", 
-					   (datetime.now(), new_cookie, user['user_id']))
-		connection.commit()
-		cursor.close()
-
-		# Create response with the new cookie
-		response = make_response(jsonify({"message": "Login successful"}), 200)
-		response.set_cookie("session_id", new_cookie, max_age=1*60*60)
-		
-		return response
-	else:
-		cursor.close()
+	if not user or not hashing.run(hashing.bcrypt_check, password, user['pass_hash']):
 		return jsonify({"error": "Invalid email or password"}), 401
 
+	# The plain password is only available here, so older hashes are upgraded on login
+	new_hash = None
+	cost = user['pass_cost'] or hashing.bcrypt_cost(user['pass_hash'])
+	if cost != hashing.BCRYPT_TARGET_COST:
+		try:
+			new_hash = hashing.run(hashing.bcrypt_hash, password, hashing.BCRYPT_TARGET_COST)
+		except hashing.HashingBusy:
+			pass  # Try again on the next login
+
+	# Generate a new cookie and store it, with the upgraded hash if there is one, in one short UPDATE
+	new_cookie = str(uuid.uuid4())
+	try:
+		if new_hash is None:
+			database.execute("UPDATE users SET last_login = %s, cookie = %s WHERE user_id = %s",
+							 (datetime.now(), new_cookie, user['user_id']))
+		else:
+			database.execute("UPDATE users SET last_login = %s, cookie = %s, pass_hash = %s, pass_cost = %s WHERE user_id = %s",
+							 (datetime.now(), new_cookie, new_hash, hashing.BCRYPT_TARGET_COST, user['user_id']))
+	except Error:
+		return jsonify({"error": "Database connection failed"}), 500
+
+	# Create response with the new cookie
+	response = make_response(jsonify({"message": "Login successful"}), 200)
+	response.set_cookie("session_id", new_cookie, max_age=1*60*60)
+	
+	return response
+
 @app.route('/validate_cookie', methods=['GET'])
 def validate_cookie():
 	session_id = request.headers.get('session-id') or request.cookies.get('session_id') 
 	if not session_id:
 		return jsonify({"error": "No session cookie or header provided"}), 400
 
-	connection = get_db_connection()
-	if connection is None:
+	# Every authenticated request in the system comes through here, so it runs as a prepared statement
+	try:
+		user = database.query_one("SELECT user_id, email, authority FROM users WHERE cookie = %s", (session_id,), dictionary=True)
+	except Error:
 		return jsonify({"error": "Database connection failed"}), 500
 
-	cursor = connection.cursor(dictionary=True)
-	cursor.execute("SELECT user_id, email, authority FROM users WHERE cookie = %s", (session_id,))
-	user = cursor.fetchone()
-	cursor.close()
-
 	if user:
 		return jsonify({"message": "Cookie is valid", "valid": True, "email": user['email'], "uid": user['user_id'], "authority": user["authority"]}), 200
 	else:
@@ -129,5 +160,6 @@ def get_users():
 	return jsonify({"users": users}), 200
 
 if __name__ == '__main__':
-	get_db_connection()  # Ensure the connection is established at startup
+	database.pool()  # Ensure the database is reachable at startup
+	hashing.start()  # Start the hashing workers before Flask starts its threads
 	app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
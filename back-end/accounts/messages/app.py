@@ -1,34 +1,22 @@
 from flask import Flask, request, jsonify, make_response
 from flask_cors import CORS
-import mysql.connector
 from mysql.connector import Error
-import bcrypt
 import uuid
 from datetime import datetime
-import os
 import time
+import threading
+from shared import metrics, db, hashing
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "account_messages")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request gets its own and returns it to the pool when it ends
+database = db.Database("account_messages")
+database.init_app(app)
 
 def get_db_connection():
-	attempts = 5
-	for attempt in range(attempts):
-		try:
-			db_connection = mysql.connector.connect(
-				host=os.getenv('DB_HOST'),
-				user=os.getenv('DB_USER'),
-				password=os.getenv('DB_PASSWORD'),
-				database=os.getenv('DB_NAME')
-			)
-			return db_connection
-		except Error as e:
-			print(f"Error connecting to MySQL (attempt {attempt + 1}/{attempts}): {e}")
-			time.sleep(2)  # Wait for 2 seconds before retrying
-	return None
+	return database.connection()
 
 def validate_session_cookie(request):
 	VALIDATION_SITE = "http://account_login:5002/validate_cookie"
@@ -153,6 +141,7 @@ def send_message():
 			VALUES (%s, %s, %s)
 		""", (receiver_id, sender_id, message))
 		connection.commit()
+		unread_counters.changed(receiver_id)
 		cursor.close()
 		connection.close()
 		return jsonify({"message": "Message sent successfully."}), 200
@@ -191,7 +180,6 @@ def delete_user():
 		return jsonify({"error": f"Failed to delete user: {e}"}), 500
 
 
-import bcrypt
 # Reset password functionality
 @app.route('/reset_password', methods=['POST'])
 def reset_password():
@@ -199,20 +187,24 @@ def reset_password():
 	if not session_id:
 		return jsonify({"error": "No session cookie or header provided"}), 400
 
-	connection = get_db_connection()
-	if connection is None:
-		return jsonify({"error": "Database connection failed"}), 500
-
-	cursor = connection.cursor(dictionary=True)
-
 	data = request.get_json()
 	if not data or "email" not in data or "new_password" not in data:
 		return jsonify({"error": "Email and new password are required"}), 400
 
-	hashed_password = bcrypt.hashpw(data["new_password"].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+	try:
+		hashed_password = hashing.run(hashing.bcrypt_hash, data["new_password"], hashing.BCRYPT_TARGET_COST)
+	except hashing.HashingBusy:
+		return hashing.busy_response()
+
+	# Taken after hashing so the request does not hold a pooled connection while it waits
+	connection = get_db_connection()
+	if connection is None:
+		return jsonify({"error": "Database connection failed"}), 500
 
+	cursor = connection.cursor(dictionary=True)
 	try:
-		cursor.execute("UPDATE users SET pass_hash = %s WHERE email = %s", (hashed_password, data["email"]))
+		cursor.execute("UPDATE users SET pass_hash = %s, pass_cost = %s WHERE email = %s",
+					   (hashed_password, hashing.BCRYPT_TARGET_COST, data["email"]))
 		connection.commit()
 		cursor.close()
 		connection.close()
@@ -230,10 +222,6 @@ def add_user():
 	if not session_id:
 		return jsonify({"error": "No session cookie or header provided"}), 400
 
-	connection = get_db_connection()
-	if connection is None:
-		return jsonify({"error": "Database connection failed"}), 500
-
 	data = request.get_json()
 	if not data or 'full_name' not in data or 'email' not in data or 'is_admin' not in data:
 		return jsonify({"error": "Missing required fields"}), 400
@@ -245,14 +233,22 @@ def add_user():
 	
 	# Generate a default password and hash it
 	default_password = "password123"  # Consider sending an email to reset this
-	hashed_password = bcrypt.hashpw(default_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+	try:
+		hashed_password = hashing.run(hashing.bcrypt_hash, default_password, hashing.BCRYPT_TARGET_COST)
+	except hashing.HashingBusy:
+		return hashing.busy_response()
+
+	# Taken after hashing so the request does not hold a pooled connection while it waits
+	connection = get_db_connection()
+	if connection is None:
+		return jsonify({"error": "Database connection failed"}), 500
 
 	cursor = connection.cursor()
 	try:
 		cursor.execute("""
-			INSERT INTO users (full_name, email, authority, pass_hash)
-			VALUES (%s, %s, %s, %s)
-		""", (full_name, email, authority, hashed_password))
+			INSERT INTO users (full_name, email, authority, pass_hash, pass_cost)
+			VALUES (%s, %s, %s, %s, %s)
+		""", (full_name, email, authority, hashed_password, hashing.BCRYPT_TARGET_COST))
 		connection.commit()
 		cursor.close()
 		connection.close()
@@ -289,6 +285,115 @@ def check_admin():
 
 	return jsonify({"message": "Authorized"}), 200
 
+# -------------------------------
+# Keyset pagination
+# -------------------------------
+# Pages are ordered newest first by (time_sent, message_id). The cursor is the last row of the
+# previous page, so each page is an index range scan no matter how deep the history goes.
+MESSAGE_PAGE_MAX = 200
+
+def parse_page_args(args):
+    """(limit, before) from ?limit=&before_time=&before_id=, limit None means everything."""
+    limit = args.get('limit', type=int)
+    if limit is not None and not 0 < limit <= MESSAGE_PAGE_MAX:
+        raise ValueError(f"limit must be between 1 and {MESSAGE_PAGE_MAX}")
+    before_time = args.get('before_time')
+    before_id = args.get('before_id', type=int)
+    if before_time is None and before_id is None:
+        return limit, None
+    if before_time is None or before_id is None:
+        raise ValueError("before_time and before_id must be given together")
+    return limit, (datetime.fromisoformat(before_time.replace("Z", "")), before_id)
+
+def keyset_clause(before, alias="m"):
+    if before is None:
+        return "", []
+    return (f" AND ({alias}.time_sent < %s OR ({alias}.time_sent = %s AND {alias}.message_id < %s))",
+            [before[0], before[0], before[1]])
+
+def page_cursor(row):
+    return {"before_time": row["time_sent"].isoformat(), "before_id": row["message_id"]}
+
+@app.route('/conversations', methods=['GET'])
+def get_conversations():
+    """One row per person the user has messaged with: their last message and unread count."""
+    session_id = request.headers.get('session-id') or request.cookies.get('session_id')
+    if not session_id:
+        return jsonify({"error": "No session cookie or header provided"}), 400
+
+    try:
+        limit, before = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    connection = get_db_connection()
+    if connection is None:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+
+    cursor.execute("SELECT user_id FROM users WHERE cookie = %s", (session_id,))
+    user = cursor.fetchone()
+
+    if user is None:
+        cursor.close()
+        connection.close()
+        return jsonify({"error": "User not found!"}), 404
+
+    user_id = user["user_id"]
+
+    # The latest message_id is the latest message, ids and time_sent both only go up
+    keyset, keyset_params = keyset_clause(before)
+    query = f"""
+        SELECT u.email AS other_user_email,
+               u.full_name AS other_user_name,
+               m.message_id,
+               m.left_message,
+               m.time_sent,
+               m.sender_id = %s AS sent_by_me,
+               COALESCE(unread.unread_count, 0) AS unread_count
+        FROM (
+            SELECT other_id, MAX(message_id) AS last_message_id
+            FROM (
+                SELECT receiver_id AS other_id, message_id FROM messages WHERE sender_id = %s AND receiver_id != %s
+                UNION ALL
+                SELECT sender_id AS other_id, message_id FROM messages WHERE receiver_id = %s AND sender_id != %s
+            ) AS threads
+            GROUP BY other_id
+        ) AS c
+        JOIN messages m ON m.message_id = c.last_message_id
+        JOIN users u ON u.user_id = c.other_id
+        LEFT JOIN (
+            SELECT sender_id, COUNT(*) AS unread_count
+            FROM messages
+            WHERE receiver_id = %s AND is_read = 0
+            GROUP BY sender_id
+        ) AS unread ON unread.sender_id = c.other_id
+        WHERE 1 = 1{keyset}
+        ORDER BY m.time_sent DESC, m.message_id DESC
+    """
+    params = [user_id, user_id, user_id, user_id, user_id, user_id] + keyset_params
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    try:
+        cursor.execute(query, tuple(params))
+        conversations = cursor.fetchall()
+    except Error as e:
+        return jsonify({"error": f"Failed to fetch conversations: {e}"}), 500
+    finally:
+        cursor.close()
+        connection.close()
+
+    for conversation in conversations:
+        conversation["sent_by_me"] = bool(conversation["sent_by_me"])
+
+    response = {"conversations": conversations}
+    if limit and len(conversations) == limit:
+        response["next_cursor"] = page_cursor(conversations[-1])
+    return jsonify(response), 200
+
 @app.route('/get_messages', methods=['GET'])
 def get_messages():
     session_id = request.headers.get('session-id') or request.cookies.get('session_id')
@@ -312,21 +417,35 @@ def get_messages():
 
     user_id = user["user_id"]
 
-    # Retrieve messages and determine who the other participant in the conversation is
-    cursor.execute("""
+    try:
+        limit, before = parse_page_args(request.args)
+    except ValueError as e:
+        cursor.close()
+        connection.close()
+        return jsonify({"error": str(e)}), 400
+
+    # Retrieve messages and determine who the other participant in the conversation is.
+    # Each direction is its own branch so the sender/receiver indexes can be used, rather
+    # than an OR across both columns. Each message comes back once per participant.
+    branch = """
         SELECT m.message_id,
                u.email AS sender_email,
-               CASE 
-                   WHEN m.receiver_id = %s THEN u.email  -- logged-in user is the receiver, show sender_email
-                   WHEN m.sender_id = %s THEN u.email  -- logged-in user is the sender, show receiver_email
-               END AS other_user_email,
+               u.email AS other_user_email,
                m.left_message, m.time_sent
         FROM messages m
-        JOIN users u ON (m.sender_id = u.user_id OR m.receiver_id = u.user_id)
-        WHERE ((m.receiver_id = %s AND m.sender_id != %s)  -- Only get messages where receiver is not the logged-in user
-                OR (m.sender_id = %s AND m.receiver_id != %s))  -- Only get messages where sender is not the logged-in user
-        ORDER BY m.time_sent DESC
-    """, (user_id, user_id, user_id, user_id, user_id, user_id))
+        JOIN users u ON u.user_id IN (m.sender_id, m.receiver_id)
+        WHERE m.{own} = %s AND m.{other} != %s{keyset}
+    """
+    keyset, keyset_params = keyset_clause(before)
+    query = " UNION ALL ".join([
+        "(" + branch.format(own="receiver_id", other="sender_id", keyset=keyset) + ")",
+        "(" + branch.format(own="sender_id", other="receiver_id", keyset=keyset) + ")",
+    ]) + " ORDER BY time_sent DESC, message_id DESC"
+    params = [user_id, user_id] + keyset_params + [user_id, user_id] + keyset_params
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit * 2)  # two rows per message
+    cursor.execute(query, tuple(params))
 
     messages = cursor.fetchall()
 
@@ -356,43 +475,154 @@ def get_messages():
     cursor.close()
     connection.close()
 
-    return jsonify({"messages": messages, "unreadCounts": unread_counts_dict}), 200
-
-@app.route('/unread_messages_count', methods=['GET'])
-def unread_messages_count():
-    session_id = request.headers.get('session-id') or request.cookies.get('session_id')
-    if not session_id:
-        return jsonify({"error": "No session cookie or header provided"}), 400
+    response = {"messages": messages, "unreadCounts": unread_counts_dict}
+    if limit and len(messages) == limit * 2:
+        response["next_cursor"] = page_cursor(messages[-1])
+    return jsonify(response), 200
+
+# -------------------------------
+# Unread counters
+# -------------------------------
+# Unread counts are kept in memory per user and only recounted after send_message or
+# get_chat_messages changes them. Clients long-poll /unread_messages_count/wait with the last
+# version they saw and are woken as soon as their count changes, so idle clients hold an HTTP
+# connection open but cost no queries. A waiting request holds no database connection: each
+# lookup returns its pooled connection straight away, otherwise a handful of waiters would
+# starve every other endpoint of the pool for the whole wait.
+UNREAD_RESYNC_SECONDS = 300   # recount anyway in case messages changed outside this service
+UNREAD_WAIT_MAX_SECONDS = 30
+SESSION_CACHE_SECONDS = 120   # outlives a wait, so consecutive polls skip the lookup
+
+class UnreadCounters:
+    def __init__(self):
+        self.entries = {}  # user_id -> {"count": int or None, "version": int, "synced_at": float}
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def _entry(self, user_id):
+        if user_id not in self.entries:
+            self.entries[user_id] = {"count": None, "version": self.version, "synced_at": 0}
+        return self.entries[user_id]
+
+    def get(self, cursor, user_id):
+        """(count, version) for the user, counting from the database only when stale."""
+        with self.condition:
+            entry = self._entry(user_id)
+            if entry["count"] is not None and time.monotonic() - entry["synced_at"] < UNREAD_RESYNC_SECONDS:
+                return entry["count"], entry["version"]
+            seen_version = entry["version"]
+
+        cursor.execute("""
+            SELECT COUNT(*) AS unread_count
+            FROM messages
+            WHERE receiver_id = %s AND is_read = 0
+        """, (user_id,))
+        count = cursor.fetchone()["unread_count"]
+
+        with self.condition:
+            entry = self._entry(user_id)
+            if entry["version"] == seen_version:  # nothing changed while we were counting
+                if entry["count"] is not None and entry["count"] != count:
+                    self.version += 1
+                    entry["version"] = self.version
+                    self.condition.notify_all()
+                entry["count"] = count
+                entry["synced_at"] = time.monotonic()
+            return count, entry["version"]
+
+    def changed(self, user_id):
+        """Marks the user's count stale and wakes anyone waiting on it."""
+        with self.condition:
+            entry = self._entry(user_id)
+            self.version += 1
+            entry["version"] = self.version
+            entry["count"] = None
+            self.condition.notify_all()
+
+    def wait(self, user_id, since, timeout):
+        """Blocks until the user's version is newer than `since`, returns whether it changed."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self._entry(user_id)["version"] > since, timeout)
+
+unread_counters = UnreadCounters()
+session_users = {}  # session id -> (user_id, expires at)
+session_users_lock = threading.Lock()
+
+def lookup_user_id(session_id):
+    """user_id for the session, cached briefly so long-polling clients don't hit the database."""
+    now = time.monotonic()
+    with session_users_lock:
+        cached = session_users.get(session_id)
+    if cached and cached[1] > now:
+        return cached[0]
 
     connection = get_db_connection()
     if connection is None:
-        return jsonify({"error": "Database connection failed"}), 500
-
+        raise Error("Database connection failed")
     cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT user_id FROM users WHERE cookie = %s", (session_id,))
+        user = cursor.fetchone()
+    finally:
+        cursor.close()
+        database.discard()  # back to the pool now, not when the request ends
+    if user is None:
+        return None
 
-    cursor.execute("SELECT user_id FROM users WHERE cookie = %s", (session_id,))
-    user = cursor.fetchone()
+    with session_users_lock:
+        for key in [key for key, (_, expires) in session_users.items() if expires <= now]:
+            del session_users[key]
+        session_users[session_id] = (user["user_id"], now + SESSION_CACHE_SECONDS)
+    return user["user_id"]
 
-    if user is None:
+def current_unread(user_id):
+    connection = get_db_connection()
+    if connection is None:
+        raise Error("Database connection failed")
+    cursor = connection.cursor(dictionary=True)
+    try:
+        return unread_counters.get(cursor, user_id)
+    finally:
         cursor.close()
-        connection.close()
-        return jsonify({"error": "User not found!"}), 404
+        database.discard()
 
-    user_id = user["user_id"]
+@app.route('/unread_messages_count', methods=['GET'])
+def unread_messages_count():
+    session_id = request.headers.get('session-id') or request.cookies.get('session_id')
+    if not session_id:
+        return jsonify({"error": "No session cookie or header provided"}), 400
 
-    # Get the count of unread messages for the logged-in user
-    cursor.execute("""
-        SELECT COUNT(*) AS unread_count
-        FROM messages
-        WHERE receiver_id = %s AND is_read = 0
-    """, (user_id,))
+    try:
+        user_id = lookup_user_id(session_id)
+        if user_id is None:
+            return jsonify({"error": "User not found!"}), 404
+        unread_count, version = current_unread(user_id)
+    except Error as e:
+        return jsonify({"error": f"Database connection failed: {e}"}), 500
 
-    unread_count = cursor.fetchone()["unread_count"]
+    return jsonify({"unread_messages_count": unread_count, "version": version}), 200
 
-    cursor.close()
-    connection.close()
+@app.route('/unread_messages_count/wait', methods=['GET'])
+def wait_unread_messages_count():
+    """Long-poll: answers as soon as the count changes from `since`, or after `timeout` seconds."""
+    session_id = request.headers.get('session-id') or request.cookies.get('session_id')
+    if not session_id:
+        return jsonify({"error": "No session cookie or header provided"}), 400
+
+    since = request.args.get('since', type=int)
+    timeout = min(request.args.get('timeout', UNREAD_WAIT_MAX_SECONDS, type=float), UNREAD_WAIT_MAX_SECONDS)
+
+    try:
+        user_id = lookup_user_id(session_id)
+        if user_id is None:
+            return jsonify({"error": "User not found!"}), 404
+        if since is not None:
+            unread_counters.wait(user_id, since, timeout)
+        unread_count, version = current_unread(user_id)
+    except Error as e:
+        return jsonify({"error": f"Database connection failed: {e}"}), 500
 
-    return jsonify({"unread_messages_count": unread_count}), 200
+    return jsonify({"unread_messages_count": unread_count, "version": version}), 200
 
 @app.route('/get_chat_messages', methods=['GET'])
 def get_chat_messages():
@@ -431,9 +661,17 @@ def get_chat_messages():
         SET is_read = 1
         WHERE receiver_id = %s AND sender_id = %s AND is_read = 0
     """, (logged_in_id, recipient_id))
+    marked_read = cursor.rowcount
 
-    # Fetch both sent & received messages between the two users
-    cursor.execute("""
+    try:
+        limit, before = parse_page_args(request.args)
+    except ValueError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+
+    # Fetch both sent & received messages between the two users, one branch per direction
+    # so each is a range scan on (sender_id, receiver_id, time_sent)
+    branch = """
         SELECT 
             m.message_id, 
             m.sender_id, 
@@ -445,19 +683,32 @@ def get_chat_messages():
         FROM messages m
         JOIN users u1 ON m.sender_id = u1.user_id
         JOIN users u2 ON m.receiver_id = u2.user_id
-        WHERE 
-            (m.sender_id = %s AND m.receiver_id = %s) 
-            OR 
-            (m.sender_id = %s AND m.receiver_id = %s)
-        ORDER BY m.time_sent ASC
-    """, (logged_in_id, recipient_id, recipient_id, logged_in_id))
+        WHERE m.sender_id = %s AND m.receiver_id = %s{keyset}
+    """
+    keyset, keyset_params = keyset_clause(before)
+    query = f"({branch.format(keyset=keyset)}) UNION ALL ({branch.format(keyset=keyset)})"
+    params = [logged_in_id, recipient_id] + keyset_params + [recipient_id, logged_in_id] + keyset_params
+    if limit:
+        # Newest page first, then flipped back to oldest first like the full history
+        query += " ORDER BY time_sent DESC, message_id DESC LIMIT %s"
+        params.append(limit)
+    else:
+        query += " ORDER BY time_sent ASC, message_id ASC"
+    cursor.execute(query, tuple(params))
 
     messages = cursor.fetchall()
+    next_cursor = page_cursor(messages[-1]) if limit and len(messages) == limit else None
+    if limit:
+        messages.reverse()
 
     conn.commit()  # Commit the update to the messages
+    if marked_read:
+        unread_counters.changed(logged_in_id)
 
     conn.close()
 
+    if next_cursor:
+        return jsonify({'messages': messages, 'next_cursor': next_cursor})
     return jsonify({'messages': messages})
 
 
@@ -513,12 +764,18 @@ def check_password():
     cursor.close()
     connection.close()
 
-    if user and bcrypt.checkpw(data["password"].encode('utf-8'), user['pass_hash'].encode('utf-8')):
+    try:
+        correct = user is not None and hashing.run(hashing.bcrypt_check, data["password"], user['pass_hash'])
+    except hashing.HashingBusy:
+        return hashing.busy_response()
+
+    if correct:
         return jsonify({"message": "Password is correct"}), 200
     else:
         return jsonify({"error": "Incorrect password"}), 401
 
 
 if __name__ == '__main__':
-	get_db_connection()  # Ensure the connection is established at startup
+	database.pool()  # Ensure the database is reachable at startup
+	hashing.start()  # Start the hashing workers before Flask starts its threads
 	app.run(host='0.0.0.0', port=5007)
\ No newline at end of file
@@ -1,35 +1,19 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import mysql.connector
 from mysql.connector import Error
-import bcrypt
-import os
-import time
+from shared import metrics, db, hashing
 
 app = Flask(__name__)
 
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "account_registration")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request gets its own and returns it to the pool when it ends
+database = db.Database("account_registration")
+database.init_app(app)
 
 def get_db_connection():
-    global db_connection
-    if db_connection is None or not db_connection.is_connected():
-        while True:
-            try:
-                db_connection = mysql.connector.connect(
-                    host=os.getenv('DB_HOST'),
-                    user=os.getenv('DB_USER'),
-                    password=os.getenv('DB_PASSWORD'),
-                    database=os.getenv('DB_NAME')
-                )
-                if db_connection.is_connected():
-                    break
-            except Error as e:
-                print(f"Error connecting to MySQL: {e}")
-                time.sleep(5)  # Wait for 5 seconds before retrying
-    return db_connection
+    return database.connection()
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -51,12 +35,17 @@ def register():
     if not email.endswith('@fakecompany.co.uk'):
         return jsonify({"error": "Email must end with '@fakecompany.co.uk'"}), 400
 
+    try:
+        hashed_password = hashing.run(hashing.bcrypt_hash, password, hashing.BCRYPT_TARGET_COST)
+    except hashing.HashingBusy:
+        return hashing.busy_response()
+
+    # Taken after hashing so the request does not hold a pooled connection while it waits
     connection = get_db_connection()
     if connection is None:
         return jsonify({"error": "Database connection failed"}), 500
 
     cursor = connection.cursor(dictionary=True)
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
     
     # Updated authority assignment
     if super == "yes":
@@ -67,8 +56,8 @@ def register():
         authority = "Reception"
         
     try:
-        cursor.execute("INSERT INTO users (full_name, email, pass_hash, authority) VALUES (%s, %s, %s, %s)", 
-                       (full_name, email, hashed_password, authority))
+        cursor.execute("INSERT INTO users (full_name, email, pass_hash, pass_cost, authority) VALUES (%s, %s, %s, %s, %s)", 
+                       (full_name, email, hashed_password, hashing.BCRYPT_TARGET_COST, authority))
         connection.commit()
         cursor.close()
         return jsonify({"message": "User registered successfully"}), 201
@@ -79,5 +68,6 @@ def register():
 # Should add a queue that needs admin approval to this
 
 if __name__ == '__main__':
-    get_db_connection()  # Ensure the connection is established at startup
+    database.pool()  # Ensure the database is reachable at startup
+    hashing.start()  # Start the hashing workers before Flask starts its threads
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
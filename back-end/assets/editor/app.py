@@ -1,74 +1,199 @@
 from flask import Flask, request, jsonify, make_response
-import mysql.connector
 from flask_cors import CORS
 from mysql.connector import Error
-import os
 import requests
 import time
 import base64
 import binascii
+import hashlib
+import mimetypes
+import queue
+import threading
+from derivatives import build_derivatives, DERIVATIVE_TYPE
+from shared import metrics, log, db
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "assets_editor")
+logger = log.setup("assets_editor")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request (or worker thread) gets its own
+database = db.Database("assets_editor")
+database.init_app(app)
 
-def get_db_connection(retries=5, delay=1):
-    global db_connection
-    for _ in range(retries):
+def get_db_connection():
+    return database.connection()
+
+# -------------------------------
+# Derivative image worker
+# -------------------------------
+# Thumbnails and tiles are slow to build for large floor plans, so uploads only queue the
+# work and a single background thread writes the derivatives for the current image hash.
+derivative_jobs = metrics.track_queue("derivative_jobs", queue.Queue())
+
+def queue_derivatives(preset_id, image_hash):
+    derivative_jobs.put((preset_id, image_hash))
+
+def build_preset_derivatives(conn, preset_id, image_hash):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT image_data FROM presets WHERE preset_id = %s AND image_hash = %s",
+            (preset_id, image_hash)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return  # replaced or deleted since it was queued
+        width, height, rows = build_derivatives(bytes(row[0]))
+
+        cursor.execute("DELETE FROM preset_image_derivatives WHERE preset_id = %s", (preset_id,))
+        cursor.executemany("""
+            INSERT INTO preset_image_derivatives
+            (preset_id, image_hash, kind, level, x, y, width, height, content_type, data)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, [(preset_id, image_hash) + r[:6] + (DERIVATIVE_TYPE, r[6]) for r in rows])
+        cursor.execute(
+            "UPDATE presets SET image_width = %s, image_height = %s WHERE preset_id = %s AND image_hash = %s",
+            (width, height, preset_id, image_hash)
+        )
+        conn.commit()
+        logger.info("Built %s derivatives", len(rows), extra={"preset": preset_id})
+    except Exception as e:
+        conn.rollback()
+        logger.exception("Error building derivatives: %s", e, extra={"preset": preset_id})
+    finally:
+        cursor.close()
+
+def derivative_worker():
+    while True:
+        preset_id, image_hash = derivative_jobs.get()
         try:
-            if db_connection != None and db_connection.is_connected():
-                return db_connection
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-            time.sleep(delay)
-    
-    print("Failed to establish database connection after retries")
-    return None
+            conn = get_db_connection()
+            if conn is None:
+                logger.error("No database connection for derivatives", extra={"preset": preset_id})
+                continue
+            build_preset_derivatives(conn, preset_id, image_hash)
+        finally:
+            derivative_jobs.task_done()
+
+def queue_missing_derivatives():
+    """Picks up images uploaded while the worker was down, or before derivatives existed."""
+    connection = get_db_connection()
+    if connection is None:
+        return
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            SELECT p.preset_id, p.image_hash
+            FROM presets p
+            WHERE p.image_hash IS NOT NULL
+              AND NOT EXISTS (
+                SELECT 1 FROM preset_image_derivatives d
+                WHERE d.preset_id = p.preset_id AND d.image_hash = p.image_hash
+              )
+        """)
+        for preset_id, image_hash in cursor.fetchall():
+            queue_derivatives(preset_id, image_hash)
+    except Error as e:
+        logger.error("Error finding presets missing derivatives: %s", e)
+    finally:
+        cursor.close()
 
-def validate_session_cookie(request):
+# -------------------------------
+# Session and preset ACL caches
+# -------------------------------
+# Authorising a write used to cost an HTTP call to account_login (plus its DB lookup) and two
+# queries for the preset's owner and trustees. Both are cached here: sessions for a short TTL so
+# logouts still take effect quickly, ACLs until this service changes them. The ACL TTL only
+# covers changes made outside the editor (e.g. a deleted user cascading out of preset_trusted).
+SESSION_CACHE_SECONDS = 30
+SESSION_CACHE_MAX_ENTRIES = 10000
+PRESET_ACL_CACHE_SECONDS = 300
+
+session_cache = {}  # cookie -> (user data, expires at)
+preset_acl_cache = {}  # preset_id -> (owner_id, frozenset of trusted user ids, expires at)
+auth_cache_lock = threading.Lock()
+
+def get_cookie_user(request):
+    """The validated user data for the session cookie, or an (error, status) tuple."""
     VALIDATION_SITE = "http://account_login:5002/validate_cookie"
     cookie = request.cookies.get("session_id")
-
     if not cookie:
-        print("No session_id cookie found.")
+        logger.debug("No session_id cookie found")
         return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
 
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
+    now = time.monotonic()
+    with auth_cache_lock:
+        cached = session_cache.get(cookie)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    with metrics.span("validate_cookie"):
+        r = requests.get(VALIDATION_SITE, headers={"session-id": cookie, **metrics.trace_headers()})
     if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
+        logger.info("Invalid cookie detected")
         return {"error": "Invalid cookie"}, 401 #, "message": r.text
-    
-    data = r.json()
-    if data.get("authority") != "Admin" and data.get("authority") != "Super Admin" :
-        print("ERR: Non-admin cookie")
+
+    user_data = r.json()
+    with auth_cache_lock:
+        if len(session_cache) >= SESSION_CACHE_MAX_ENTRIES:
+            for key in [key for key, (_, expires) in session_cache.items() if expires <= now]:
+                del session_cache[key]
+            if len(session_cache) >= SESSION_CACHE_MAX_ENTRIES:
+                session_cache.clear()
+        session_cache[cookie] = (user_data, now + SESSION_CACHE_SECONDS)
+    return user_data
+
+def get_preset_acl(cursor, preset_ids):
+    """{preset_id: (owner_id, trusted user ids)}, only querying presets that aren't cached."""
+    now = time.monotonic()
+    acl = {}
+    with auth_cache_lock:
+        for preset_id in preset_ids:
+            cached = preset_acl_cache.get(preset_id)
+            if cached and cached[2] > now:
+                acl[preset_id] = cached[:2]
+    missing = [preset_id for preset_id in preset_ids if preset_id not in acl]
+    if not missing:
+        return acl
+
+    cursor.execute(f"""
+        SELECT p.preset_id, p.owner_id, t.user_id
+        FROM presets p
+        LEFT JOIN preset_trusted t ON t.preset_id = p.preset_id
+        WHERE p.preset_id IN ({",".join(["%s"] * len(missing))})
+    """, tuple(missing))
+    loaded = {}
+    for row in cursor.fetchall():
+        owner_id, trustees = loaded.setdefault(row["preset_id"], (row["owner_id"], set()))
+        if row["user_id"] is not None:
+            trustees.add(row["user_id"])
+    with auth_cache_lock:
+        for preset_id, (owner_id, trustees) in loaded.items():
+            acl[preset_id] = (owner_id, frozenset(trustees))
+            preset_acl_cache[preset_id] = acl[preset_id] + (now + PRESET_ACL_CACHE_SECONDS,)
+    return acl
+
+def invalidate_preset_acl(preset_id):
+    with auth_cache_lock:
+        preset_acl_cache.pop(preset_id, None)
+
+def validate_session_cookie(request):
+    user_data = get_cookie_user(request)
+    if isinstance(user_data, tuple):
+        return user_data
+
+    if user_data.get("authority") != "Admin" and user_data.get("authority") != "Super Admin" :
+        logger.info("Non-admin cookie")
         return {"error": "Forbidden", "message": "User isn't a valid admin"}, 403
     
-    return [data.get("uid")]
+    return [user_data.get("uid")]
 
 def validate_owner_cookie(request, owner):
-    VALIDATION_SITE = "http://account_login:5002/validate_cookie"
-    cookie = request.cookies.get("session_id")
+    user_data = get_cookie_user(request)
+    if isinstance(user_data, tuple):
+        return user_data
 
-    if not cookie:
-        print("No session_id cookie found.")
-        return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
-
-    print(f"Cookie found: {cookie}")
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
-    if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
-        return {"error": "Invalid cookie"}, 401 #, "message": r.text
-
-    user_data = r.json()
     if user_data.get("uid") != owner:
         print("ERR: User isn't owner")
         return {"error":"Forbidden", "message":"Not the owner of this preset"}, 403
@@ -77,46 +202,29 @@ def validate_owner_cookie(request, owner):
     return None
 
 def validate_trusted_cookie(request, trustees):
-    VALIDATION_SITE = "http://account_login:5002/validate_cookie"
-    cookie = request.cookies.get("session_id")
-    if not cookie:
-        return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
+    user_data = get_cookie_user(request)
+    if isinstance(user_data, tuple):
+        return user_data
 
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
-    if r.status_code != 200:
-        return {"error": "Invalid cookie"}, 401
-
-    user_data = r.json()
     if user_data.get("uid") not in trustees:
         return {"error": "Forbidden", "message": "You are not a trusted user"}, 403
 
     return None
 
 def validate_owner_or_trusted_cookie(request, owner, trustees):
-    VALIDATION_SITE = "http://account_login:5002/validate_cookie"
-    cookie = request.cookies.get("session_id")
-    if not cookie:
-        return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
-
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
-    if r.status_code != 200:
-        return {"error": "Invalid cookie"}, 401
+    user_data = get_cookie_user(request)
+    if isinstance(user_data, tuple):
+        return user_data
 
-    user_data = r.json()
     if user_data.get("uid") != owner and user_data.get("uid") not in trustees:
         return {"error": "Forbidden", "message": "You are not authorized"}, 403
 
     return None
 
 def validate_super_admin(request):
-    VALIDATION_SITE = "http://account_login:5002/validate_cookie"
-    cookie = request.cookies.get("session_id")
-    if not cookie:
-        return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
-    if r.status_code != 200:
-        return {"error": "Invalid cookie"}, 401
-    data = r.json()
+    data = get_cookie_user(request)
+    if isinstance(data, tuple):
+        return data
     if data.get("authority") != "Super Admin":
         return {"error": "Forbidden", "message": "User isn't a super admin"}, 403
     return data
@@ -160,6 +268,7 @@ def presets():
                 return jsonify({"error": "Failed to add trusted user"}), 400
 
         connection.commit()
+        invalidate_preset_acl(preset_id)
         return jsonify({"message": "Preset created", "preset_id": preset_id}), 201
     except Error as e:
         connection.rollback()
@@ -207,11 +316,10 @@ def upload_preset_image(preset_id):
     
     cursor = connection.cursor(dictionary=True)
     
-    cursor.execute("SELECT owner_id FROM presets WHERE preset_id = %s", (preset_id,))
-    owner_id = cursor.fetchone()["owner_id"]
-    
-    cursor.execute("SELECT user_id FROM preset_trusted WHERE preset_id = %s", (preset_id,))
-    trustees = [row["user_id"] for row in cursor.fetchall()]
+    acl = get_preset_acl(cursor, [preset_id])
+    if preset_id not in acl:
+        return jsonify({"error": "Preset not found"}), 404
+    owner_id, trustees = acl[preset_id]
     
     cookie_validation = validate_owner_or_trusted_cookie(request, owner_id, trustees)
     if cookie_validation:
@@ -219,19 +327,22 @@ def upload_preset_image(preset_id):
     
     data = request.get_json()
 
-    # Validate base64 encoding
+    # Validate base64 encoding, the image is stored as raw bytes
     try:
-        base64.b64decode(data["data"], validate=True)
-        print(data["data"])
+        image_bytes = base64.b64decode(data["data"], validate=True)
     except (binascii.Error, KeyError):
         return jsonify({"error": "Image data is not valid base64"}), 400
 
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    image_type = mimetypes.guess_type(data["name"])[0] or "application/octet-stream"
+
     try:
         cursor.execute(
-            "UPDATE presets SET image_name = %s, image_data = %s WHERE preset_id = %s",
-            (data["name"], data["data"], preset_id)
+            "UPDATE presets SET image_name = %s, image_type = %s, image_hash = %s, image_data = %s WHERE preset_id = %s",
+            (data["name"], image_type, image_hash, image_bytes, preset_id)
         )
         connection.commit()
+        queue_derivatives(preset_id, image_hash)
         return jsonify({"message": "Preset image updated"}), 200
     except Error as e:
         connection.rollback()
@@ -241,6 +352,89 @@ def upload_preset_image(preset_id):
         cursor.close()
         connection.close()
 
+BOX_FIELDS = ["roomID", "label", "top", "left", "width", "height", "colour"]
+
+def box_values(box):
+    return (str(box["roomID"]), box["label"], int(box["top"]), int(box["left"]),
+            int(box["width"]), int(box["height"]), box["colour"])
+
+def diff_boxes(existing, boxes):
+    """
+    Works out the statements needed to turn the preset's current map_blocks rows into `boxes`.
+    Boxes are matched on their `id`, boxes without one (older clients) are matched on roomID.
+    Returns (inserts, updates, deletes, matched ids in the order of `boxes`, None for new boxes).
+    """
+    by_id = {row["id"]: row for row in existing}
+    by_room = {}
+    for row in existing:
+        by_room.setdefault(str(row["roomID"]), []).append(row)
+
+    requested_ids = {box.get("id") for box in boxes}
+    matched = []
+    claimed = set()
+    for box in boxes:
+        row = by_id.get(box.get("id"))
+        if row is None or row["id"] in claimed:
+            row = next((r for r in by_room.get(str(box["roomID"]), [])
+                        if r["id"] not in claimed and r["id"] not in requested_ids), None)
+        if row is not None:
+            claimed.add(row["id"])
+        matched.append(row)
+
+    inserts, updates, ids = [], [], []
+    for box, row in zip(boxes, matched):
+        values = box_values(box)
+        if row is None:
+            inserts.append(values)
+            ids.append(None)
+            continue
+        if values != box_values(row):
+            updates.append(values + (row["id"],))
+        ids.append(row["id"])
+    deletes = [(row["id"],) for row in existing if row["id"] not in claimed]
+    return inserts, updates, deletes, ids
+
+def validate_boxes(boxes):
+    for box in boxes:
+        if any(field not in box for field in BOX_FIELDS):
+            return "Box is missing a field"
+        try:
+            box_values(box)
+        except (TypeError, ValueError):
+            return "Box position and size must be numbers"
+        if box["label"] == "":
+            return "Box label cannot be empty"
+    return None
+
+def apply_box_diff(cursor, preset_id, boxes):
+    """Applies the diff for one preset, returns the counts and the stable ids of `boxes`."""
+    cursor.execute("""
+        SELECT id, roomID, label, `top`, `left`, `width`, `height`, colour
+        FROM map_blocks WHERE preset_id = %s
+    """, (preset_id,))
+    inserts, updates, deletes, ids = diff_boxes(cursor.fetchall(), boxes)
+
+    if deletes:
+        cursor.executemany("DELETE FROM map_blocks WHERE id = %s", deletes)
+    if updates:
+        cursor.executemany("""
+            UPDATE map_blocks
+            SET roomID = %s, label = %s, `top` = %s, `left` = %s, `width` = %s, `height` = %s, colour = %s
+            WHERE id = %s
+        """, updates)
+    if inserts:
+        cursor.executemany("""
+            INSERT INTO map_blocks
+            (preset_id, roomID, label, `top`, `left`, `width`, `height`, colour)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, [(preset_id,) + values for values in inserts])
+        # New rows are the ones we didn't match, in insertion (id) order
+        known = set(ids)
+        cursor.execute("SELECT id FROM map_blocks WHERE preset_id = %s ORDER BY id", (preset_id,))
+        new_ids = iter([row["id"] for row in cursor.fetchall() if row["id"] not in known])
+        ids = [box_id if box_id is not None else next(new_ids) for box_id in ids]
+    return {"inserted": len(inserts), "updated": len(updates), "deleted": len(deletes), "ids": ids}
+
 @app.route('/presets/<int:preset_id>/boxes', methods=['PATCH'])
 def update_preset_boxes(preset_id):   
     connection = get_db_connection()
@@ -249,33 +443,74 @@ def update_preset_boxes(preset_id):
         return jsonify({"error": "Database connection failed"}), 500
     
     cursor = connection.cursor(dictionary=True)
-    
-    cursor.execute("SELECT owner_id FROM presets WHERE preset_id = %s", (preset_id,))
-    owner_id = cursor.fetchone()["owner_id"]
-    
-    cursor.execute("SELECT user_id FROM preset_trusted WHERE preset_id = %s", (preset_id,))
-    trustees = [row["user_id"] for row in cursor.fetchall()]
+
+    acl = get_preset_acl(cursor, [preset_id])
+    if preset_id not in acl:
+        return jsonify({"error": "Preset not found"}), 404
+    owner_id, trustees = acl[preset_id]
     
     cookie_validation = validate_owner_or_trusted_cookie(request, owner_id, trustees)
     if cookie_validation:
         return cookie_validation
     
     data = request.get_json()
+    box_error = validate_boxes(data["boxes"])
+    if box_error:
+        return jsonify({"error": box_error}), 400
 
     try:
-        # Delete existing boxes (map_blocks) for this preset
-        cursor.execute("DELETE FROM map_blocks WHERE preset_id = %s", (preset_id,))
-        # Insert new boxes into map_blocks
-        for box in data["boxes"]:
-            if box["label"] == "":
-                return jsonify({"error": "Box label cannot be empty"}), 400
-            cursor.execute("""
-                INSERT INTO map_blocks 
-                (preset_id, roomID, label, `top`, `left`, `width`, `height`, colour)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (preset_id, box["roomID"], box["label"], box["top"], box["left"], box["width"], box["height"], box["colour"]))
+        result = apply_box_diff(cursor, preset_id, data["boxes"])
+        connection.commit()
+        return jsonify({"message": "Preset boxes updated", **result}), 200
+    except Error as e:
+        connection.rollback()
+        print(f"Error updating preset boxes: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cursor.close()
+        connection.close()
+
+@app.route('/presets/boxes', methods=['PATCH'])
+def update_many_preset_boxes():
+    """Applies box updates for several presets in one transaction, all or nothing."""
+    data = request.get_json()
+    updates = data.get("presets") if data else None
+    if not updates:
+        return jsonify({"error": "No presets given"}), 400
+    for update in updates:
+        if "preset_id" not in update or "boxes" not in update:
+            return jsonify({"error": "Each entry needs a preset_id and boxes"}), 400
+        box_error = validate_boxes(update["boxes"])
+        if box_error:
+            return jsonify({"error": box_error, "preset_id": update["preset_id"]}), 400
+
+    connection = get_db_connection()
+    if connection is None:
+        print("Database connection failed")
+        return jsonify({"error": "Database connection failed"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+
+    preset_ids = [update["preset_id"] for update in updates]
+    acl = get_preset_acl(cursor, preset_ids)
+    missing = [preset_id for preset_id in preset_ids if preset_id not in acl]
+    if missing:
+        return jsonify({"error": "Preset not found", "preset_ids": missing}), 404
+
+    user = get_cookie_user(request)
+    if isinstance(user, tuple):
+        return user
+    for preset_id in preset_ids:
+        owner_id, trustees = acl[preset_id]
+        if user.get("uid") != owner_id and user.get("uid") not in trustees:
+            return jsonify({"error": "Forbidden", "message": "You are not authorized", "preset_id": preset_id}), 403
+
+    try:
+        results = {}
+        for update in updates:
+            results[update["preset_id"]] = apply_box_diff(cursor, update["preset_id"], update["boxes"])
         connection.commit()
-        return jsonify({"message": "Preset boxes updated"}), 200
+        return jsonify({"message": "Preset boxes updated", "presets": results}), 200
     except Error as e:
         connection.rollback()
         print(f"Error updating preset boxes: {e}")
@@ -297,8 +532,10 @@ def update_preset(preset_id):
     
     cursor = connection.cursor(dictionary=True)
 
-    cursor.execute("SELECT owner_id FROM presets WHERE preset_id = %s", (preset_id,))
-    owner_id = cursor.fetchone()["owner_id"]
+    acl = get_preset_acl(cursor, [preset_id])
+    if preset_id not in acl:
+        return jsonify({"error": "Preset not found"}), 404
+    owner_id = acl[preset_id][0]
     if owner_id != cookie_res[0]:
         return jsonify({"error": "Forbidden", "message": "Not the owner of this preset"}), 403
     data = request.get_json()
@@ -318,6 +555,7 @@ def update_preset(preset_id):
                 """, (preset_id, user_id))
 
         connection.commit()
+        invalidate_preset_acl(preset_id)
         return jsonify({"message": "Preset updated"}), 200
     except Error as e:
         connection.rollback()
@@ -340,8 +578,10 @@ def delete_preset(preset_id):
     
     cursor = connection.cursor(dictionary=True)
 
-    cursor.execute("SELECT owner_id FROM presets WHERE preset_id = %s", (preset_id,))
-    owner_id = cursor.fetchone()["owner_id"]
+    acl = get_preset_acl(cursor, [preset_id])
+    if preset_id not in acl:
+        return jsonify({"error": "Preset not found"}), 404
+    owner_id = acl[preset_id][0]
     if owner_id != cookie_res[0]:
         return jsonify({"error": "Forbidden", "message": "Not the owner of this preset"}), 403
     
@@ -354,6 +594,7 @@ def delete_preset(preset_id):
         cursor.execute("DELETE FROM presets WHERE preset_id = %s", (preset_id,))
         cursor.execute("DELETE FROM preset_trusted WHERE preset_id = %s", (preset_id,))
         connection.commit()
+        invalidate_preset_acl(preset_id)
         return jsonify({"message": "Preset deleted"}), 200
     except Error as e:
         connection.rollback()
@@ -382,7 +623,8 @@ def update_front_page():
         image_data = hero.get("image", {}).get("data")
         cursor.execute("""
             UPDATE config 
-            SET domain = %s, loginText = %s, hero_title = %s, hero_subtitle = %s, image_name = %s, image_data = %s 
+            SET domain = %s, loginText = %s, hero_title = %s, hero_subtitle = %s, image_name = %s, image_data = %s,
+                version = version + 1
             WHERE id = 1
         """, (
             data["config"]["domain"],
@@ -445,5 +687,8 @@ def update_front_page():
         conn.close()
 
 if __name__ == '__main__':
-    get_db_connection()  # Ensure the connection is established at startup
+    database.pool()  # Ensure the database is reachable at startup
+    threading.Thread(target=derivative_worker, daemon=True).start()
+    queue_missing_derivatives()
+    database.discard()  # Return the startup thread's connection to the pool
     app.run(host='0.0.0.0', port=5011)
\ No newline at end of file
@@ -0,0 +1,57 @@
+"""
+Thumbnails and a tile pyramid for preset images.
+
+Tiles follow the usual deep-zoom layout: level `levels - 1` is the full resolution image,
+each level below it is half the size of the one above, and level 0 fits in a single tile.
+"""
+import io
+import math
+from PIL import Image
+
+THUMBNAIL_WIDTHS = [256, 512, 1024]
+TILE_SIZE = 256
+DERIVATIVE_FORMAT = "WEBP"
+DERIVATIVE_TYPE = "image/webp"
+DERIVATIVE_QUALITY = 80
+
+def encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY)
+    return buffer.getvalue()
+
+def tile_levels(width, height):
+    return max(0, math.ceil(math.log2(max(width, height) / TILE_SIZE))) + 1
+
+def build_thumbnails(image):
+    """(width, height, bytes) for every thumbnail width smaller than the image."""
+    for thumb_width in THUMBNAIL_WIDTHS:
+        if thumb_width >= image.width:
+            break
+        thumb_height = max(1, round(image.height * thumb_width / image.width))
+        thumb = image.resize((thumb_width, thumb_height), Image.LANCZOS)
+        yield thumb_width, thumb_height, encode(thumb)
+
+def build_tiles(image):
+    """(level, x, y, width, height, bytes) for every tile, starting from the smallest level."""
+    levels = tile_levels(image.width, image.height)
+    for level in range(levels):
+        scale = 2 ** (levels - 1 - level)
+        level_image = image if scale == 1 else image.resize(
+            (max(1, math.ceil(image.width / scale)), max(1, math.ceil(image.height / scale))), Image.LANCZOS
+        )
+        for y in range(0, level_image.height, TILE_SIZE):
+            for x in range(0, level_image.width, TILE_SIZE):
+                tile = level_image.crop((x, y, min(x + TILE_SIZE, level_image.width), min(y + TILE_SIZE, level_image.height)))
+                yield level, x // TILE_SIZE, y // TILE_SIZE, tile.width, tile.height, encode(tile)
+
+def build_derivatives(image_bytes):
+    """
+    Returns (width, height, rows) where rows are (kind, level, x, y, width, height, bytes).
+    Thumbnails use their width as the level.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    rows = [("thumb", w, 0, 0, w, h, data) for w, h, data in build_thumbnails(image)]
+    rows.extend(("tile",) + tile for tile in build_tiles(image))
+    return image.width, image.height, rows
@@ -1,50 +1,54 @@
-from flask import Flask, request, jsonify, make_response
-import mysql.connector
+from flask import Flask, request, jsonify, make_response, Response, stream_with_context
 from flask_cors import CORS
 from mysql.connector import Error
 from datetime import datetime
-import os
 import requests
 import time
 import base64
+import binascii
+import gzip
+import hashlib
+import json
+import threading
+import mimetypes
+from shared import metrics, log, db, responses
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "assets_reader")
+logger = log.setup("assets_reader")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request gets its own and returns it to the pool when it ends
+database = db.Database("assets_reader")
+database.init_app(app)
 
-def get_db_connection(retries=5, delay=1):
-    global db_connection
-    for _ in range(retries):
-        try:
-            if db_connection != None and db_connection.is_connected():
-                return db_connection
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-            time.sleep(delay)
-    
-    return None
+def get_db_connection():
+    return database.connection()
+
+def open_connection():
+    """A dedicated pooled connection for a streamed response, the request's is released when the request ends."""
+    return database.checkout()
+
+IMAGE_CHUNK_BYTES = 1024 * 1024
+IMAGE_MAX_AGE = 31536000
+TILE_SIZE = 256  # matches the editor's derivative pipeline
+
+# Presets and the front page only change when the editor writes them, so clients revalidate
+# with If-None-Match and get a 304 instead of the whole payload (images included)
+responses.init_app(app, revalidate=True)
 
 def validate_session_cookie(request):
     VALIDATION_SITE = "http://account_login:5002/validate_cookie"
     cookie = request.cookies.get("session_id")
 
     if not cookie:
-        print("No session_id cookie found.")
+        logger.debug("No session_id cookie found")
         return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
 
-    print(f"Cookie found: {cookie}")
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
+    with metrics.span("validate_cookie"):
+        r = requests.get(VALIDATION_SITE, headers={"session-id": cookie, **metrics.trace_headers()})
     if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
+        logger.info("Invalid cookie detected")
         return {"error": "Invalid cookie"}, 401 #, "message": r.text
 
     # Return the UID if no error
@@ -89,14 +93,15 @@ def get_preset_details(preset_id):
 
     conn = get_db_connection()
     if not conn:
-        print("ERR: No DB connection retrieving data")
+        logger.error("No DB connection retrieving data")
         return jsonify({"error": "DB connection unavailable"}), 500
 
     cursor = conn.cursor(dictionary=True)
     try:
         # Fetch preset details including image columns from presets
         cursor.execute("""
-            SELECT preset_id AS id, preset_name AS name, image_name, image_data, owner_id
+            SELECT preset_id AS id, preset_name AS name, image_name, image_hash, image_width, image_height,
+                   image_data IS NOT NULL AS has_image, owner_id
             FROM presets
             WHERE preset_id = %s
         """, (preset_id,))
@@ -115,6 +120,7 @@ def get_preset_details(preset_id):
         # Fetch boxes from map_blocks
         cursor.execute("""
             SELECT
+              id,
               roomID,
               label,
               `top`,
@@ -127,14 +133,30 @@ def get_preset_details(preset_id):
         """, (preset_id,))
         boxes = cursor.fetchall()
 
-        # Build image object from presets columns if present
+        # The image itself is served by /presets/<id>/image, the hash versions the URL
         image = {}
-        if preset_row.get("image_name") and preset_row.get("image_data"):
-            print(preset_row["image_data"])
+        if preset_row.get("image_name") and preset_row.get("has_image"):
             image = {
                 "name": preset_row["image_name"],
-                "data": preset_row["image_data"].decode('utf-8')
+                "hash": preset_row["image_hash"],
+                "url": preset_image_url(preset_row["id"], preset_row["image_hash"]),
+                "width": preset_row["image_width"],
+                "height": preset_row["image_height"],
+                "thumbnails": [],
+                "tiles": None
             }
+            # Derivatives are built in the background after upload, so they may not exist yet
+            cursor.execute("""
+                SELECT kind, level
+                FROM preset_image_derivatives
+                WHERE preset_id = %s AND image_hash = %s AND x = 0 AND y = 0
+                ORDER BY level ASC
+            """, (preset_id, preset_row["image_hash"]))
+            for row in cursor.fetchall():
+                if row["kind"] == "thumb":
+                    image["thumbnails"].append(row["level"])
+                elif image["tiles"] is None:
+                    image["tiles"] = f"/presets/{preset_id}/tiles"
 
         # Minimal representation of "permission"
         if cookie_error[0] in trusted:
@@ -153,69 +175,293 @@ def get_preset_details(preset_id):
         }), 200
 
     except Error as e:
-        print(f"ERR: Error encountered retrieving preset data: {str(e)}")
+        logger.error("Error encountered retrieving preset data: %s", e, extra={"preset": preset_id})
         return jsonify({"error": str(e)}), 500
     finally:
         cursor.close()
         conn.close()
 
-@app.route('/home', methods=['GET'])
-def get_front_page():   
+def preset_image_url(preset_id, image_hash):
+    url = f"/presets/{preset_id}/image"
+    return f"{url}?v={image_hash}" if image_hash else url
+
+def iter_preset_image(preset_id, image_hash, size):
+    """Reads the blob in IMAGE_CHUNK_BYTES slices, stopping if the image is replaced mid-stream."""
+    conn = open_connection()
+    cursor = conn.cursor()
+    try:
+        for offset in range(1, size + 1, IMAGE_CHUNK_BYTES):
+            cursor.execute(
+                "SELECT SUBSTRING(image_data, %s, %s) FROM presets WHERE preset_id = %s AND image_hash = %s",
+                (offset, IMAGE_CHUNK_BYTES, preset_id, image_hash)
+            )
+            row = cursor.fetchone()
+            if not row or not row[0]:
+                logger.warning("Image changed while streaming", extra={"preset": preset_id})
+                return
+            yield bytes(row[0])
+    except Error as e:
+        logger.error("Error streaming preset image: %s", e, extra={"preset": preset_id})
+    finally:
+        cursor.close()
+        conn.close()
+
+def legacy_preset_image(cursor, preset_id):
+    """Rows written before images were stored as bytes hold the base64 text."""
+    cursor.execute("SELECT image_data FROM presets WHERE preset_id = %s", (preset_id,))
+    image_data = cursor.fetchone()["image_data"]
+    try:
+        return base64.b64decode(image_data, validate=True)
+    except binascii.Error:
+        return bytes(image_data)
+
+def find_thumbnail(cursor, preset_id, image_hash, width):
+    """The smallest thumbnail at least `width` wide, None means the original should be sent."""
+    cursor.execute("""
+        SELECT level, content_type, data
+        FROM preset_image_derivatives
+        WHERE preset_id = %s AND image_hash = %s AND kind = 'thumb' AND level >= %s
+        ORDER BY level ASC
+        LIMIT 1
+    """, (preset_id, image_hash, width))
+    return cursor.fetchone()
+
+def versioned_image_response(response, image_hash, etag):
+    response.set_etag(etag)
+    response.cache_control.private = True
+    if request.args.get("v") == image_hash:
+        # The URL changes with the image, so this one never goes stale
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/presets/<int:preset_id>/image', methods=['GET'])
+def get_preset_image(preset_id):
+    cookie_error = validate_session_cookie(request)
+    if len(cookie_error) == 2:
+        return jsonify(cookie_error[0]), cookie_error[1]
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "DB connection unavailable"}), 500
+
     cursor = conn.cursor(dictionary=True)
     try:
-        cursor.execute("SELECT domain, loginText, hero_title, hero_subtitle, image_name, image_data FROM config WHERE id=1")
-        config_row = cursor.fetchone()
-        # Changed code: decode image_data if present
-        image_data = config_row.get("image_data")
-        if image_data and isinstance(image_data, bytes):
-            image_data = base64.b64encode(image_data).decode('utf-8')
-        config = {
-            "domain": config_row.get("domain"),
-            "loginText": config_row.get("loginText"),
-            "hero": {
-                "title": config_row.get("hero_title"),
-                "subtitle": config_row.get("hero_subtitle"),
-                "image": {
-                    "name": config_row.get("image_name"),
-                    "data": image_data
-                }
-            }
-        }
-        cursor.execute("SELECT title, description, icon FROM features")
-        features = cursor.fetchall()
-        cursor.execute("SELECT * FROM how_it_works")
-        howItWorks = cursor.fetchall()
         cursor.execute("""
-            SELECT 
-              primary_bg, primary_text, primary_bg_hover,
-              primary_dark_bg, primary_dark_text, primary_dark_bg_hover, primary_dark_text_hover,
-              primary_light_bg, primary_light_text, primary_light_bg_hover, primary_light_text_hover,
-              warning_text, warning_bg, warning_text_hover, warning_bg_hover,
-              notification_text, notification_bg, notification_text_hover, notification_bg_hover,
-              active, active_text, active_bg,
-              not_active, not_active_text, not_active_bg,
-              negative, negative_text, negative_bg,
-              positive
-            FROM theme_colours WHERE id=1
-        """)
-        theme = cursor.fetchone()
-        
-        front_page = {
-            "config": config,
-            "features": features,
-            "howItWorks": howItWorks,
-            "theme": theme
-        }
-        return jsonify(front_page), 200
-    except Exception as e:
+            SELECT image_name, image_type, image_hash, OCTET_LENGTH(image_data) AS size
+            FROM presets
+            WHERE preset_id = %s
+        """, (preset_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({"error": "Preset not found"}), 404
+        if not row["size"]:
+            return jsonify({"error": "Preset has no image"}), 404
+
+        image_hash = row["image_hash"]
+        legacy_bytes = None
+        thumbnail = None
+        if image_hash is None:
+            legacy_bytes = legacy_preset_image(cursor, preset_id)
+            image_hash = hashlib.sha256(legacy_bytes).hexdigest()
+        elif request.args.get("width", type=int):
+            thumbnail = find_thumbnail(cursor, preset_id, image_hash, request.args.get("width", type=int))
+        etag = f"{image_hash}-{thumbnail['level']}" if thumbnail else image_hash
+    except Error as e:
+        logger.error("Error encountered retrieving preset image: %s", e, extra={"preset": preset_id})
         return jsonify({"error": str(e)}), 500
     finally:
         cursor.close()
         conn.close()
 
+    image_type = row["image_type"] or mimetypes.guess_type(row["image_name"] or "")[0] or "application/octet-stream"
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    elif thumbnail is not None:
+        response = Response(bytes(thumbnail["data"]), mimetype=thumbnail["content_type"])
+    elif legacy_bytes is not None:
+        response = Response(legacy_bytes, mimetype=image_type)
+    else:
+        response = Response(
+            stream_with_context(iter_preset_image(preset_id, image_hash, row["size"])),
+            mimetype=image_type
+        )
+        response.content_length = row["size"]
+    if response.status_code == 200 and row["image_name"] and thumbnail is None:
+        response.headers["Content-Disposition"] = f'inline; filename="{row["image_name"]}"'
+    return versioned_image_response(response, image_hash, etag)
+
+@app.route('/presets/<int:preset_id>/tiles', methods=['GET'])
+def get_preset_tiles(preset_id):
+    cookie_error = validate_session_cookie(request)
+    if len(cookie_error) == 2:
+        return jsonify(cookie_error[0]), cookie_error[1]
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "DB connection unavailable"}), 500
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT p.image_hash, p.image_width, p.image_height, MAX(d.level) AS max_level
+            FROM presets p
+            JOIN preset_image_derivatives d ON d.preset_id = p.preset_id AND d.image_hash = p.image_hash
+            WHERE p.preset_id = %s AND d.kind = 'tile'
+            GROUP BY p.image_hash, p.image_width, p.image_height
+        """, (preset_id,))
+        row = cursor.fetchone()
+        if not row:
+            return jsonify({"error": "Tiles not available"}), 404
+        return jsonify({
+            "hash": row["image_hash"],
+            "width": row["image_width"],
+            "height": row["image_height"],
+            "tile_size": TILE_SIZE,
+            "levels": row["max_level"] + 1,
+            "url": f"/presets/{preset_id}/tiles/{{level}}/{{x}}/{{y}}?v={row['image_hash']}"
+        }), 200
+    except Error as e:
+        logger.error("Error encountered retrieving preset tiles: %s", e, extra={"preset": preset_id})
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.route('/presets/<int:preset_id>/tiles/<int:level>/<int:x>/<int:y>', methods=['GET'])
+def get_preset_tile(preset_id, level, x, y):
+    cookie_error = validate_session_cookie(request)
+    if len(cookie_error) == 2:
+        return jsonify(cookie_error[0]), cookie_error[1]
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "DB connection unavailable"}), 500
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT d.image_hash, d.content_type, d.data
+            FROM preset_image_derivatives d
+            JOIN presets p ON p.preset_id = d.preset_id AND p.image_hash = d.image_hash
+            WHERE d.preset_id = %s AND d.kind = 'tile' AND d.level = %s AND d.x = %s AND d.y = %s
+        """, (preset_id, level, x, y))
+        tile = cursor.fetchone()
+    except Error as e:
+        logger.error("Error encountered retrieving preset tile: %s", e, extra={"preset": preset_id})
+        return jsonify({"error": str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+    if not tile:
+        return jsonify({"error": "Tile not found"}), 404
+    etag = f"{tile['image_hash']}-{level}-{x}-{y}"
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = Response(bytes(tile["data"]), mimetype=tile["content_type"])
+    return versioned_image_response(response, tile["image_hash"], etag)
+
+# -------------------------------
+# Front page cache
+# -------------------------------
+# /home is the landing page, so the assembled payload is serialised and compressed once per
+# config version. The editor bumps config.version on every /home PATCH, replicas notice it on
+# their next version check.
+FRONT_PAGE_VERSION_CHECK_SECONDS = 1
+front_page_cache = {"version": None, "checked_at": 0, "body": None, "gzip_body": None}
+front_page_lock = threading.Lock()
+
+def build_front_page(cursor):
+    cursor.execute("SELECT domain, loginText, hero_title, hero_subtitle, image_name, image_data FROM config WHERE id=1")
+    config_row = cursor.fetchone()
+    # Changed code: decode image_data if present
+    image_data = config_row.get("image_data")
+    if image_data and isinstance(image_data, bytes):
+        image_data = base64.b64encode(image_data).decode('utf-8')
+    config = {
+        "domain": config_row.get("domain"),
+        "loginText": config_row.get("loginText"),
+        "hero": {
+            "title": config_row.get("hero_title"),
+            "subtitle": config_row.get("hero_subtitle"),
+            "image": {
+                "name": config_row.get("image_name"),
+                "data": image_data
+            }
+        }
+    }
+    cursor.execute("SELECT title, description, icon FROM features")
+    features = cursor.fetchall()
+    cursor.execute("SELECT * FROM how_it_works")
+    howItWorks = cursor.fetchall()
+    cursor.execute("""
+        SELECT 
+          primary_bg, primary_text, primary_bg_hover,
+          primary_dark_bg, primary_dark_text, primary_dark_bg_hover, primary_dark_text_hover,
+          primary_light_bg, primary_light_text, primary_light_bg_hover, primary_light_text_hover,
+          warning_text, warning_bg, warning_text_hover, warning_bg_hover,
+          notification_text, notification_bg, notification_text_hover, notification_bg_hover,
+          active, active_text, active_bg,
+          not_active, not_active_text, not_active_bg,
+          negative, negative_text, negative_bg,
+          positive
+        FROM theme_colours WHERE id=1
+    """)
+    theme = cursor.fetchone()
+    
+    front_page = {
+        "config": config,
+        "features": features,
+        "howItWorks": howItWorks,
+        "theme": theme
+    }
+    return front_page
+
+def get_front_page_cache():
+    """Returns (version, body, gzip_body), rebuilding the payload only if the version changed."""
+    with front_page_lock:
+        if time.monotonic() - front_page_cache["checked_at"] < FRONT_PAGE_VERSION_CHECK_SECONDS:
+            return front_page_cache["version"], front_page_cache["body"], front_page_cache["gzip_body"]
+        conn = get_db_connection()
+        if not conn:
+            raise Error("DB connection unavailable")
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT version FROM config WHERE id=1")
+            version = cursor.fetchone()["version"]
+            if version != front_page_cache["version"]:
+                body = json.dumps(build_front_page(cursor), default=str, sort_keys=True, separators=(",", ":")).encode("utf-8")
+                front_page_cache.update(version=version, body=body, gzip_body=gzip.compress(body, compresslevel=9))
+                logger.info("Front page cache rebuilt", extra={"version": version})
+            front_page_cache["checked_at"] = time.monotonic()
+        finally:
+            cursor.close()
+            conn.close()
+        return front_page_cache["version"], front_page_cache["body"], front_page_cache["gzip_body"]
+
+@app.route('/home', methods=['GET'])
+def get_front_page():   
+    try:
+        version, body, gzip_body = get_front_page_cache()
+    except Exception as e:
+        if front_page_cache["body"] is None:
+            return jsonify({"error": str(e)}), 500
+        # Keep serving the last good payload while the database is unavailable
+        logger.warning("Serving cached front page: %s", e)
+        version, body, gzip_body = front_page_cache["version"], front_page_cache["body"], front_page_cache["gzip_body"]
+
+    response = Response(body, mimetype="application/json")
+    # Weak, like every other ETag here: the gzip and identity bodies share it
+    response.set_etag(f"home-{version}", weak=True)
+    if "gzip" in request.headers.get("Accept-Encoding", "").lower():
+        response.set_data(gzip_body)
+        response.content_encoding = "gzip"
+    return response
+
 if __name__ == '__main__':
-    get_db_connection()  # Ensure the connection is established at startup
+    database.pool()  # Ensure the database is reachable at startup
     app.run(host='0.0.0.0', port=5010)
\ No newline at end of file
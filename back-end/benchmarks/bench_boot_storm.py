@@ -0,0 +1,160 @@
+"""
+Reboot storm benchmark for the boot message handler.
+
+Feeds DEVICES boot messages (each repeated REPEATS times, as devices do when the broker is
+slow to answer) straight into on_message from several threads and times how long it takes
+until every device has had its reply published. MQTT is replaced by a client that records
+publishes, the database is the real one from the DB_* environment variables.
+
+    docker compose run --rm -v "$PWD/benchmarks:/app/benchmarks" hardware_config \
+        python -u benchmarks/bench_boot_storm.py --devices 5000
+
+Rounds:
+  cold     devices are unknown and get registered
+  restart  devices exist but the cache is empty (service just restarted)
+  warm     every config is cached
+  baseline the handler before the cache: on the MQTT thread, one SELECT per boot message (two
+           for trackers), a commit and a publish for every message, repeats included
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+# hardware/config in a checkout, or the service's /app when mounted into its container
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "..", "hardware", "config"), os.path.join(HERE, "..")]
+import app  # noqa: E402
+
+DEVICE_PREFIX = "benchBoot"
+HARDWARE_MESSAGE_TOPIC = "hardware_config/hardware_message/"
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload, qos=0):
+        with self.lock:
+            self.published += 1
+
+
+def boot_messages(devices, repeats):
+    messages = []
+    for _ in range(repeats):
+        for i in range(devices):
+            pico_id = f"{DEVICE_PREFIX}{i:05d}"
+            messages.append(SimpleNamespace(topic=HARDWARE_MESSAGE_TOPIC + pico_id,
+                                            payload=json.dumps({"PicoID" : pico_id}).encode("utf-8")))
+    return messages
+
+
+def storm(client, messages, devices, threads, timeout=120):
+    """Seconds until `devices` replies have been published."""
+    app.recent_replies.clear()
+    target = client.published + devices
+    chunks = [messages[i::threads] for i in range(threads)]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        workers = [threading.Thread(target=lambda chunk=chunk: [app.on_message(client, None, m) for m in chunk])
+                   for chunk in chunks]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        while client.published < target and time.perf_counter() - started < timeout:
+            time.sleep(0.005)
+    return time.perf_counter() - started
+
+
+def old_on_message(client, connection, message):
+    """on_message as it was before the cache, minus its prints; the devices are all known by now."""
+    cursor = connection.cursor()
+    try:
+        pico_id = app.ConfigRequest.parse_raw(message.payload.decode("utf-8", errors="ignore")).PicoID
+        cursor.execute("SELECT readablePicoID, bluetoothID, picoType FROM pico_device WHERE picoID = %s;", (pico_id,))
+        readable_id, bt_id, pico_type = cursor.fetchone()
+        tracking_group = ""
+        if pico_type == app.BT_TRACKER_PICO_TYPE:
+            cursor.execute("""SELECT tracking_groups.groupName
+                              FROM tracking_groups
+                              INNER JOIN bluetooth_tracker ON tracking_groups.groupID = bluetooth_tracker.trackingGroupID
+                              WHERE bluetooth_tracker.picoID = %s;""", (pico_id,))
+            row = cursor.fetchone()
+            tracking_group = row[0] if row else ""
+        response = json.dumps({"ReadableID" : readable_id, "BluetoothID" : 0 if bt_id is None else int(bt_id),
+                               "PicoType" : pico_type, "TrackerGroup" : tracking_group})
+        client.publish(app.SERVER_MESSAGE_TOPIC + pico_id, response, qos=2)
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+def baseline(messages):
+    """Seconds for the old handler to answer every message in turn, as paho's one network thread did."""
+    connection = app.get_db_connection()
+    client = RecordingClient()
+    started = time.perf_counter()
+    for message in messages:
+        old_on_message(client, connection, message)
+    return time.perf_counter() - started
+
+
+def cleanup():
+    connection = app.get_db_connection()
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM pico_device WHERE picoID LIKE %s", (DEVICE_PREFIX + "%",))
+    connection.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    if app.get_db_connection() is None:
+        print("No database connection")
+        return
+    cleanup()
+
+    client = RecordingClient()
+    threading.Thread(target=app.reply_worker, args=(client,), daemon=True).start()
+    messages = boot_messages(args.devices, args.repeats)
+
+    results = []
+    try:
+        for name in ["cold", "restart", "warm"]:
+            if name != "warm":
+                app.device_configs.clear()
+            lookups = app.cache_stats["lookups"]
+            seconds = storm(client, messages, args.devices, args.threads)
+            results.append((name, seconds, app.cache_stats["lookups"] - lookups))
+        results.append(("baseline", baseline(messages), len(messages)))
+    finally:
+        cleanup()
+
+    print(f"{args.devices} devices x {args.repeats} boot messages, {args.threads} MQTT threads")
+    print(f"{'round':<10}{'seconds':>10}{'boots/s':>12}{'queries':>10}")
+    for name, seconds, queries in results:
+        print(f"{name:<10}{seconds:>10.3f}{len(messages) / seconds:>12.0f}{queries:>10}")
+    print(f"replies published: {client.published}, coalesced: {app.cache_stats['coalesced']}")
+    print(json.dumps({
+        "devices": args.devices,
+        "repeats": args.repeats,
+        "threads": args.threads,
+        "rounds": [{"round": name, "seconds": round(seconds, 3), "boots_per_second": round(len(messages) / seconds),
+                    "queries": queries} for name, seconds, queries in results],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+End-to-end ingest benchmark: publish -> data_processor -> MySQL -> data_reader.
+
+Publishes MESSAGES PicoData messages for a fleet of benchmark devices, waits until
+data_processor has written them to MySQL, then times the reader's /summary and /movement
+over the result. Meant for the local broker so it runs fully offline:
+
+    export MQTT_HOST=mqtt_broker mqtt_token=local
+    docker compose --profile local-mqtt up -d mqtt_broker && docker compose up -d
+    docker compose run --rm --entrypoint python test -u benchmarks/bench_e2e_throughput.py --messages 20000
+
+Devices are registered through dummy/app.py's fleet helpers, as the dummy database user,
+with fixed IDs so repeated runs reuse them. Their data rows are left behind (the dummy
+user cannot delete).
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "..", "dummy"), os.path.join(HERE, "..")]
+import app as dummy  # noqa: E402
+from shared import broker  # noqa: E402
+
+DEVICE_PREFIX = "benchE2E"
+ACCOUNTS_URL = os.getenv("ACCOUNTS_URL", "http://account_registration:5001")
+LOGIN_URL = os.getenv("LOGIN_URL", "http://account_login:5002")
+READER_URL = os.getenv("READER_URL", "http://data_reader:5003")
+
+
+def create_devices(conn, rooms, trackers):
+    room_ids = [f"{DEVICE_PREFIX}R{i:03d}" for i in range(rooms)]
+    tracker_ids = [f"{DEVICE_PREFIX}T{i:05d}" for i in range(trackers)]
+    dummy.upsert_pico_devices(conn, [(pico_id, pico_id, None, dummy.ENVIRONMENT_PICO_TYPE) for pico_id in room_ids]
+                                    + [(pico_id, pico_id, None, dummy.BT_TRACKER_PICO_TYPE) for pico_id in tracker_ids])
+    group_id = dummy.ensure_tracking_group_exists(conn, "user")
+    dummy.link_trackers(conn, [(pico_id, group_id) for pico_id in tracker_ids])
+    return room_ids, tracker_ids, dummy.room_bluetooth_ids(conn, room_ids)
+
+
+def db_now(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT NOW()")
+    (now,) = cursor.fetchone()
+    cursor.close()
+    return now
+
+
+def count_rows(conn, since):
+    conn.commit()  # new snapshot, the connection is REPEATABLE READ
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM bluetooth_tracker_data WHERE picoID LIKE %s AND logged_at >= %s",
+                   (DEVICE_PREFIX + "%", since))
+    (trackers,) = cursor.fetchone()
+    cursor.execute("SELECT COUNT(*) FROM environment_sensor_data WHERE picoID LIKE %s AND logged_at >= %s",
+                   (DEVICE_PREFIX + "%", since))
+    (environment,) = cursor.fetchone()
+    cursor.close()
+    return trackers + environment
+
+
+def publish(messages, rate, qos):
+    """Publishes (topic, payload) pairs, returning (seconds, failed)."""
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(os.getenv("mqtt_token"), None)
+    client.max_inflight_messages_set(1000)
+    connected = threading.Event()
+    client.on_connect = lambda *args: connected.set()
+    broker.connect(client)
+    client.loop_start()
+    connected.wait(10)
+
+    failed = 0
+    infos = []
+    started = time.perf_counter()
+    for i, (topic, payload) in enumerate(messages):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        info = client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            failed += 1
+        elif qos:
+            infos.append(info)
+    for info in infos:
+        info.wait_for_publish(10)
+    seconds = time.perf_counter() - started
+    client.loop_stop()
+    client.disconnect()
+    return seconds, failed
+
+
+def wait_for_rows(conn, since, expected, idle_timeout):
+    """(rows, seconds) once `expected` rows exist or the count stops moving for idle_timeout seconds."""
+    started = time.perf_counter()
+    last_change = started
+    rows = 0
+    while rows < expected and time.perf_counter() - last_change < idle_timeout:
+        time.sleep(0.25)
+        current = count_rows(conn, since)
+        if current != rows:
+            rows = current
+            last_change = time.perf_counter()
+    return rows, last_change - started
+
+
+def login():
+    email = "bench_" + "".join(random.choices(string.ascii_lowercase + string.digits, k=10)) + "@fakecompany.co.uk"
+    requests.post(f"{ACCOUNTS_URL}/register", headers={"name": "Benchmark", "email": email, "password": "password123"})
+    response = requests.post(f"{LOGIN_URL}/login", headers={"email": email, "password": "password123"})
+    response.raise_for_status()
+    return {"session_id": response.cookies.get("session_id")}
+
+
+def time_requests(url, cookies, repeats):
+    """Latency percentiles in ms for `repeats` sequential GETs."""
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = requests.get(url, cookies=cookies)
+        timings.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    timings.sort()
+    return {"p50": round(timings[len(timings) // 2], 1),
+            "p95": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 1),
+            "max": round(timings[-1], 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--trackers", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument("--idle-timeout", type=float, default=15, help="give up once no rows arrive for this long")
+    parser.add_argument("--reader-repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    conn = dummy.get_connection()
+    if conn is None:
+        print("No database connection")
+        return
+    dummy.switch_database(conn, "pico")
+    room_ids, tracker_ids, bluetooth_ids = create_devices(conn, args.rooms, args.trackers)
+
+    messages = []
+    for i in range(args.messages):
+        if i % 10 == 0:
+            pico_id = room_ids[(i // 10) % len(room_ids)]
+            payload = {"PicoID": pico_id, "RoomID": bluetooth_ids[pico_id], "PicoType": dummy.ENVIRONMENT_PICO_TYPE,
+                       "Data": ",".join(str(value) for value in dummy.environment_reading())}
+        else:
+            pico_id = tracker_ids[i % len(tracker_ids)]
+            payload = {"PicoID": pico_id, "RoomID": bluetooth_ids[random.choice(room_ids)],
+                       "PicoType": dummy.BT_TRACKER_PICO_TYPE, "Data": ""}
+        messages.append(("feeds/hardware-data/" + pico_id, json.dumps(payload)))
+
+    since = db_now(conn)
+    publish_seconds, failed = publish(messages, args.rate, args.qos)
+    rows, ingest_seconds = wait_for_rows(conn, since, args.messages - failed, args.idle_timeout)
+    conn.close()
+    # ingest_seconds counts from the end of publishing; the processor starts as soon as the first message lands
+    total_seconds = publish_seconds + ingest_seconds
+
+    cookies = login()
+    reader = {
+        "summary": time_requests(f"{READER_URL}/summary", cookies, args.reader_repeats),
+        "movement": time_requests(f"{READER_URL}/movement", cookies, args.reader_repeats),
+    }
+
+    print(f"{args.messages} messages, {args.trackers} trackers, {args.rooms} rooms, QoS {args.qos}, "
+          f"broker {broker.HOST}")
+    print(f"published in {publish_seconds:.2f}s ({args.messages / publish_seconds:,.0f} msg/s), {failed} failed")
+    print(f"stored {rows} rows in {total_seconds:.2f}s ({rows / total_seconds:,.0f} rows/s), "
+          f"{args.messages - failed - rows} lost")
+    for name, latency in reader.items():
+        print(f"/{name:<10} p50 {latency['p50']}ms  p95 {latency['p95']}ms  max {latency['max']}ms")
+    print(json.dumps({
+        "messages": args.messages,
+        "rooms": args.rooms,
+        "trackers": args.trackers,
+        "qos": args.qos,
+        "publish_seconds": round(publish_seconds, 3),
+        "publish_per_second": round(args.messages / publish_seconds),
+        "publish_failed": failed,
+        "rows_stored": rows,
+        "rows_lost": args.messages - failed - rows,
+        "ingest_seconds": round(total_seconds, 3),
+        "ingest_per_second": round(rows / total_seconds),
+        "reader_ms": reader,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
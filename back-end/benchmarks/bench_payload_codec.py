@@ -0,0 +1,134 @@
+"""
+Telemetry payload benchmark: JSON PicoData vs the binary format in shared/telemetry.py.
+
+For a mix of environment and tracker messages shaped like the devices send them, reports
+the payload size and, for each format, the decode throughput and CPU time per message of
+the path data/processor and warning/alert take up to having the PicoID, RoomID, PicoType
+and readings in hand:
+
+  json    bytes -> utf-8 str -> PicoData.parse_raw -> Data.split(",") -> float
+  binary  telemetry.decode (struct.unpack_from in place) + PicoID from the topic
+
+No services needed, but pydantic is, so run it inside the data_processor image:
+
+    docker compose run --rm -v "$PWD/benchmarks:/app/benchmarks" data_processor \
+        python -u benchmarks/bench_payload_codec.py --messages 200000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Union
+
+from pydantic import BaseModel
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+from shared import telemetry  # noqa: E402
+
+TOPIC = "feeds/hardware-data/"
+
+
+class PicoData(BaseModel):
+    # as in data/processor and warning/alert
+    PicoID: Union[str, int]
+    RoomID: Union[str, int]
+    PicoType: int
+    Data: Union[str, int]
+
+
+def device_id(i):
+    # the devices use their MAC address without colons
+    return f"{0x2CCF67000000 + i:012X}"
+
+
+def sample_messages(count, environment_share):
+    """(topic, json payload, binary payload) triples."""
+    messages = []
+    for i in range(count):
+        pico_id = device_id(i % 5000)
+        room_id = random.randint(1000, 1999)
+        if random.random() < environment_share:
+            values = [round(random.uniform(30, 90), 2), float(random.randint(0, 4000)), round(random.uniform(15, 30), 2),
+                      round(random.uniform(0, 300), 2), round(random.uniform(980, 1040), 2), round(random.uniform(20, 80), 2)]
+            document = {"PicoID": pico_id, "RoomID": room_id, "PicoType": telemetry.ENVIRONMENT_PICO_TYPE,
+                        "Data": ",".join(str(value) for value in values)}
+            binary = telemetry.encode(telemetry.ENVIRONMENT_PICO_TYPE, room_id, values)
+        else:
+            # the trackers send RoomID as a string and an empty Data field
+            document = {"PicoID": pico_id, "RoomID": str(room_id), "PicoType": 2, "Data": ""}
+            binary = telemetry.encode(2, room_id)
+        messages.append((TOPIC + pico_id, json.dumps(document, separators=(",", ":")).encode("utf-8"), binary))
+    return messages
+
+
+def decode_json(topic, payload):
+    data = PicoData.parse_raw(payload.decode("utf-8", errors="ignore"))
+    readings = list(map(float, data.Data.split(","))) if data.PicoType == telemetry.ENVIRONMENT_PICO_TYPE else None
+    return data.PicoID, data.RoomID, data.PicoType, readings
+
+
+def decode_binary(topic, payload):
+    pico_type, room_id, readings = telemetry.decode(payload)
+    return telemetry.pico_id(topic), room_id, pico_type, readings
+
+
+def run(decoder, messages, column, repeats):
+    """(messages per second, CPU microseconds per message), best of `repeats`."""
+    best_wall, best_cpu = None, None
+    for _ in range(repeats):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        for message in messages:
+            decoder(message[0], message[column])
+        wall, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    return len(messages) / best_wall, best_cpu / len(messages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--environment-share", type=float, default=0.1,
+                        help="fraction of messages from room sensors, the rest are trackers")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    messages = sample_messages(args.messages, args.environment_share)
+    # Both paths must agree before their speed means anything
+    for topic, json_payload, binary_payload in messages[:1000]:
+        pico_id, room_id, pico_type, readings = decode_json(topic, json_payload)
+        expected = decode_binary(topic, binary_payload)
+        assert (pico_id, int(room_id), pico_type) == expected[:3], (pico_id, room_id, pico_type, expected)
+        if readings is not None:
+            assert all(abs(a - b) <= abs(a) * 1e-6 + 1e-6 for a, b in zip(readings, expected[3])), (readings, expected[3])
+
+    sizes = {}
+    for name, column in (("json", 1), ("binary", 2)):
+        environment = [len(m[column]) for m in messages if m[2][1] == telemetry.ENVIRONMENT_PICO_TYPE]
+        trackers = [len(m[column]) for m in messages if m[2][1] != telemetry.ENVIRONMENT_PICO_TYPE]
+        sizes[name] = {"environment": round(sum(environment) / max(len(environment), 1), 1),
+                       "tracker": round(sum(trackers) / max(len(trackers), 1), 1),
+                       "mean": round(sum(len(m[column]) for m in messages) / len(messages), 1)}
+
+    results = {}
+    for name, decoder, column in (("json", decode_json, 1), ("binary", decode_binary, 2)):
+        per_second, cpu_us = run(decoder, messages, column, args.repeats)
+        results[name] = {"bytes": sizes[name], "decode_per_second": round(per_second), "cpu_us_per_message": round(cpu_us, 2)}
+
+    print(f"{args.messages} messages, {args.environment_share:.0%} environment")
+    for name, result in results.items():
+        print(f"{name:<7} {result['bytes']['mean']:>6} B/msg (env {result['bytes']['environment']}, "
+              f"tracker {result['bytes']['tracker']})  {result['decode_per_second']:>10,} msg/s  "
+              f"{result['cpu_us_per_message']} us CPU/msg")
+    print(f"binary is {results['json']['bytes']['mean'] / results['binary']['bytes']['mean']:.1f}x smaller and decodes "
+          f"{results['binary']['decode_per_second'] / results['json']['decode_per_second']:.1f}x faster")
+    print(json.dumps({"messages": args.messages, "environment_share": args.environment_share, **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Memory benchmark for the data reader's streaming responses.
+
+Compares peak Python heap usage of the buffered path (fetchall -> dict tree -> jsonify)
+against the streaming path (fetchmany from an unbuffered cursor -> incremental JSON)
+for /movement shaped results of increasing size. No database or Flask needed:
+
+    python benchmarks/bench_reader_streaming.py
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "data", "reader"))
+from streaming import iter_rows, json_object, movement_buckets  # noqa: E402
+
+ROOMS = [f"room{i:02d}" for i in range(20)]
+TYPES = ["users", "luggage", "staff", "guard"]
+
+class FakeCursor:
+    """Generates rows lazily, like an unbuffered cursor reading from the server socket."""
+    def __init__(self, trackers, minutes):
+        self.trackers = trackers
+        self.minutes = minutes
+        self.position = 0
+        self.total = trackers * minutes
+        self.start = datetime(2024, 1, 1)
+
+    def row(self, i):
+        minute, tracker = divmod(i, self.trackers)
+        ts = self.start + timedelta(minutes=minute)
+        return {
+            "roomID": ROOMS[(tracker + minute // 7) % len(ROOMS)],
+            "picoID": f"AA:BB:CC:{tracker // 65536:02X}:{tracker // 256 % 256:02X}:{tracker % 256:02X}",
+            "bucket": ts.strftime("%Y-%m-%dT%H:%M:00Z"),
+        }
+
+    def fetchmany(self, size):
+        end = min(self.position + size, self.total)
+        rows = [self.row(i) for i in range(self.position, end)]
+        self.position = end
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(self.total - self.position)
+
+def tracker_type(picoID):
+    return TYPES[int(picoID[-2:], 16) % len(TYPES)]
+
+def buffered(cursor):
+    movement_summary = {}
+    for row in cursor.fetchall():
+        bucket = movement_summary.setdefault(row["bucket"], {})
+        bucket.setdefault(row["roomID"], {})[row["picoID"]] = tracker_type(row["picoID"])
+    return len(json.dumps(movement_summary))
+
+def streamed(cursor):
+    written = 0
+    for chunk in json_object(movement_buckets(iter_rows(cursor), tracker_type)):
+        written += len(chunk)
+    return written
+
+def measure(fn, trackers, minutes):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = fn(FakeCursor(trackers, minutes))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, peak, elapsed
+
+def main():
+    trackers = int(os.getenv("BENCH_TRACKERS", "1000"))
+    results = []
+    for minutes in (60, 360, 1440):
+        row = {"trackers": trackers, "minutes": minutes, "rows": trackers * minutes}
+        for name, fn in (("buffered", buffered), ("streamed", streamed)):
+            size, peak, elapsed = measure(fn, trackers, minutes)
+            row[name] = {"bytes": size, "peak_mib": round(peak / 2**20, 2), "seconds": round(elapsed, 2)}
+        results.append(row)
+        print(f"{row['rows']:>9} rows | buffered peak {row['buffered']['peak_mib']:>8} MiB"
+              f" | streamed peak {row['streamed']['peak_mib']:>6} MiB")
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+End-to-end performance regression suite.
+
+Seeds a realistic dataset once, then measures the read endpoints, the ingest path and the
+alert evaluator against the running stack and writes the results as JSON. Passing an
+earlier result with --baseline compares the two runs and exits non-zero on a regression.
+
+    export MQTT_HOST=mqtt_broker mqtt_token=local
+    docker compose --profile local-mqtt up -d mqtt_broker && docker compose up -d
+    docker compose run --rm --entrypoint python -v "$PWD/benchmarks:/app/benchmarks" test \
+        -u benchmarks/perf_regression.py --output benchmarks/results/latest.json \
+        --baseline benchmarks/results/baseline.json
+
+Dataset (seeded through dummy/app.py, skipped when already present):
+  tracker rows      --tracker-rows (10M) over the dummy fleet, one sample a minute ending now
+  environment rows  --environment-rows (1M) from --rooms (200) room sensors
+  rules             --rules (500) test-only warning rules, created per run and deleted after
+  messages          --messages (5000) between the benchmark user and the demo account
+
+Measured:
+  latency    p50/p90/p95/p99 ms for /summary, /summary/average, /movement, /pico,
+             /warnings/logs, /get_messages and /presets/<id>
+  ingest     rows/s from MQTT through data_processor into MySQL (bench_e2e_throughput.py)
+  alerts     rules/s evaluated by the active warning/alert node for one triggering message
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import paho.mqtt.client as mqtt
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [HERE, os.path.join(HERE, "..", "dummy"), os.path.join(HERE, "..")]
+import app as dummy  # noqa: E402
+import bench_e2e_throughput as e2e  # noqa: E402
+from shared import broker  # noqa: E402
+
+ACCOUNTS_URL = os.getenv("ACCOUNTS_URL", "http://account_registration:5001")
+LOGIN_URL = os.getenv("LOGIN_URL", "http://account_login:5002")
+MESSAGES_URL = os.getenv("MESSAGES_URL", "http://account_messages:5007")
+READER_URL = os.getenv("READER_URL", "http://data_reader:5003")
+WARNINGS_URL = os.getenv("WARNINGS_URL", "http://warning_editor:5004")
+ASSETS_URL = os.getenv("ASSETS_URL", "http://assets_reader:5010")
+
+TRACKERS_PER_GROUP_LIMIT = 50000
+# Lower is better for latencies and seconds, higher is better for rates
+HIGHER_IS_BETTER = ("per_second",)
+
+
+def random_suffix(length=10):
+    return "".join(random.choices(string.ascii_lowercase + string.digits, k=length))
+
+
+# -------------------------------
+# Seeding
+# -------------------------------
+def fleet_shape(tracker_rows, environment_rows, rooms):
+    """(samples per device, trackers per group) so the fleet produces roughly the requested row counts."""
+    samples = max(1, environment_rows // rooms)
+    per_group = max(1, round(tracker_rows / samples / len(dummy.TRACKER_GROUPS)))
+    return samples, min(per_group, TRACKERS_PER_GROUP_LIMIT)
+
+
+def fleet_rows(conn, picos):
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(picos))
+    cursor.execute(f"SELECT COUNT(*) FROM bluetooth_tracker_data WHERE picoID IN ({placeholders})", tuple(picos))
+    (rows,) = cursor.fetchone()
+    cursor.close()
+    return rows
+
+
+def seed_readings(conn, args):
+    samples, per_group = fleet_shape(args.tracker_rows, args.environment_rows, args.rooms)
+    rooms = dummy.room_ids(args.rooms)
+    trackers = dummy.tracker_ids({tracker: per_group for tracker in dummy.TRACKER_GROUPS})
+    dummy.create_fleet(conn, rooms, trackers)
+    pico_ids = [mac for macs in trackers.values() for mac in macs]
+
+    # Every tracker gets the same number of samples, so one tracker's rows give the total
+    existing = fleet_rows(conn, pico_ids[:1]) * len(pico_ids)
+    if existing >= args.tracker_rows * 0.95 and not args.reseed:
+        print(f"Dataset present (~{existing:,} tracker rows), skipping seeding")
+        return rooms, pico_ids
+
+    print(f"Seeding {samples:,} samples x ({len(pico_ids):,} trackers + {len(rooms)} rooms)")
+    backfill = argparse.Namespace(days=samples * 60 / 86400, interval=60, movement="dwell", dwell=15,
+                                  load_data=args.load_data)
+    dummy.run_backfill(conn, backfill, rooms, trackers)
+    dummy.seed_demo_assets(conn, rooms)
+    return rooms, pico_ids
+
+
+def seed_messages(conn, user_id, count):
+    dummy.switch_database(conn, "accounts")
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM users WHERE email = %s", ("filler@fakecompany.co.uk",))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.close()
+        dummy.switch_database(conn, "pico")
+        print("No demo account to exchange messages with, skipping message seeding")
+        return
+    other_id = row[0]
+    now = datetime.now()
+    rows = []
+    for i in range(count):
+        sender, receiver = (user_id, other_id) if i % 2 else (other_id, user_id)
+        rows.append((receiver, sender, f"Benchmark message {i}", now - timedelta(seconds=count - i), 1))
+    for i in range(0, len(rows), dummy.BATCH_ROWS):
+        cursor.executemany("""INSERT INTO messages (receiver_id, sender_id, left_message, time_sent, is_read)
+                              VALUES (%s, %s, %s, %s, %s)""", rows[i:i + dummy.BATCH_ROWS])
+    conn.commit()
+    cursor.close()
+    dummy.switch_database(conn, "pico")
+
+
+def admin_session():
+    """Registers an admin (the registration bypass header) and returns (email, cookies)."""
+    email = f"perf_{random_suffix()}@fakecompany.co.uk"
+    response = requests.post(f"{ACCOUNTS_URL}/register",
+                             headers={"name": "Perf Admin", "email": email, "password": "password123", "bypass": "yes"})
+    response.raise_for_status()
+    response = requests.post(f"{LOGIN_URL}/login", headers={"email": email, "password": "password123"})
+    response.raise_for_status()
+    return email, {"session_id": response.cookies.get("session_id")}
+
+
+def user_id_for(conn, email):
+    dummy.switch_database(conn, "accounts")
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM users WHERE email = %s", (email,))
+    (user_id,) = cursor.fetchone()
+    cursor.close()
+    dummy.switch_database(conn, "pico")
+    return user_id
+
+
+def create_rules(cookies, count, room_id):
+    """Test-only rules that all fire on any environment reading for room_id."""
+    rule_ids = []
+    for i in range(count):
+        name = f"Perf_{random_suffix(6)}_{i}"
+        response = requests.post(f"{WARNINGS_URL}/warnings", json={"name": name, "test_only": True}, cookies=cookies)
+        response.raise_for_status()
+        rule_id = response.json()["id"]
+        rule_ids.append(rule_id)
+        response = requests.patch(f"{WARNINGS_URL}/warnings/{rule_id}", cookies=cookies, json={
+            "name": name,
+            "conditions": [{"roomID": str(room_id),
+                            "conditions": [{"variable": "temperature", "lower_bound": -100, "upper_bound": 1000}]}],
+            "messages": [{"Authority": "everyone", "Title": "Perf", "Location": str(room_id),
+                          "Severity": "warning", "Summary": "Performance suite rule"}],
+        })
+        response.raise_for_status()
+    return rule_ids
+
+
+def delete_rules(cookies, rule_ids):
+    for rule_id in rule_ids:
+        try:
+            requests.delete(f"{WARNINGS_URL}/warnings/{rule_id}", cookies=cookies)
+        except requests.RequestException as e:
+            print(f"Cleanup failed for rule {rule_id}: {e}")
+
+
+# -------------------------------
+# Measurements
+# -------------------------------
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def latency(url, cookies, repeats, warmup=2, **kwargs):
+    for _ in range(warmup):
+        requests.get(url, cookies=cookies, **kwargs)
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        response = requests.get(url, cookies=cookies, **kwargs)
+        timings.append((time.perf_counter() - started) * 1000)
+        response.raise_for_status()
+    timings.sort()
+    return {"p50_ms": round(percentile(timings, 0.50), 1),
+            "p90_ms": round(percentile(timings, 0.90), 1),
+            "p95_ms": round(percentile(timings, 0.95), 1),
+            "p99_ms": round(percentile(timings, 0.99), 1)}
+
+
+def endpoint_latencies(cookies, repeats, pico_id, preset_id, rooms):
+    now = datetime.utcnow()
+    day_ago = (now - timedelta(days=1)).isoformat() + "Z"
+    endpoints = {
+        "/summary": (f"{READER_URL}/summary", {}),
+        "/summary/average": (f"{READER_URL}/summary/average",
+                             {"params": {"start_time": day_ago, "end_time": now.isoformat() + "Z",
+                                         "time_periods": "1hr", "rooms": rooms}}),
+        "/movement": (f"{READER_URL}/movement", {}),
+        "/pico": (f"{READER_URL}/pico/{pico_id}", {}),
+        "/warnings/logs": (f"{WARNINGS_URL}/warnings/logs", {}),
+        "/get_messages": (f"{MESSAGES_URL}/get_messages", {}),
+        "/presets/<id>": (f"{ASSETS_URL}/presets/{preset_id}", {}),
+    }
+    results = {}
+    for name, (url, kwargs) in endpoints.items():
+        results[name] = latency(url, cookies, repeats, **kwargs)
+        print(f"{name:<18} p50 {results[name]['p50_ms']:>8}ms  p95 {results[name]['p95_ms']:>8}ms  "
+              f"p99 {results[name]['p99_ms']:>8}ms")
+    return results
+
+
+def alert_evaluation(rule_ids, room_pico_id, room_bluetooth_id, timeout):
+    """Rules per second from one triggering reading until every rule's warning has arrived."""
+    waiting = set(rule_ids)
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def on_message(client, user_data, message):
+        try:
+            rule_id = json.loads(message.payload).get("ID")
+        except ValueError:
+            return
+        with lock:
+            waiting.discard(rule_id)
+            if not waiting:
+                done.set()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(os.getenv("mqtt_token"), None)
+    subscribed = threading.Event()
+    client.on_message = on_message
+    client.on_subscribe = lambda *args: subscribed.set()
+    client.on_connect = lambda client, *args: client.subscribe("test/warnings/#")
+    broker.connect(client)
+    client.loop_start()
+    subscribed.wait(10)
+
+    payload = {"PicoID": room_pico_id, "RoomID": room_bluetooth_id, "PicoType": dummy.ENVIRONMENT_PICO_TYPE,
+               "Data": "50,400,21,80,1010,45"}
+    started = time.perf_counter()
+    client.publish("feeds/hardware-data/" + room_pico_id, json.dumps(payload), qos=1)
+    done.wait(timeout)
+    seconds = time.perf_counter() - started
+    client.loop_stop()
+    client.disconnect()
+    fired = len(rule_ids) - len(waiting)
+    return {"rules": len(rule_ids), "fired": fired, "seconds": round(seconds, 3),
+            "rules_per_second": round(fired / seconds)}
+
+
+# -------------------------------
+# Comparison
+# -------------------------------
+def flatten(results, prefix=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(results, baseline, tolerance):
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)."""
+    old = dict(flatten(baseline.get("metrics", {})))
+    regressions = []
+    for name, value in flatten(results["metrics"]):
+        if name not in old or not old[name]:
+            continue
+        higher_is_better = name.endswith(HIGHER_IS_BETTER)
+        if not (name.endswith("_ms") or higher_is_better):
+            continue
+        change = (value - old[name]) / old[name]
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append({"metric": name, "baseline": old[name], "current": value,
+                                "change": round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tracker-rows", type=int, default=10_000_000)
+    parser.add_argument("--environment-rows", type=int, default=1_000_000)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--rules", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=50, help="requests per endpoint")
+    parser.add_argument("--ingest-messages", type=int, default=20000)
+    parser.add_argument("--alert-timeout", type=float, default=60)
+    parser.add_argument("--load-data", action="store_true", help="seed with LOAD DATA LOCAL INFILE")
+    parser.add_argument("--reseed", action="store_true", help="seed readings even if the dataset looks present")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--baseline", help="earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="allowed slowdown before failing, as a fraction")
+    args = parser.parse_args()
+    if not 1 <= args.rooms <= 999:
+        parser.error("--rooms must be between 1 and 999")
+
+    conn = dummy.get_connection(allow_local_infile=args.load_data)
+    if conn is None:
+        print("No database connection")
+        sys.exit(2)
+    dummy.switch_database(conn, "pico")
+
+    rooms, pico_ids = seed_readings(conn, args)
+    email, cookies = admin_session()
+    seed_messages(conn, user_id_for(conn, email), args.messages)
+    bluetooth_ids = dummy.room_bluetooth_ids(conn, rooms[:1])
+    conn.close()
+
+    presets = requests.get(f"{ASSETS_URL}/presets", cookies=cookies)
+    presets.raise_for_status()
+    preset_id = presets.json()["default"] or presets.json()["presets"][0]["id"]
+
+    rule_ids = create_rules(cookies, args.rules, bluetooth_ids[rooms[0]])
+    try:
+        metrics = {"latency": endpoint_latencies(cookies, args.repeats, pico_ids[0], preset_id,
+                                                 [str(bluetooth_ids[rooms[0]])])}
+        metrics["alerts"] = alert_evaluation(rule_ids, rooms[0], bluetooth_ids[rooms[0]], args.alert_timeout)
+        print(f"alerts: {metrics['alerts']['fired']}/{args.rules} rules fired in {metrics['alerts']['seconds']}s "
+              f"({metrics['alerts']['rules_per_second']} rules/s)")
+    finally:
+        delete_rules(cookies, rule_ids)
+
+    ingest_conn = dummy.get_connection()
+    dummy.switch_database(ingest_conn, "pico")
+    room_ids, tracker_ids, ingest_bluetooth_ids = e2e.create_devices(ingest_conn, 20, 2000)
+    messages = [("feeds/hardware-data/" + pico_id,
+                 json.dumps({"PicoID": pico_id, "RoomID": ingest_bluetooth_ids[random.choice(room_ids)],
+                             "PicoType": dummy.BT_TRACKER_PICO_TYPE, "Data": ""}))
+                for pico_id in (tracker_ids[i % len(tracker_ids)] for i in range(args.ingest_messages))]
+    since = e2e.db_now(ingest_conn)
+    publish_seconds, failed = e2e.publish(messages, 0, 0)
+    rows, wait_seconds = e2e.wait_for_rows(ingest_conn, since, args.ingest_messages - failed, 15)
+    ingest_conn.close()
+    metrics["ingest"] = {"messages": args.ingest_messages, "rows_stored": rows,
+                         "seconds": round(publish_seconds + wait_seconds, 3),
+                         "rows_per_second": round(rows / (publish_seconds + wait_seconds))}
+    print(f"ingest: {rows:,}/{args.ingest_messages:,} rows, {metrics['ingest']['rows_per_second']:,} rows/s")
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "dataset": {"tracker_rows": args.tracker_rows, "environment_rows": args.environment_rows,
+                    "rooms": args.rooms, "rules": args.rules, "messages": args.messages},
+        "metrics": metrics,
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = compare(results, json.load(f), args.tolerance)
+        for regression in results["regressions"]:
+            print(f"REGRESSION {regression['metric']}: {regression['baseline']} -> {regression['current']} "
+                  f"({regression['change']:+.0%})")
+        exit_code = 1 if results["regressions"] else 0
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,38 +2,32 @@
 import paho.mqtt.client as mqtt
 import os
 import json
-import mysql.connector
 from mysql.connector import Error
 from pydantic import BaseModel, ValidationError
-from typing import Union
-
-db_connection = None
-
-def get_db_connection():
-    global db_connection
-    if db_connection is None or not db_connection.is_connected():
-        try:
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-        except e:
-            print("Unknown error", e)
-    return db_connection
+from shared import metrics, log, db, telemetry, broker
+
+logger = log.setup("data_processor")
+# Messages are handled on the MQTT thread, so one pooled connection is enough. The statements
+# below run on it as server-side prepared statements and are retried on transient errors.
+database = db.Database("data_processor", pool_size=1)
+
+ENVIRONMENT_INSERT = ("INSERT INTO environment_sensor_data (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity) "
+                      "VALUES (%s, NOW(), %s, %s, %s, %s, %s, %s)")
+ROOM_LOOKUP = """SELECT picoID
+                 FROM pico_device
+                 WHERE bluetoothID = %s
+                 LIMIT 1;"""
+TRACKER_INSERT = """INSERT INTO bluetooth_tracker_data (picoID, roomID, logged_at)
+                    VALUES (%s, %s, NOW())"""
 
 #on connection or reconnection, subscribe to all hardware data feed
 # such that data from these feeds will be recieved by on_message
 def on_connect(client, user_data, connect_flags, result_code, properties):
-    print(f"Connected with result code {result_code}")
+    logger.info("Connected with result code %s", result_code)
 
     #subscribe to all hardware data feeds
     client.subscribe("feeds/hardware-data/#")
-    print("Subscribed to hardware feeds")
+    logger.info("Subscribed to hardware feeds")
 
 class PicoData(BaseModel):
     PicoID: str
@@ -41,105 +35,89 @@ class PicoData(BaseModel):
     PicoType: int
     Data: str
 
-#whenever a message is recieved from a feed, print it and its details
+#whenever a message is recieved from a feed, store it
 def on_message(client, user_data, message):
-    print(f'message from "{message.topic}":')
-    # print(str(message.payload))
+    logger.debug("message received", extra={"topic": message.topic, "sample": 0.01})
 
-    # Decode message into utf-8
-    payload_str = message.payload.decode("utf-8", errors="ignore")
-
-    # Make sure it is a json
-    try:
-        data = PicoData.parse_raw(payload_str)
-    except json.JSONDecodeError:
-        print("ERR: invalid json")
-        return
-    except ValidationError as e:
-        print("ERR: invalid structure", e)
-        return
-    except e:
-        print("Unknown error", e)
-        return
-
-    # Make sure there is SQL connection
-    db_connection = get_db_connection()
-    if db_connection is None:
-        print("ERR: No database connection, check the DB is up!")
-        return
-    cursor = db_connection.cursor()
+    # Devices that negotiated it send the compact binary format (see shared/telemetry.py)
+    if telemetry.is_binary(message.payload):
+        try:
+            pico_type, room_id, env_data = telemetry.decode(message.payload)
+        except ValueError as e:
+            logger.warning("invalid binary payload: %s", e, extra={"topic": message.topic})
+            return
+        pico_id = telemetry.pico_id(message.topic)
+    else:
+        # Decode message into utf-8
+        payload_str = message.payload.decode("utf-8", errors="ignore")
+
+        # Make sure it is a json
+        try:
+            data = PicoData.parse_raw(payload_str)
+        except json.JSONDecodeError:
+            logger.warning("invalid json", extra={"topic": message.topic})
+            return
+        except ValidationError as e:
+            logger.warning("invalid structure: %s", e, extra={"topic": message.topic})
+            return
+        except Exception:
+            logger.exception("Unknown error")
+            return
+        pico_id, room_id, pico_type = str(data.PicoID), data.RoomID, data.PicoType
+        # Variables are split into Sound, Light, and Temperature
+        env_data = data.Data.split(",") if pico_type == 1 else None
 
     # If it is a room sensor we do this
-    if data.PicoType == 1:
-        # Variables are split into Sound, Light, and Temperature
-        env_data = data.Data.split(",")
-        
+    if pico_type == 1:
         # Insert data into the database
         try:
-            cursor.execute(
-                "INSERT INTO environment_sensor_data (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity) "
-                "VALUES (%s, NOW(), %s, %s, %s, %s, %s, %s)",
-                (str(data.PicoID), env_data[0], env_data[1], env_data[2], env_data[3], env_data[4], env_data[5])
-            )
-            db_connection.commit()
+            database.execute(ENVIRONMENT_INSERT,
+                             (pico_id, env_data[0], env_data[1], env_data[2], env_data[3], env_data[4], env_data[5]))
         except Error as e:
-            db_connection.rollback()
-            print(f"Error inserting data into MySQL: {e}")
+            logger.error("Error inserting environment data into MySQL: %s", e, extra={"pico": pico_id})
         except:
-            print("Incorrect format")
+            logger.warning("Incorrect environment data format", extra={"pico": pico_id})
 
-    elif data.PicoType == 2:
+    elif pico_type == 2:
         # Otherwise just put the data in
         try:
-            select_query = """SELECT picoID
-                              FROM pico_device
-                              WHERE bluetoothID = %s
-                              LIMIT 1;"""
-            
-            cursor.execute(select_query, (data.RoomID,))
-            select_result = cursor.fetchone()
+            select_result = database.query_one(ROOM_LOOKUP, (room_id,))
             if not select_result is None:
                 room_pico_id = select_result[0]
-                query = """INSERT INTO bluetooth_tracker_data (picoID, roomID, logged_at)
-                           VALUES (%s, %s, NOW())"""
-                cursor.execute(query, (str(data.PicoID), str(room_pico_id)))
-                db_connection.commit()
+                database.execute(TRACKER_INSERT, (pico_id, str(room_pico_id)))
         except Error as e:
-            db_connection.rollback()
-            print(f"Error inserting data into MySQL: {e}")
-        except e:
-            print("unknown error", e)
-    
-    cursor.close()
+            logger.error("Error inserting tracker data into MySQL: %s", e, extra={"pico": pico_id})
+        except Exception:
+            logger.exception("Unknown error")
 
 #set up the client to recieve messages
 def main():
     #get the mqtt access from a local env folder
     # if this fails exit main
-    print("Getting access token")
     access_token = os.getenv("mqtt_token")
-    print(f"Access token: {access_token}")
-    get_db_connection()
+    database.connection()
 
     if not access_token:
-        print("Error: Token not found")
+        logger.error("Token not found")
         return
 
 
     #set up the mqtt client
-    print("Starting mqtt client")
+    logger.info("Starting mqtt client")
 
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     
     #set the mqtt client to handle connections and messages
     client.on_connect = on_connect
     client.on_message = on_message
+    metrics.instrument_mqtt_client(client)
+    metrics.serve_metrics("data_processor")
 
     #set the token to authorise the client
     client.username_pw_set(access_token, None)
 
     #connect
-    client.connect("mqtt.flespi.io", 1883)
+    broker.connect(client)
 
     client.loop_forever()
 
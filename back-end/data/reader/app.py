@@ -1,35 +1,52 @@
-from flask import Flask, request, jsonify, make_response
-import mysql.connector
-from mysql.connector import Error, pooling
+from flask import Flask, request, jsonify, make_response, Response, stream_with_context
+from mysql.connector import Error
 from datetime import datetime, timedelta
 import os
 import requests
 import time
 import re
+import sys
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import chain
 from flask_cors import CORS
+from streaming import (iter_rows, iter_batches, json_object, dumps, gzip_csv,
+                       movement_buckets, pico_session, average_buckets, bucket_label)
+from shared import metrics, log, db, responses
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "data_reader")
+logger = log.setup("data_reader")
 
 # -------------------------------
 # Database Connection Pool
 # -------------------------------
-connection_pool = pooling.MySQLConnectionPool(
-    pool_name="mypool",
-    pool_size=10,
-    pool_reset_session=True,
-    host=os.getenv('DB_HOST'),
-    user=os.getenv('DB_USER'),
-    password=os.getenv('DB_PASSWORD'),
-    database=os.getenv('DB_NAME')  # This should be "pico"
-)
+# Each request gets one pooled connection, returned when the request ends; streamed
+# responses check out their own so rows can stay on the server while they are sent.
+database = db.Database("data_reader")
+database.init_app(app)
 
 def get_db_connection():
-    try:
-        return connection_pool.get_connection()
-    except Error as e:
-        print(f"Error getting connection from pool: {e}")
-        return None
+    return database.connection()
+
+# -------------------------------
+# HTTP Caching and Compression
+# -------------------------------
+IMMUTABLE_GRACE = timedelta(minutes=5)  # late readings can still land just after a window closes
+IMMUTABLE_MAX_AGE = 31536000
+
+def cache_if_elapsed(response, end_dt, now):
+    """Windows that closed a while ago never change, so let the browser keep them."""
+    if end_dt.tzinfo is None and end_dt <= now - IMMUTABLE_GRACE:
+        response.cache_control.private = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+# Content-hash ETags with If-None-Match -> 304, then gzip if the client accepts it
+responses.init_app(app)
 
 # -------------------------------
 # Session Validation
@@ -38,12 +55,12 @@ def validate_session_cookie(request):
     VALIDATION_SITE = "http://account_login:5002/validate_cookie"
     cookie = request.cookies.get("session_id")
     if not cookie:
-        print("No session_id cookie found.")
+        logger.debug("No session_id cookie found")
         return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
-    print(f"Cookie found: {cookie}")
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
+    with metrics.span("validate_cookie"):
+        r = requests.get(VALIDATION_SITE, headers={"session-id": cookie, **metrics.trace_headers()})
     if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
+        logger.info("Invalid cookie detected")
         return {"error": "Invalid cookie"}, 401
     return None
 
@@ -55,18 +72,14 @@ def lookup_tracking_group(picoID):
     Given a MAC address (picoID), look up its current tracking group from the bluetooth_tracker table.
     Returns the groupName in lowercase if found, otherwise "unknown".
     """
-    conn = get_db_connection()
-    if conn is None:
-        return "unknown"
-    cursor = conn.cursor()
+    # Runs once per tracker in a response, so it is a prepared statement
     try:
-        cursor.execute("""
+        row = database.query_one("""
             SELECT tg.groupName
             FROM bluetooth_tracker bt
             LEFT JOIN tracking_groups tg ON bt.trackingGroupID = tg.groupID
             WHERE bt.picoID = %s
         """, (picoID,))
-        row = cursor.fetchone()
         if row is not None and row[0]:
             return row[0].lower()
         else:
@@ -74,9 +87,6 @@ def lookup_tracking_group(picoID):
     except Error as e:
         print("Error in lookup_tracking_group:", e)
         return "unknown"
-    finally:
-        cursor.close()
-        conn.close()
 
 # -------------------------------
 # Helper Functions for Type Mapping
@@ -139,6 +149,157 @@ def init_average_room():
         "humidity": occ_obj()
     }
 
+# -------------------------------
+# Snapshot Index for historical /summary?time= queries
+# -------------------------------
+SNAPSHOT_CHECKPOINT_SECONDS = 300  # one checkpoint every 5 minutes
+SNAPSHOT_PRESENCE_SECONDS = 60     # a tracker counts as present if seen in the last minute
+SNAPSHOT_MAX_BLOCKS = 288          # keep up to one day of checkpoint blocks in memory
+
+class SnapshotBlock:
+    """
+    One checkpoint and the delta log that follows it.
+    `checkpoint` holds the latest (roomID, logged_at) per tracker seen in the minute before `start`,
+    the delta log holds every tracker row in (start, start + SNAPSHOT_CHECKPOINT_SECONDS) in time order.
+    """
+    __slots__ = ("start", "checkpoint", "delta_times", "delta_rows")
+
+    def __init__(self, start, checkpoint, delta_times, delta_rows):
+        self.start = start
+        self.checkpoint = checkpoint
+        self.delta_times = delta_times
+        self.delta_rows = delta_rows
+
+    def state_at(self, snapshot_time):
+        """
+        Replays the delta log on top of the checkpoint up to snapshot_time.
+        Returns a list of (roomID, picoID) for trackers seen within the presence window.
+        """
+        state = dict(self.checkpoint)
+        end = bisect_right(self.delta_times, snapshot_time)
+        for i in range(end):
+            picoID, roomID = self.delta_rows[i]
+            state[picoID] = (roomID, self.delta_times[i])
+        cutoff = snapshot_time - timedelta(seconds=SNAPSHOT_PRESENCE_SECONDS)
+        return [(roomID, picoID) for picoID, (roomID, seen) in state.items() if seen >= cutoff]
+
+snapshot_blocks = OrderedDict()
+snapshot_lock = threading.Lock()
+
+def snapshot_block_start(snapshot_time):
+    seconds = int((snapshot_time - datetime.min).total_seconds())
+    return datetime.min + timedelta(seconds=seconds - seconds % SNAPSHOT_CHECKPOINT_SECONDS)
+
+def build_snapshot_block(cursor, start):
+    end = start + timedelta(seconds=SNAPSHOT_CHECKPOINT_SECONDS)
+    cursor.execute("""
+        SELECT picoID, roomID, logged_at
+        FROM bluetooth_tracker_data
+        WHERE logged_at >= %s AND logged_at <= %s
+        ORDER BY logged_at ASC, databaseID ASC
+    """, (start - timedelta(seconds=SNAPSHOT_PRESENCE_SECONDS), start))
+    checkpoint = {}
+    for row in cursor.fetchall():
+        checkpoint[row["picoID"]] = (str(row["roomID"]), row["logged_at"])
+
+    cursor.execute("""
+        SELECT picoID, roomID, logged_at
+        FROM bluetooth_tracker_data
+        WHERE logged_at > %s AND logged_at < %s
+        ORDER BY logged_at ASC, databaseID ASC
+    """, (start, end))
+    delta_times = []
+    delta_rows = []
+    for row in cursor.fetchall():
+        delta_times.append(row["logged_at"])
+        delta_rows.append((row["picoID"], str(row["roomID"])))
+    return SnapshotBlock(start, checkpoint, delta_times, delta_rows)
+
+def get_snapshot_occupancy(cursor, snapshot_time, now):
+    """
+    Returns the (roomID, picoID) rows present at snapshot_time, or None if the snapshot
+    falls in a block that hasn't fully elapsed yet (those are still being written to).
+    Elapsed blocks never change so they are cached and shared between requests.
+    """
+    if snapshot_time.tzinfo is not None:
+        return None
+    start = snapshot_block_start(snapshot_time)
+    if start + timedelta(seconds=SNAPSHOT_CHECKPOINT_SECONDS) > now:
+        return None
+
+    with snapshot_lock:
+        block = snapshot_blocks.get(start)
+        if block is not None:
+            snapshot_blocks.move_to_end(start)
+    if block is None:
+        block = build_snapshot_block(cursor, start)
+        with snapshot_lock:
+            snapshot_blocks[start] = block
+            while len(snapshot_blocks) > SNAPSHOT_MAX_BLOCKS:
+                snapshot_blocks.popitem(last=False)
+    return block.state_at(snapshot_time)
+
+# -------------------------------
+# Streaming Responses
+# -------------------------------
+def wants_stream(req_data=None):
+    value = request.args.get("stream") or (req_data or {}).get("stream")
+    return str(value).lower() in ("1", "true", "yes")
+
+def open_stream(query, params, dictionary=True):
+    """
+    Runs the query on its own pooled connection with an unbuffered cursor, so rows stay on
+    the server until the response generator reads them. Returns (conn, cursor).
+    """
+    conn = database.checkout()
+    cursor = conn.cursor(dictionary=dictionary)  # unbuffered by default
+    try:
+        cursor.execute(query, params)
+    except Error:
+        cursor.close()
+        conn.close()
+        raise
+    return conn, cursor
+
+def close_stream(conn, cursor):
+    """
+    Rows the response did not read (/pico stops at the first gap, or the client went away)
+    are not fetched just to be thrown away: the connection is dropped instead, and the pool
+    reconnects it on its next checkout.
+    """
+    raw = db.raw_connection(conn)
+    try:
+        if raw.unread_result:
+            raw.disconnect()
+        else:
+            cursor.close()
+    except Error as e:
+        print(f"Error closing stream: {e}")
+    finally:
+        conn.close()
+
+def stream_response(chunks, streams, mimetype="application/json", headers=None):
+    def generate():
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Error as e:
+            # Headers are already sent, so all we can do is stop writing
+            print(f"Error while streaming response: {e}")
+        finally:
+            for conn, cursor in streams:
+                close_stream(conn, cursor)
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+def memoized_tracker_type():
+    """map_tracker_type hits the DB, so look each tracker up once per response."""
+    types = {}
+    def tracker_type(picoID):
+        if picoID not in types:
+            types[picoID] = map_tracker_type(picoID)
+        return types[picoID]
+    return tracker_type
+
 # -------------------------------
 # /pico Endpoint
 # -------------------------------
@@ -174,7 +335,25 @@ def pico(PICO):
         if req_data and req_data.get("time"):
             provided_time = datetime.fromisoformat(req_data.get("time"))
         
-        if provided_time:
+        if provided_time and wants_stream(req_data):
+            stream = open_stream(f"""
+                SELECT roomID, logged_at
+                FROM {data_table}
+                WHERE picoID = %s AND logged_at >= %s
+                ORDER BY logged_at ASC;
+            """, (PICO, provided_time))
+            rows = iter_rows(stream[1])
+            first = next(rows, None)
+            if first is None:
+                close_stream(*stream)
+                return jsonify({"error": "No logs found for the specified Pico"}), 404
+
+            def pico_chunks():
+                yield '{"movement":'
+                yield from json_object(pico_session(chain([first], rows)))
+                yield ',"type":' + dumps(device_label) + '}'
+            return stream_response(pico_chunks(), [stream])
+        elif provided_time:
             query = f"""
                 SELECT roomID, logged_at
                 FROM {data_table}
@@ -246,6 +425,21 @@ def pico(PICO):
 # -------------------------------
 # /summary Endpoint
 # -------------------------------
+def fetch_live_occupancy(snapshot_time):
+    # The latest-state queries behind /summary polling run as prepared statements
+    occ_query = """
+        SELECT t.roomID, t.picoID
+        FROM bluetooth_tracker_data t
+        JOIN (
+            SELECT picoID, MAX(logged_at) AS max_time
+            FROM bluetooth_tracker_data
+            WHERE logged_at <= %s AND logged_at >= (%s - INTERVAL 1 MINUTE)
+            GROUP BY picoID
+        ) latest ON t.picoID = latest.picoID AND t.logged_at = latest.max_time
+    """
+    rows = database.query(occ_query, (snapshot_time, snapshot_time), dictionary=True)
+    return [(row["roomID"], row["picoID"]) for row in rows]
+
 @app.route('/summary', methods=['GET'])
 def summary():
     cookie_validation_error = validate_session_cookie(request)
@@ -272,22 +466,15 @@ def summary():
     try:
         # 1) Occupancy Data from bluetooth_tracker_data (only if mode == "all" or "picos")
         if mode in ("all", "picos"):
-            occ_query = """
-                SELECT t.roomID, t.picoID
-                FROM bluetooth_tracker_data t
-                JOIN (
-                    SELECT picoID, MAX(logged_at) AS max_time
-                    FROM bluetooth_tracker_data
-                    WHERE logged_at <= %s AND logged_at >= (%s - INTERVAL 1 MINUTE)
-                    GROUP BY picoID
-                ) latest ON t.picoID = latest.picoID AND t.logged_at = latest.max_time
-            """
-            cursor.execute(occ_query, (snapshot_time, snapshot_time))
-            occ_rows = cursor.fetchall()
+            occ_rows = None
+            if time_str:
+                occ_rows = get_snapshot_occupancy(cursor, snapshot_time, now)
+            if occ_rows is None:
+                occ_rows = fetch_live_occupancy(snapshot_time)
 
-            for row in occ_rows:
-                room_id = str(row["roomID"])
-                tracker_type = map_tracker_type(row["picoID"])  # e.g. "users", "staff", "guard", etc.
+            for room_id, picoID in occ_rows:
+                room_id = str(room_id)
+                tracker_type = map_tracker_type(picoID)  # e.g. "users", "staff", "guard", etc.
                 if tracker_type == "unknown":
                     continue  # skip unrecognized trackers
 
@@ -303,7 +490,7 @@ def summary():
 
                 # Increment the count and add the picoID
                 summary_data[room_id][tracker_type]["count"] += 1
-                summary_data[room_id][tracker_type]["id"].append(row["picoID"])
+                summary_data[room_id][tracker_type]["id"].append(picoID)
 
         # 2) Environment Data from environment_sensor_data (only if mode == "all" or "environment")
         if mode in ("all", "environment"):
@@ -318,8 +505,7 @@ def summary():
                     GROUP BY picoID
                 ) latest ON e.picoID = latest.picoID AND e.logged_at = latest.latest_time
             """
-            cursor.execute(env_query, (snapshot_time, snapshot_time))
-            env_rows = cursor.fetchall()
+            env_rows = database.query(env_query, (snapshot_time, snapshot_time), dictionary=True)
 
             for row in env_rows:
                 room_id = str(row["roomID"])
@@ -346,7 +532,10 @@ def summary():
             if "environment" not in summary_data[room_id]:
                 summary_data[room_id]["environment"] = {}
 
-        return jsonify(summary_data)
+        response = jsonify(summary_data)
+        if time_str:
+            cache_if_elapsed(response, snapshot_time, now)
+        return response
     except Error as e:
         print(f"Error in /summary: {e}")
         return jsonify({"error": "Error querying data", "message": str(e)}), 500
@@ -372,6 +561,268 @@ def parse_period(period_str):
         raise ValueError("Maximum grouping period is 1 week")
     return total_seconds
 
+def build_average_env_query(period_seconds, start_dt, end_dt, rooms):
+    env_query = """
+    SELECT 
+        e.picoID as roomID,
+        FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(logged_at)/%s)*%s) as bucket,
+        AVG(temperature) as avg_temperature, MAX(temperature) as peak_temperature, MIN(temperature) as trough_temperature,
+        AVG(sound) as avg_sound, MAX(sound) as peak_sound, MIN(sound) as trough_sound,
+        AVG(light) as avg_light, MAX(light) as peak_light, MIN(light) as trough_light,
+        AVG(IAQ) as avg_IAQ, MAX(IAQ) as peak_IAQ, MIN(IAQ) as trough_IAQ,
+        AVG(pressure) as avg_pressure, MAX(pressure) as peak_pressure, MIN(pressure) as trough_pressure,
+        AVG(humidity) as avg_humidity, MAX(humidity) as peak_humidity, MIN(humidity) as trough_humidity
+    FROM environment_sensor_data e
+    WHERE logged_at BETWEEN %s AND %s
+    """
+    env_params = [period_seconds, period_seconds, start_dt, end_dt]
+    if rooms:
+        env_query += " AND e.picoID IN (" + ",".join(["%s"] * len(rooms)) + ")"
+        env_params.extend(rooms)
+    env_query += " GROUP BY e.picoID, bucket ORDER BY bucket ASC;"
+    return env_query, env_params
+
+def build_average_occ_query(period_seconds, start_dt, end_dt, rooms):
+    occ_query = """
+        SELECT 
+            roomID,
+            picoID,
+            FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(logged_at)/%s)*%s) as bucket
+        FROM bluetooth_tracker_data
+        WHERE logged_at BETWEEN %s AND %s
+    """
+    occ_params = [period_seconds, period_seconds, start_dt, end_dt]
+    if rooms:
+        occ_query += " AND roomID IN (" + ",".join(["%s"] * len(rooms)) + ")"
+        occ_params.extend(rooms)
+    occ_query += " ORDER BY logged_at ASC;"
+    return occ_query, occ_params
+
+def compute_average(cursor, period_seconds, start_dt, end_dt, rooms, tracker_type):
+    """Runs the aggregate queries, returns {bucket: {roomID: metrics}} keyed by the raw bucket start."""
+    average_summary = {}
+    # 1) Environment: Aggregate by environment_sensor_data grouped by picoID (as roomID) and time bucket.
+    env_query, env_params = build_average_env_query(period_seconds, start_dt, end_dt, rooms)
+    cursor.execute(env_query, env_params)
+    env_results = cursor.fetchall()
+    for row in env_results:
+        bucket = row["bucket"]
+        room_id = str(row["roomID"])
+        if bucket not in average_summary:
+            average_summary[bucket] = {}
+        if room_id not in average_summary[bucket]:
+            average_summary[bucket][room_id] = init_average_room()
+        average_summary[bucket][room_id]["temperature"] = {
+            "average": row["avg_temperature"],
+            "peak": row["peak_temperature"],
+            "trough": row["trough_temperature"]
+        }
+        average_summary[bucket][room_id]["sound"] = {
+            "average": row["avg_sound"],
+            "peak": row["peak_sound"],
+            "trough": row["trough_sound"]
+        }
+        average_summary[bucket][room_id]["light"] = {
+            "average": row["avg_light"],
+            "peak": row["peak_light"],
+            "trough": row["trough_light"]
+        }
+        average_summary[bucket][room_id]["IAQ"] = {
+            "average": row["avg_IAQ"],
+            "peak": row["peak_IAQ"],
+            "trough": row["trough_IAQ"]
+        }
+        average_summary[bucket][room_id]["pressure"] = {
+            "average": row["avg_pressure"],
+            "peak": row["peak_pressure"],
+            "trough": row["trough_pressure"]
+        }
+        average_summary[bucket][room_id]["humidity"] = {
+            "average": row["avg_humidity"],
+            "peak": row["peak_humidity"],
+            "trough": row["trough_humidity"]
+        }
+
+    # 2) Occupancy: Aggregate counts from bluetooth_tracker_data grouped by roomID, time bucket, and tracker type.
+    occ_query, occ_params = build_average_occ_query(period_seconds, start_dt, end_dt, rooms)
+    cursor.execute(occ_query, occ_params)
+    occ_rows = cursor.fetchall()
+    occupant_counts = {}
+    for row in occ_rows:
+        bucket = row["bucket"]
+        room_id = str(row["roomID"])
+        tracker = tracker_type(row["picoID"])
+        if tracker == "unknown":
+            continue
+        key = (bucket, room_id, tracker)
+        occupant_counts[key] = occupant_counts.get(key, 0) + 1
+
+    for (bucket, room_id, tracker), count in occupant_counts.items():
+        if bucket not in average_summary:
+            average_summary[bucket] = {}
+        if room_id not in average_summary[bucket]:
+            average_summary[bucket][room_id] = init_average_room()
+        average_summary[bucket][room_id][tracker] = {
+            "average": count,
+            "peak": count,
+            "trough": count
+        }
+
+    # Ensure every bucket/room has all keys.
+    for bucket_key, rooms_dict in average_summary.items():
+        for room_key, data_dict in rooms_dict.items():
+            for t in ["users", "luggage", "staff", "guard"]:
+                if t not in data_dict:
+                    data_dict[t] = {"average": 0, "peak": 0, "trough": 0}
+            for env_var in ["temperature", "sound", "light", "IAQ", "pressure", "humidity"]:
+                if env_var not in data_dict:
+                    data_dict[env_var] = {"average": 0, "peak": 0, "trough": 0}
+    return average_summary
+
+# -------------------------------
+# Average Result Cache for /summary/average
+# -------------------------------
+AVERAGE_CACHE_MAX_BYTES = int(os.getenv("AVERAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+AVERAGE_CACHE_MAX_BUCKETS = 10000  # larger windows are computed directly rather than walked bucket by bucket
+ALL_ROOMS = "*"
+EPOCH = datetime(1970, 1, 1)
+
+def approx_size(value):
+    """Rough deep size of the nested dicts/tuples held in the cache."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (tuple, list)):
+        size += sum(approx_size(v) for v in value)
+    return size
+
+class AverageCache:
+    """
+    LRU cache of computed /summary/average blocks keyed by (roomID, bucket_start, period_seconds).
+    A value of None records that the room had no data in that bucket. For requests without a room
+    filter, (ALL_ROOMS, bucket_start, period_seconds) holds the tuple of rooms present in the bucket.
+    Only buckets that have fully elapsed are stored, so entries never need invalidating.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def cacheable(self, period_seconds, start_dt, end_dt):
+        # Buckets are floored on unix time in the DB session timezone; periods dividing an hour
+        # line up with naive local buckets for any whole hour UTC offset.
+        if start_dt.tzinfo is not None or end_dt.tzinfo is not None:
+            return False
+        if 3600 % period_seconds != 0:
+            return False
+        return (end_dt - start_dt).total_seconds() / period_seconds <= AVERAGE_CACHE_MAX_BUCKETS
+
+    def lookup(self, bucket, period_seconds, rooms):
+        """Returns {roomID: block} for the bucket, or None if any part of it is missing."""
+        with self.lock:
+            present = self.entries.get((ALL_ROOMS, bucket, period_seconds))
+            wanted = rooms if rooms else present
+            if wanted is None:
+                self.misses += 1
+                return None
+            result = {}
+            for room_id in wanted:
+                key = (room_id, bucket, period_seconds)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    if self.entries[key] is not None:
+                        result[room_id] = self.entries[key]
+                elif present is None or room_id in present:
+                    self.misses += 1
+                    return None
+            self.hits += 1
+            return result
+
+    def store(self, bucket, period_seconds, rooms, rooms_dict):
+        with self.lock:
+            if rooms:
+                for room_id in rooms:
+                    self._put((room_id, bucket, period_seconds), rooms_dict.get(room_id))
+            else:
+                for room_id, block in rooms_dict.items():
+                    self._put((room_id, bucket, period_seconds), block)
+                self._put((ALL_ROOMS, bucket, period_seconds), tuple(rooms_dict))
+            while self.bytes > self.max_bytes and self.entries:
+                key, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(key)
+                self.evictions += 1
+
+    def _put(self, key, value):
+        if key in self.entries:
+            self.bytes -= self.sizes[key]
+        size = approx_size(key) + approx_size(value)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.sizes[key] = size
+        self.bytes += size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+average_cache = AverageCache(AVERAGE_CACHE_MAX_BYTES)
+
+def bucket_floor(dt, period_seconds):
+    offset = int((dt - EPOCH).total_seconds()) // period_seconds * period_seconds
+    return EPOCH + timedelta(seconds=offset)
+
+def cached_average(cursor, period_seconds, start_dt, end_dt, rooms, now):
+    """
+    compute_average, but buckets lying fully inside the window that have already elapsed are
+    served from average_cache. The remaining buckets are queried in contiguous spans.
+    """
+    rooms = [str(room) for room in rooms] if rooms else []
+    period = timedelta(seconds=period_seconds)
+    settled = now - IMMUTABLE_GRACE
+    average_summary = {}
+    spans = []
+    bucket = bucket_floor(start_dt, period_seconds)
+    while bucket <= end_dt:
+        cacheable = bucket >= start_dt and bucket + period <= min(end_dt, settled)
+        cached = average_cache.lookup(bucket, period_seconds, rooms) if cacheable else None
+        if cached is not None:
+            if cached:
+                average_summary[bucket] = cached
+        elif spans and spans[-1][1] == bucket:
+            spans[-1][1] = bucket + period
+        else:
+            spans.append([bucket, bucket + period])
+        bucket += period
+
+    tracker_type = memoized_tracker_type()
+    for span_start, span_end in spans:
+        computed = compute_average(cursor, period_seconds, max(start_dt, span_start),
+                                   min(end_dt, span_end - timedelta(microseconds=1)), rooms, tracker_type)
+        bucket = span_start
+        while bucket < span_end:
+            rooms_dict = computed.get(bucket, {})
+            if rooms_dict:
+                average_summary[bucket] = rooms_dict
+            if bucket >= start_dt and bucket + period <= min(end_dt, settled):
+                average_cache.store(bucket, period_seconds, rooms, rooms_dict)
+            bucket += period
+    return average_summary
+
 @app.route('/summary/average', methods=['GET'])
 def summary_average():
     cookie_validation_error = validate_session_cookie(request)
@@ -403,120 +854,31 @@ def summary_average():
     if start_dt >= end_dt:
         return jsonify({"error": "start_time must be before end_time"}), 400
 
+    if wants_stream(req_data):
+        streams = []
+        try:
+            streams.append(open_stream(*build_average_env_query(period_seconds, start_dt, end_dt, rooms)))
+            streams.append(open_stream(*build_average_occ_query(period_seconds, start_dt, end_dt, rooms)))
+        except Error as e:
+            for stream in streams:
+                close_stream(*stream)
+            print(f"Error in /summary/average: {e}")
+            return jsonify({"error": "Error querying data", "message": str(e)}), 500
+        pairs = average_buckets(iter_rows(streams[0][1]), iter_rows(streams[1][1]),
+                                memoized_tracker_type(), init_average_room)
+        return cache_if_elapsed(stream_response(json_object(pairs), streams), end_dt, now)
+
     conn = get_db_connection()
     if conn is None:
         return jsonify({"error": "MySQL connection unavailable"}), 500
     cursor = conn.cursor(dictionary=True)
-    average_summary = {}
     try:
-        # 1) Environment: Aggregate by environment_sensor_data grouped by picoID (as roomID) and time bucket.
-        env_query = """
-        SELECT 
-            e.picoID as roomID,
-            FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(logged_at)/%s)*%s) as bucket,
-            AVG(temperature) as avg_temperature, MAX(temperature) as peak_temperature, MIN(temperature) as trough_temperature,
-            AVG(sound) as avg_sound, MAX(sound) as peak_sound, MIN(sound) as trough_sound,
-            AVG(light) as avg_light, MAX(light) as peak_light, MIN(light) as trough_light,
-            AVG(IAQ) as avg_IAQ, MAX(IAQ) as peak_IAQ, MIN(IAQ) as trough_IAQ,
-            AVG(pressure) as avg_pressure, MAX(pressure) as peak_pressure, MIN(pressure) as trough_pressure,
-            AVG(humidity) as avg_humidity, MAX(humidity) as peak_humidity, MIN(humidity) as trough_humidity
-        FROM environment_sensor_data e
-        WHERE logged_at BETWEEN %s AND %s
-        """
-        env_params = [period_seconds, period_seconds, start_dt, end_dt]
-        if rooms:
-            env_query += " AND e.picoID IN (" + ",".join(["%s"] * len(rooms)) + ")"
-            env_params.extend(rooms)
-        env_query += " GROUP BY e.picoID, bucket ORDER BY bucket ASC;"
-        cursor.execute(env_query, env_params)
-        env_results = cursor.fetchall()
-        for row in env_results:
-            bucket = row["bucket"]
-            bucket = bucket.isoformat() + "Z" if isinstance(bucket, datetime) else str(bucket)
-            room_id = str(row["roomID"])
-            if bucket not in average_summary:
-                average_summary[bucket] = {}
-            if room_id not in average_summary[bucket]:
-                average_summary[bucket][room_id] = init_average_room()
-            average_summary[bucket][room_id]["temperature"] = {
-                "average": row["avg_temperature"],
-                "peak": row["peak_temperature"],
-                "trough": row["trough_temperature"]
-            }
-            average_summary[bucket][room_id]["sound"] = {
-                "average": row["avg_sound"],
-                "peak": row["peak_sound"],
-                "trough": row["trough_sound"]
-            }
-            average_summary[bucket][room_id]["light"] = {
-                "average": row["avg_light"],
-                "peak": row["peak_light"],
-                "trough": row["trough_light"]
-            }
-            average_summary[bucket][room_id]["IAQ"] = {
-                "average": row["avg_IAQ"],
-                "peak": row["peak_IAQ"],
-                "trough": row["trough_IAQ"]
-            }
-            average_summary[bucket][room_id]["pressure"] = {
-                "average": row["avg_pressure"],
-                "peak": row["peak_pressure"],
-                "trough": row["trough_pressure"]
-            }
-            average_summary[bucket][room_id]["humidity"] = {
-                "average": row["avg_humidity"],
-                "peak": row["peak_humidity"],
-                "trough": row["trough_humidity"]
-            }
-
-        # 2) Occupancy: Aggregate counts from bluetooth_tracker_data grouped by roomID, time bucket, and tracker type.
-        occ_query = """
-            SELECT 
-                roomID,
-                picoID,
-                FROM_UNIXTIME(FLOOR(UNIX_TIMESTAMP(logged_at)/%s)*%s) as bucket
-            FROM bluetooth_tracker_data
-            WHERE logged_at BETWEEN %s AND %s
-        """
-        occ_params = [period_seconds, period_seconds, start_dt, end_dt]
-        if rooms:
-            occ_query += " AND roomID IN (" + ",".join(["%s"] * len(rooms)) + ")"
-            occ_params.extend(rooms)
-        occ_query += " ORDER BY logged_at ASC;"
-        cursor.execute(occ_query, occ_params)
-        occ_rows = cursor.fetchall()
-        occupant_counts = {}
-        for row in occ_rows:
-            bucket = row["bucket"]
-            bucket = bucket.isoformat() + "Z" if isinstance(bucket, datetime) else str(bucket)
-            room_id = str(row["roomID"])
-            tracker = map_tracker_type(row["picoID"])
-            if tracker == "unknown":
-                continue
-            key = (bucket, room_id, tracker)
-            occupant_counts[key] = occupant_counts.get(key, 0) + 1
-
-        for (bucket, room_id, tracker), count in occupant_counts.items():
-            if bucket not in average_summary:
-                average_summary[bucket] = {}
-            if room_id not in average_summary[bucket]:
-                average_summary[bucket][room_id] = init_average_room()
-            average_summary[bucket][room_id][tracker] = {
-                "average": count,
-                "peak": count,
-                "trough": count
-            }
-
-        # Ensure every bucket/room has all keys.
-        for bucket_key, rooms_dict in average_summary.items():
-            for room_key, data_dict in rooms_dict.items():
-                for t in ["users", "luggage", "staff", "guard"]:
-                    if t not in data_dict:
-                        data_dict[t] = {"average": 0, "peak": 0, "trough": 0}
-                for env_var in ["temperature", "sound", "light", "IAQ", "pressure", "humidity"]:
-                    if env_var not in data_dict:
-                        data_dict[env_var] = {"average": 0, "peak": 0, "trough": 0}
-        return jsonify(average_summary)
+        if average_cache.cacheable(period_seconds, start_dt, end_dt):
+            average_summary = cached_average(cursor, period_seconds, start_dt, end_dt, rooms, now)
+        else:
+            average_summary = compute_average(cursor, period_seconds, start_dt, end_dt, rooms, memoized_tracker_type())
+        average_summary = {bucket_label(bucket): rooms_dict for bucket, rooms_dict in sorted(average_summary.items())}
+        return cache_if_elapsed(jsonify(average_summary), end_dt, now)
     except Error as e:
         print(f"Error in /summary/average: {e}")
         return jsonify({"error": "Error querying data", "message": str(e)}), 500
@@ -524,6 +886,13 @@ def summary_average():
         cursor.close()
         conn.close()
 
+@app.route('/summary/average/cache', methods=['GET'])
+def summary_average_cache():
+    cookie_validation_error = validate_session_cookie(request)
+    if cookie_validation_error:
+        return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
+    return jsonify(average_cache.stats()), 200
+
 # -------------------------------
 # /movement Endpoint
 # -------------------------------
@@ -551,6 +920,22 @@ def movement():
     time_start = time_start.replace(second=0, microsecond=0)
     time_end = time_end.replace(second=0, microsecond=0)
 
+    if wants_stream():
+        # One ordered pass over the range instead of a query per minute bucket
+        try:
+            stream = open_stream("""
+                SELECT roomID, picoID,
+                       DATE_FORMAT(logged_at, '%%Y-%%m-%%dT%%H:%%i:00Z') as bucket
+                FROM bluetooth_tracker_data
+                WHERE logged_at >= %s AND logged_at < %s
+                ORDER BY logged_at ASC;
+            """, (time_start, time_end + timedelta(minutes=1)))
+        except Error as e:
+            print(f"Error in /movement: {e}")
+            return jsonify({"error": "Error querying movement data", "message": str(e)}), 500
+        pairs = movement_buckets(iter_rows(stream[1]), memoized_tracker_type())
+        return cache_if_elapsed(stream_response(json_object(pairs), [stream]), time_end, now)
+
     buckets = []
     current_bucket = time_start
     while current_bucket <= time_end:
@@ -585,7 +970,7 @@ def movement():
                 bucket_key = bucket.isoformat() + "Z"
                 movement_summary[bucket_key] = bucket_data
 
-        return jsonify(movement_summary)
+        return cache_if_elapsed(jsonify(movement_summary), time_end, now)
     except Error as e:
         print(f"Error in /movement: {e}")
         return jsonify({"error": "Error querying movement data", "message": str(e)}), 500
@@ -593,6 +978,67 @@ def movement():
         cursor.close()
         conn.close()
 
+# -------------------------------
+# /export Endpoint
+# -------------------------------
+# table -> (SQL table, exported columns, column used for the rooms filter)
+EXPORT_TABLES = {
+    "environment": ("environment_sensor_data",
+                    ["picoID", "logged_at", "temperature", "sound", "light", "IAQ", "pressure", "humidity"],
+                    "picoID"),
+    "tracker": ("bluetooth_tracker_data", ["picoID", "roomID", "logged_at"], "roomID"),
+}
+
+@app.route('/export', methods=['GET'])
+def export():
+    cookie_validation_error = validate_session_cookie(request)
+    if cookie_validation_error:
+        return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
+
+    table_key = request.args.get("table", "environment")
+    if table_key not in EXPORT_TABLES:
+        return jsonify({"error": "Invalid table parameter", "message": "Use one of: " + ", ".join(EXPORT_TABLES)}), 400
+    table, columns, room_column = EXPORT_TABLES[table_key]
+
+    now = datetime.utcnow()
+    start_time_str = request.args.get("start_time")
+    end_time_str = request.args.get("end_time")
+    try:
+        start_dt = datetime.fromisoformat(start_time_str.replace("Z", "")) if start_time_str else now - timedelta(hours=24)
+    except ValueError:
+        return jsonify({"error": "Invalid start_time format"}), 400
+    try:
+        end_dt = datetime.fromisoformat(end_time_str.replace("Z", "")) if end_time_str else now
+    except ValueError:
+        return jsonify({"error": "Invalid end_time format"}), 400
+    if start_dt >= end_dt:
+        return jsonify({"error": "start_time must be before end_time"}), 400
+
+    query = "SELECT " + ", ".join(f"`{c}`" for c in columns) + f" FROM {table} WHERE logged_at BETWEEN %s AND %s"
+    params = [start_dt, end_dt]
+    rooms = request.args.getlist("rooms")
+    if rooms:
+        query += f" AND {room_column} IN (" + ",".join(["%s"] * len(rooms)) + ")"
+        params.extend(rooms)
+    picos = request.args.getlist("picos")
+    if picos:
+        query += " AND picoID IN (" + ",".join(["%s"] * len(picos)) + ")"
+        params.extend(picos)
+    query += " ORDER BY logged_at ASC;"
+
+    try:
+        stream = open_stream(query, params, dictionary=False)
+    except Error as e:
+        print(f"Error in /export: {e}")
+        return jsonify({"error": "Error querying data", "message": str(e)}), 500
+
+    filename = f"{table_key}_{start_dt:%Y%m%dT%H%M%S}_{end_dt:%Y%m%dT%H%M%S}.csv.gz"
+    return stream_response(
+        gzip_csv(columns, iter_batches(stream[1])), [stream],
+        mimetype="application/gzip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 if __name__ == '__main__':
-    get_db_connection()  # Warm up connection
+    database.pool()  # Warm up the pool
     app.run(host='0.0.0.0', port=5003)
\ No newline at end of file
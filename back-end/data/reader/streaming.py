@@ -0,0 +1,164 @@
+"""
+Incremental JSON and CSV writers for the reader's large responses.
+
+Rows are pulled from an unbuffered (server-side) cursor in small batches and grouped
+per time bucket, so only one bucket is held in memory at a time regardless of the
+requested range. The output keeps the same schema as the buffered jsonify responses.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timedelta
+
+FETCH_BATCH_SIZE = 500
+
+def dumps(value):
+    # Matches the jsonify output closely enough for the reader's payloads (Decimal -> str)
+    return json.dumps(value, default=str, sort_keys=True, separators=(",", ":"))
+
+def iter_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    """Yields lists of rows from an unbuffered cursor without ever fetching the whole result set."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+def iter_rows(cursor, batch_size=FETCH_BATCH_SIZE):
+    for rows in iter_batches(cursor, batch_size):
+        for row in rows:
+            yield row
+
+def json_object(pairs):
+    """Writes a JSON object piece by piece from an iterable of (key, value) pairs."""
+    yield "{"
+    first = True
+    for key, value in pairs:
+        if not first:
+            yield ","
+        first = False
+        yield json.dumps(str(key)) + ":" + dumps(value)
+    yield "}"
+
+def gzip_csv(columns, batches, level=6):
+    """Writes a gzip compressed CSV one batch of rows at a time."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row]
+            for row in rows
+        )
+        chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0)
+        buffer.truncate()
+        if chunk:
+            yield chunk
+    yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+def bucket_label(bucket):
+    return bucket.isoformat() + "Z" if isinstance(bucket, datetime) else str(bucket)
+
+def group_by_bucket(rows):
+    """Groups consecutive rows sharing the same `bucket` column; rows must be ordered by bucket."""
+    current = None
+    group = []
+    for row in rows:
+        if group and row["bucket"] != current:
+            yield current, group
+            group = []
+        current = row["bucket"]
+        group.append(row)
+    if group:
+        yield current, group
+
+# -------------------------------
+# /movement
+# -------------------------------
+def movement_buckets(rows, tracker_type):
+    """(bucket, {roomID: {picoID: type}}) per minute, rows ordered by logged_at."""
+    for bucket, group in group_by_bucket(rows):
+        bucket_data = {}
+        for row in group:
+            room_id = str(row["roomID"])
+            if room_id not in bucket_data:
+                bucket_data[room_id] = {}
+            bucket_data[room_id][row["picoID"]] = tracker_type(row["picoID"])
+        yield bucket, bucket_data
+
+# -------------------------------
+# /pico
+# -------------------------------
+def pico_session(rows, gap=timedelta(seconds=90)):
+    """(isoformat time, roomID) for the contiguous session starting at the first row."""
+    previous = None
+    for row in rows:
+        logged_at = row["logged_at"]
+        if not hasattr(logged_at, "isoformat"):
+            logged_at = datetime.strptime(logged_at, "%Y-%m-%d %H:%M:%S")
+        if previous is not None and logged_at - previous > gap:
+            return
+        previous = logged_at
+        yield logged_at.isoformat(), row["roomID"]
+
+# -------------------------------
+# /summary/average
+# -------------------------------
+ENV_VARIABLES = ["temperature", "sound", "light", "IAQ", "pressure", "humidity"]
+OCCUPANCY_TYPES = ["users", "luggage", "staff", "guard"]
+
+def average_bucket(env_rows, occ_rows, tracker_type, new_room):
+    rooms = {}
+    for row in env_rows:
+        room_id = str(row["roomID"])
+        if room_id not in rooms:
+            rooms[room_id] = new_room()
+        for var in ENV_VARIABLES:
+            rooms[room_id][var] = {
+                "average": row["avg_" + var],
+                "peak": row["peak_" + var],
+                "trough": row["trough_" + var]
+            }
+
+    occupant_counts = {}
+    for row in occ_rows:
+        tracker = tracker_type(row["picoID"])
+        if tracker == "unknown":
+            continue
+        key = (str(row["roomID"]), tracker)
+        occupant_counts[key] = occupant_counts.get(key, 0) + 1
+    for (room_id, tracker), count in occupant_counts.items():
+        if room_id not in rooms:
+            rooms[room_id] = new_room()
+        rooms[room_id][tracker] = {"average": count, "peak": count, "trough": count}
+
+    for data_dict in rooms.values():
+        for key in OCCUPANCY_TYPES + ENV_VARIABLES:
+            if key not in data_dict:
+                data_dict[key] = {"average": 0, "peak": 0, "trough": 0}
+    return rooms
+
+def average_buckets(env_rows, occ_rows, tracker_type, new_room):
+    """
+    Merges the environment aggregate rows and the raw occupancy rows, both ordered by bucket,
+    into (bucket label, {roomID: metrics}) pairs.
+    """
+    env_groups = group_by_bucket(env_rows)
+    occ_groups = group_by_bucket(occ_rows)
+    env = next(env_groups, None)
+    occ = next(occ_groups, None)
+    while env is not None or occ is not None:
+        if occ is None or (env is not None and env[0] < occ[0]):
+            bucket, env_part, occ_part = env[0], env[1], []
+            env = next(env_groups, None)
+        elif env is None or occ[0] < env[0]:
+            bucket, env_part, occ_part = occ[0], [], occ[1]
+            occ = next(occ_groups, None)
+        else:
+            bucket, env_part, occ_part = env[0], env[1], occ[1]
+            env = next(env_groups, None)
+            occ = next(occ_groups, None)
+        yield bucket_label(bucket), average_bucket(env_part, occ_part, tracker_type, new_room)
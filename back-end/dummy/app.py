@@ -5,13 +5,19 @@ import random
 import hashlib
 from datetime import datetime, timedelta
 import bcrypt
-import base64
+import mimetypes
 import time
+import argparse
+import csv
+import json
+import math
+import tempfile
+from shared import broker
 
 # -------------------------------
 # Database connection helper
 # -------------------------------
-def get_connection():
+def get_connection(allow_local_infile=False):
     host = os.getenv("DB_HOST", "mysql")
     user = os.getenv("DB_USER", "dummy")
     password = os.getenv("DB_PASSWORD", "dummy")
@@ -21,7 +27,8 @@ def get_connection():
             host=host,
             user=user,
             password=password,
-            database=database
+            database=database,
+            allow_local_infile=allow_local_infile
         )
         if connection.is_connected():
             print("Connected to DB")
@@ -49,8 +56,9 @@ def generate_password(string):
 def create_account(conn, full_name, authority, raw_password, email):
     cursor = conn.cursor()
     pass_hash = generate_password(raw_password)
-    sql = "INSERT INTO users (full_name, authority, pass_hash, email) VALUES (%s, %s, %s, %s)"
-    cursor.execute(sql, (full_name, authority, pass_hash, email))
+    pass_cost = int(pass_hash.split('$')[2])
+    sql = "INSERT INTO users (full_name, authority, pass_hash, pass_cost, email) VALUES (%s, %s, %s, %s, %s)"
+    cursor.execute(sql, (full_name, authority, pass_hash, pass_cost, email))
     account_id = cursor.lastrowid
     conn.commit()
     cursor.close()
@@ -58,9 +66,11 @@ def create_account(conn, full_name, authority, raw_password, email):
 
 def create_preset(conn, preset_name, owner_id=None, image_name=None, image_data=None):
     cursor = conn.cursor()
-    sql = """INSERT INTO presets (preset_name, owner_id, image_name, image_data)
-             VALUES (%s, %s, %s, %s)"""
-    cursor.execute(sql, (preset_name, owner_id, image_name, image_data))
+    image_hash = hashlib.sha256(image_data).hexdigest() if image_data else None
+    image_type = mimetypes.guess_type(image_name)[0] if image_data and image_name else None
+    sql = """INSERT INTO presets (preset_name, owner_id, image_name, image_type, image_hash, image_data)
+             VALUES (%s, %s, %s, %s, %s, %s)"""
+    cursor.execute(sql, (preset_name, owner_id, image_name, image_type, image_hash, image_data))
     preset_id = cursor.lastrowid
     conn.commit()
     cursor.close()
@@ -76,16 +86,75 @@ def create_map_block(conn, preset_id, roomID, top, left, width, height, colour,
     cursor.close()
     return block_id
 
-# -------------------------------
-# Helper to generate a random MAC address.
-# -------------------------------
-def generate_mac_address():
-    mac = [random.randint(0x00, 0xFF) for _ in range(6)]
-    return ':'.join(f"{x:02X}" for x in mac)
+def read_image(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read()
+
+def set_default_preset(conn, preset_id):
+    cursor = conn.cursor()
+    sql = "UPDATE default_preset SET preset_id = %s WHERE id = 1"
+    cursor.execute(sql, (preset_id,))
+    conn.commit()
+    cursor.close()
+
+def seed_demo_assets(conn, rooms):
+    """A filler Super Admin account and a default preset with one block per room (first three rooms)."""
+    try:
+        switch_database(conn, "accounts")
+        try:
+            account_id = create_account(conn, "filler", "Super Admin", "filler", "filler@fakecompany.co.uk")
+        except Error as e:
+            # If it already exists, just find the existing one
+            if "Duplicate entry" in str(e):
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id FROM users WHERE email=%s", ("filler@fakecompany.co.uk",))
+                row = cursor.fetchone()
+                if row:
+                    account_id = row[0]
+                else:
+                    raise
+            else:
+                raise
+
+        switch_database(conn, "assets")
+        image_data = None
+        if os.path.exists("store.png"):
+            image_data = read_image("store.png")
+
+        preset_id = create_preset(conn, "Default", account_id, "store.png", image_data)
+        create_map_block(conn, preset_id, rooms[0], 30, 20, 300, 300, "#ab28b2", "Reception")
+        if len(rooms) > 1:
+            create_map_block(conn, preset_id, rooms[1], 330, 20, 300, 300, "#3a5fcd", "Security")
+        if len(rooms) > 2:
+            create_map_block(conn, preset_id, rooms[2], 30, 320, 300, 300, "#e94d1b", "Lobby")
+        set_default_preset(conn, preset_id)
+    except Error as e:
+        print("Error creating account or preset:", e)
+    finally:
+        switch_database(conn, "pico")
 
 # -------------------------------
-# Insert functions for pico_device and bluetooth_tracker.
+# Simulated fleet
 # -------------------------------
+# The first three rooms keep the IDs the demo preset was built around; further rooms and all
+# trackers get IDs derived from their index, so re-running with the same sizes reuses devices.
+DEMO_ROOMS = ['d83add67ed84', 'd83add41a997', 'd83add8af3cf']
+TRACKER_GROUPS = {"User": "user", "Luggage": "luggage", "Staff": "staff", "Security": "security"}
+DEMO_TRACKER_COUNTS = {"User": 10, "Luggage": 10, "Staff": 5, "Security": 5}
+ENVIRONMENT_PICO_TYPE = 1
+BT_TRACKER_PICO_TYPE = 2
+BATCH_ROWS = 5000
+
+def device_id(kind, index):
+    return hashlib.md5(f"{kind}-{index}".encode()).hexdigest()[:12]
+
+def room_ids(count):
+    return DEMO_ROOMS[:count] + [device_id("room", i) for i in range(len(DEMO_ROOMS), count)]
+
+def tracker_ids(counts):
+    """{tracker type: [picoID, ...]}"""
+    return {tracker: [device_id(f"tracker-{tracker}", i) for i in range(count)] for tracker, count in counts.items()}
+
 def ensure_tracking_group_exists(conn, groupName):
     """
     Ensures a tracking group exists with the given groupName.
@@ -103,12 +172,10 @@ def ensure_tracking_group_exists(conn, groupName):
     cursor.close()
     return groupID
 
-def insert_pico_device(conn, picoID, readablePicoID, bluetoothID, picoType):
+def upsert_pico_devices(conn, rows):
     """
-    Inserts or updates a device row into pico_device.
-    For environment sensors, picoType = 1.
-    For Bluetooth trackers, picoType = 2.
-    We ensure 'readablePicoID' is unique by hashing or appending part of the picoID.
+    Inserts or updates (picoID, readablePicoID, bluetoothID, picoType) rows in pico_device.
+    A None bluetoothID keeps whatever ID the device already has.
     """
     cursor = conn.cursor()
     sql = """INSERT INTO pico_device (picoID, readablePicoID, bluetoothID, picoType)
@@ -116,186 +183,337 @@ def insert_pico_device(conn, picoID, readablePicoID, bluetoothID, picoType):
              ON DUPLICATE KEY UPDATE
                readablePicoID = VALUES(readablePicoID),
                picoType = VALUES(picoType),
-               bluetoothID = VALUES(bluetoothID)
+               bluetoothID = COALESCE(VALUES(bluetoothID), bluetoothID)
     """
-    try:
-        cursor.execute(sql, (picoID, readablePicoID, bluetoothID, picoType))
-        conn.commit()
-    except mysql.connector.IntegrityError as e:
-        print(f"Could not insert/update device {picoID}: {e}")
-    finally:
-        cursor.close()
+    for i in range(0, len(rows), BATCH_ROWS):
+        cursor.executemany(sql, rows[i:i + BATCH_ROWS])
+    conn.commit()
+    cursor.close()
 
-def insert_or_update_bluetooth_tracker(conn, picoID, trackingGroupID):
-    """
-    Inserts or updates a row in bluetooth_tracker linking a device to a tracking group.
-    If the device does not exist in pico_device, we create it with picoType=2 and a random readable ID.
-    """
-    # Ensure the device is in pico_device (with picoType=2).
-    # If it's missing, create a fallback device entry:
-    #   readablePicoID can be a short hash of picoID to ensure uniqueness.
-    short_hash = hashlib.md5(picoID.encode()).hexdigest()[:6]
-    fallback_readable = f"Tracker-{short_hash}"
-    
-    # Insert the device in pico_device if missing
-    insert_pico_device(conn, picoID, fallback_readable, None, 2)
-
-    # Now link it to the group
+def link_trackers(conn, rows):
+    """(picoID, trackingGroupID) rows into bluetooth_tracker."""
     cursor = conn.cursor()
     sql = """INSERT INTO bluetooth_tracker (picoID, trackingGroupID)
              VALUES (%s, %s)
              ON DUPLICATE KEY UPDATE trackingGroupID = VALUES(trackingGroupID)
     """
-    try:
-        cursor.execute(sql, (picoID, trackingGroupID))
-        conn.commit()
-    except mysql.connector.Error as e:
-        print(f"Could not link {picoID} to group {trackingGroupID}: {e}")
-    finally:
-        cursor.close()
+    for i in range(0, len(rows), BATCH_ROWS):
+        cursor.executemany(sql, rows[i:i + BATCH_ROWS])
+    conn.commit()
+    cursor.close()
 
-def insert_bluetooth_tracker_data(conn, data):
-    """
-    Inserts multiple rows into bluetooth_tracker_data.
-    Data is a list of (picoID, roomID, logged_at).
-    If the picoID is not found in pico_device, we add it (picoType=2) then link it to 'unknown' group.
-    """
+def reserve_bluetooth_ids(conn, pico_type, count):
+    """Takes `count` IDs from the same counter hardware/editing allocates from."""
     cursor = conn.cursor()
-    # We'll do this row by row so we can handle missing devices gracefully
-    # (i.e., create them or link them).
-    inserted = 0
-    for (picoID, roomID, logged_at) in data:
-        try:
-            # Attempt to insert
-            sql = """INSERT INTO bluetooth_tracker_data (picoID, roomID, logged_at)
-                     VALUES (%s, %s, %s)"""
-            cursor.execute(sql, (picoID, roomID, logged_at))
-            inserted += 1
-        except mysql.connector.IntegrityError as e:
-            # If the device doesn't exist in pico_device, we create it.
-            if "foreign key constraint fails" in str(e).lower():
-                print(f"dummy  | Adding missing pico_device for {picoID}")
-                # Create or update the device
-                short_hash = hashlib.md5(picoID.encode()).hexdigest()[:6]
-                fallback_readable = f"Tracker-{short_hash}"
-                insert_pico_device(conn, picoID, fallback_readable, None, 2)
-                
-                # Also link it to the "unknown" group or some default
-                # If you have a real 'unknown' group, ensure it here:
-                unknown_gid = ensure_tracking_group_exists(conn, "unknown")
-                insert_or_update_bluetooth_tracker(conn, picoID, unknown_gid)
-                
-                # Retry the insert
-                try:
-                    cursor.execute(sql, (picoID, roomID, logged_at))
-                    inserted += 1
-                except mysql.connector.Error as e2:
-                    print(f"dummy  | Still can't insert {picoID} => {e2}")
-            else:
-                print(f"dummy  | Skipping bluetooth_tracker_data row for {picoID}: {e}")
-        except mysql.connector.Error as e:
-            print(f"dummy  | Skipping bluetooth_tracker_data row for {picoID}: {e}")
+    cursor.execute("""UPDATE bluetooth_id_allocator
+                      SET nextID = LEAST(LAST_INSERT_ID(nextID) + %s, lastID + 1)
+                      WHERE picoType = %s""", (count, pico_type))
+    if cursor.rowcount == 0:
+        conn.rollback()
+        cursor.close()
+        return []
+    cursor.execute("SELECT LAST_INSERT_ID(), nextID FROM bluetooth_id_allocator WHERE picoType = %s", (pico_type,))
+    first, end = cursor.fetchone()
     conn.commit()
-    print(f"dummy  | Inserted {inserted} rows into bluetooth_tracker_data")
     cursor.close()
+    return list(range(first, end))
 
-def insert_environment_sensor_data(conn, data):
-    """
-    Inserts multiple rows into environment_sensor_data.
-    Data is a list of (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity).
-    If the device doesn't exist, we create it with picoType=1.
-    """
+def room_bluetooth_ids(conn, rooms):
+    """picoID -> bluetoothID for every room, assigning IDs to rooms that have none."""
     cursor = conn.cursor()
-    inserted = 0
-    for row in data:
-        (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity) = row
-        try:
-            sql = """INSERT INTO environment_sensor_data
-                     (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity)
-                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                  """
-            cursor.execute(sql, row)
-            inserted += 1
-        except mysql.connector.IntegrityError as e:
-            if "foreign key constraint fails" in str(e).lower():
-                print(f"dummy  | Adding missing pico_device for env-sensor {picoID}")
-                # Insert the environment device
-                short_hash = hashlib.md5(picoID.encode()).hexdigest()[:6]
-                fallback_readable = f"Env-{short_hash}"
-                insert_pico_device(conn, picoID, fallback_readable, None, 1)
-                
-                # Retry
-                try:
-                    cursor.execute(sql, row)
-                    inserted += 1
-                except mysql.connector.Error as e2:
-                    print(f"dummy  | Still can't insert environment row {picoID}: {e2}")
-            else:
-                print(f"dummy  | Skipping environment row for {picoID}: {e}")
-        except mysql.connector.Error as e:
-            print(f"dummy  | Skipping environment row for {picoID}: {e}")
-    conn.commit()
-    print(f"dummy  | Inserted {inserted} rows into environment_sensor_data")
+    cursor.execute("SELECT picoID, bluetoothID FROM pico_device WHERE picoID IN (" + ", ".join(["%s"] * len(rooms)) + ")", tuple(rooms))
+    ids = {pico_id: bt_id for pico_id, bt_id in cursor.fetchall() if bt_id is not None}
     cursor.close()
+    missing = [room for room in rooms if room not in ids]
+    if missing:
+        new_ids = reserve_bluetooth_ids(conn, ENVIRONMENT_PICO_TYPE, len(missing))
+        if len(new_ids) < len(missing):
+            raise RuntimeError(f"Only {len(new_ids)} environment bluetooth IDs left for {len(missing)} rooms")
+        cursor = conn.cursor()
+        cursor.executemany("UPDATE pico_device SET bluetoothID = %s WHERE picoID = %s", list(zip(new_ids, missing)))
+        conn.commit()
+        cursor.close()
+        ids.update(zip(missing, new_ids))
+    return ids
+
+def create_fleet(conn, rooms, trackers):
+    """Registers every room sensor and tracker up front so data inserts never hit a missing foreign key."""
+    upsert_pico_devices(conn, [
+        (room, f"Env-{hashlib.md5(room.encode()).hexdigest()[:6]}", None, ENVIRONMENT_PICO_TYPE) for room in rooms
+    ])
+    device_rows = []
+    link_rows = []
+    for tracker, macs in trackers.items():
+        group_id = ensure_tracking_group_exists(conn, TRACKER_GROUPS[tracker])
+        for i, mac in enumerate(macs):
+            # e.g. "User-01-abc123"
+            device_rows.append((mac, f"{tracker}-{i+1:02d}-{hashlib.md5(mac.encode()).hexdigest()[:6]}", None, BT_TRACKER_PICO_TYPE))
+            link_rows.append((mac, group_id))
+    ensure_tracking_group_exists(conn, "unknown")
+    upsert_pico_devices(conn, device_rows)
+    link_trackers(conn, link_rows)
+    print(f"dummy  | Fleet: {len(rooms)} rooms, {len(device_rows)} trackers")
 
 # -------------------------------
-# Dummy Data Generation Functions
+# Movement models
 # -------------------------------
-def generate_dummy_environment_data():
+class Movement:
     """
-    Generate dummy environment sensor data for three rooms.
-    Each room (using a placeholder string) gets 60 entries (one per minute).
+    Where each tracker is, advanced one sample at a time.
+      random  30% chance per sample of jumping to any other room (the original dummy behaviour)
+      walk    like random, but only to a neighbouring room, treating the rooms as a corridor
+      dwell   stays for an exponentially distributed time (mean `dwell` minutes), then walks
     """
-    data = []
-    base_time = datetime.now().replace(second=0, microsecond=0)
-    entries = 60
-    for room in ['d83add67ed84', 'd83add41a997', 'd83add8af3cf']:
-        for i in range(entries):
-            logged_at = base_time - timedelta(minutes=(entries - 1 - i))
-            picoID = room  
-            sound = round(random.uniform(40, 70), 2)
-            light = round(random.uniform(200, 800), 2)
-            temperature = round(random.uniform(18, 26), 2)
-            IAQ = round(random.uniform(50, 150), 2)
-            pressure = round(random.uniform(1000, 1020), 2)
-            humidity = round(random.uniform(30, 70), 2)
-            data.append((picoID, logged_at.strftime("%Y-%m-%d %H:%M:%S"),
-                         sound, light, temperature, IAQ, pressure, humidity))
-    return data
-
-def generate_dummy_tracking_data_for_devices(picoIDs, entries=60):
+    def __init__(self, model, rooms, pico_ids, dwell_minutes=15, rng=random):
+        self.model = model
+        self.rooms = rooms
+        self.dwell_seconds = dwell_minutes * 60
+        self.rng = rng
+        self.position = {pico_id: rng.randrange(len(rooms)) for pico_id in pico_ids}
+        self.leave_at = {}
+
+    def neighbour(self, index):
+        if len(self.rooms) == 1:
+            return index
+        if index == 0:
+            return 1
+        if index == len(self.rooms) - 1:
+            return index - 1
+        return index + self.rng.choice((-1, 1))
+
+    def step(self, pico_id, now):
+        """The tracker's room at `now` (a datetime)."""
+        index = self.position[pico_id]
+        if self.model == "random":
+            if len(self.rooms) > 1 and self.rng.random() < 0.30:
+                index = (index + self.rng.randrange(1, len(self.rooms))) % len(self.rooms)
+        elif self.model == "walk":
+            if self.rng.random() < 0.30:
+                index = self.neighbour(index)
+        elif self.model == "dwell":
+            leave_at = self.leave_at.get(pico_id)
+            if leave_at is not None and now >= leave_at:
+                index = self.neighbour(index)
+                leave_at = None
+            if leave_at is None:
+                self.leave_at[pico_id] = now + timedelta(seconds=self.rng.expovariate(1 / self.dwell_seconds))
+        self.position[pico_id] = index
+        return self.rooms[index]
+
+def environment_reading(rng=random):
+    """(sound, light, temperature, IAQ, pressure, humidity)"""
+    return (round(rng.uniform(40, 70), 2),
+            round(rng.uniform(200, 800), 2),
+            round(rng.uniform(18, 26), 2),
+            round(rng.uniform(50, 150), 2),
+            round(rng.uniform(1000, 1020), 2),
+            round(rng.uniform(30, 70), 2))
+
+def simulate_samples(movement, rooms, start, end, interval):
     """
-    Generate dummy tracking data for each device in picoIDs.
-    Each device gets 'entries' records (one per minute) with random room changes.
+    Yields ("tracker", (picoID, roomID, logged_at)) and ("environment", (picoID, logged_at, readings...))
+    rows for every `interval` seconds in [start, end), each sample jittered within its interval.
     """
-    data = []
-    base_time = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=(entries - 1))
-    rooms = ['d83add67ed84', 'd83add41a997', 'd83add8af3cf']
-    for dev in picoIDs:
-        current_room = random.choice(rooms)
-        for m in range(entries):
-            ts = base_time + timedelta(minutes=m)
-            if random.random() < 0.3:
-                current_room = random.choice([r for r in rooms if r != current_room])
-            data.append((dev, current_room, ts.strftime("%Y-%m-%d %H:%M:%S")))
-    return data
-
-def convert_image_to_base64(filepath):
-    with open(filepath, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
+    current = start
+    step = timedelta(seconds=interval)
+    while current < end:
+        for pico_id in movement.position:
+            ts = current + timedelta(seconds=random.randint(0, interval - 1))
+            yield "tracker", (pico_id, movement.step(pico_id, ts), ts.strftime("%Y-%m-%d %H:%M:%S"))
+        for room in rooms:
+            ts = current + timedelta(seconds=random.randint(0, interval - 1))
+            yield "environment", (room, ts.strftime("%Y-%m-%d %H:%M:%S")) + environment_reading()
+        current += step
 
-def set_default_preset(conn, preset_id):
-    cursor = conn.cursor()
-    sql = "UPDATE default_preset SET preset_id = %s WHERE id = 1"
-    cursor.execute(sql, (preset_id,))
-    conn.commit()
-    cursor.close()
+# -------------------------------
+# Bulk writers
+# -------------------------------
+TRACKER_INSERT = """INSERT INTO bluetooth_tracker_data (picoID, roomID, logged_at)
+                    VALUES (%s, %s, %s)"""
+ENVIRONMENT_INSERT = """INSERT INTO environment_sensor_data
+                        (picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"""
+LOAD_DATA = {
+    "tracker": "LOAD DATA LOCAL INFILE %s INTO TABLE bluetooth_tracker_data FIELDS TERMINATED BY ',' (picoID, roomID, logged_at)",
+    "environment": "LOAD DATA LOCAL INFILE %s INTO TABLE environment_sensor_data FIELDS TERMINATED BY ',' "
+                   "(picoID, logged_at, sound, light, temperature, IAQ, pressure, humidity)",
+}
+
+class BulkWriter:
+    """
+    Buffers generated rows and writes them BATCH_ROWS at a time with executemany (one multi-row
+    INSERT per batch), or with LOAD DATA LOCAL INFILE when asked and the server allows it.
+    """
+    def __init__(self, conn, load_data=False):
+        self.conn = conn
+        self.load_data = load_data
+        self.buffers = {"tracker": [], "environment": []}
+        self.written = {"tracker": 0, "environment": 0}
+
+    def add(self, kind, row):
+        buffer = self.buffers[kind]
+        buffer.append(row)
+        if len(buffer) >= BATCH_ROWS * (20 if self.load_data else 1):
+            self.flush(kind)
+
+    def flush(self, kind=None):
+        for name in ([kind] if kind else list(self.buffers)):
+            rows = self.buffers[name]
+            if not rows:
+                continue
+            if self.load_data:
+                try:
+                    self.load(name, rows)
+                except Error as e:
+                    print(f"dummy  | LOAD DATA failed ({e}), falling back to executemany")
+                    self.conn.rollback()
+                    self.load_data = False
+            if not self.load_data:
+                cursor = self.conn.cursor()
+                cursor.executemany(TRACKER_INSERT if name == "tracker" else ENVIRONMENT_INSERT, rows)
+                cursor.close()
+            self.conn.commit()
+            self.written[name] += len(rows)
+            self.buffers[name] = []
+
+    def load(self, kind, rows):
+        with tempfile.NamedTemporaryFile("w", newline="", suffix=".csv", delete=False) as f:
+            csv.writer(f).writerows(rows)
+            path = f.name
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(LOAD_DATA[kind], (path,))
+            cursor.close()
+        finally:
+            os.remove(path)
+
+# -------------------------------
+# Modes
+# -------------------------------
+def run_backfill(conn, args, rooms, trackers):
+    """Writes `--days` of history ending now."""
+    pico_ids = [mac for macs in trackers.values() for mac in macs]
+    end = datetime.now().replace(second=0, microsecond=0)
+    start = end - timedelta(days=args.days)
+    samples = math.ceil(args.days * 86400 / args.interval)
+    print(f"dummy  | Backfilling {args.days} days from {start}: ~{samples * (len(pico_ids) + len(rooms)):,} rows")
+
+    movement = Movement(args.movement, rooms, pico_ids, args.dwell)
+    writer = BulkWriter(conn, args.load_data)
+    started = time.monotonic()
+    day = start
+    while day < end:
+        day_end = min(day + timedelta(days=1), end)
+        for kind, row in simulate_samples(movement, rooms, day, day_end, args.interval):
+            writer.add(kind, row)
+        writer.flush()
+        total = sum(writer.written.values())
+        print(f"dummy  | {day_end:%Y-%m-%d}: {total:,} rows, {total / (time.monotonic() - started):,.0f} rows/s")
+        day = day_end
+    elapsed = time.monotonic() - started
+    print(json.dumps({"mode": "backfill", "rows": writer.written, "seconds": round(elapsed, 1),
+                      "rows_per_second": round(sum(writer.written.values()) / elapsed)}))
+
+def run_live(conn, args, rooms, trackers):
+    """One sample per device every `--interval` seconds, written straight to the database."""
+    pico_ids = [mac for macs in trackers.values() for mac in macs]
+    movement = Movement(args.movement, rooms, pico_ids, args.dwell)
+    writer = BulkWriter(conn)
+    print("Starting live simulation (press CTRL+C to stop)...")
+    while True:
+        current_time = datetime.now()
+        print(f"\n--- Live Simulation: {current_time.strftime('%Y-%m-%d %H:%M:%S')} ---")
+        for kind, row in simulate_samples(movement, rooms, current_time, current_time + timedelta(seconds=1), args.interval):
+            writer.add(kind, row)
+        writer.flush()
+        print(f"dummy  | Inserted {writer.written['tracker']} tracker and {writer.written['environment']} environment rows so far")
+        time.sleep(args.interval)
+
+def run_mqtt(conn, args, rooms, trackers):
+    """
+    Publishes PicoData payloads to feeds/hardware-data/<picoID> at `--rate` messages per second,
+    so data/processor does the inserts. Each device reports once per `--interval` seconds of
+    simulated time, which runs as fast as the rate allows.
+    """
+    import paho.mqtt.client as mqtt
+
+    bluetooth_ids = room_bluetooth_ids(conn, rooms)
+    pico_ids = [mac for macs in trackers.values() for mac in macs]
+    movement = Movement(args.movement, rooms, pico_ids, args.dwell)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.username_pw_set(os.getenv("mqtt_token"), None)
+    client.max_inflight_messages_set(1000)
+    broker.connect(client)
+    client.loop_start()
+
+    def messages():
+        simulated = datetime.now()
+        while True:
+            for pico_id in pico_ids:
+                room = movement.step(pico_id, simulated)
+                yield pico_id, {"PicoID": pico_id, "RoomID": bluetooth_ids[room], "PicoType": BT_TRACKER_PICO_TYPE, "Data": ""}
+            for room in rooms:
+                yield room, {"PicoID": room, "RoomID": bluetooth_ids[room], "PicoType": ENVIRONMENT_PICO_TYPE,
+                             "Data": ",".join(str(value) for value in environment_reading())}
+            simulated += timedelta(seconds=args.interval)
+
+    print(f"dummy  | Publishing {args.rate} msg/s for {len(pico_ids)} trackers and {len(rooms)} rooms (press CTRL+C to stop)")
+    sent = failed = 0
+    started = time.monotonic()
+    last_report = started
+    try:
+        for pico_id, payload in messages():
+            # Paced against the start time so the average rate holds even when a publish is slow
+            delay = started + sent / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            info = client.publish("feeds/hardware-data/" + pico_id, json.dumps(payload), qos=args.qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                failed += 1
+            sent += 1
+            now = time.monotonic()
+            if now - last_report >= 10:
+                print(f"dummy  | {sent:,} sent, {sent / (now - started):,.0f} msg/s, {failed} failed")
+                last_report = now
+            if args.duration and now - started >= args.duration:
+                break
+    finally:
+        client.loop_stop()
+        client.disconnect()
+    elapsed = time.monotonic() - started
+    print(json.dumps({"mode": "mqtt", "sent": sent, "failed": failed, "seconds": round(elapsed, 1),
+                      "messages_per_second": round(sent / elapsed)}))
 
 # -------------------------------
-# Main Execution: Insert Dummy Data
+# Main Execution
 # -------------------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dummy data and load generator for the pico database")
+    parser.add_argument("--mode", choices=["live", "backfill", "mqtt"], default="live",
+                        help="live: seed the demo and insert a sample per device every interval (default); "
+                             "backfill: bulk insert history; mqtt: publish PicoData messages for data/processor")
+    parser.add_argument("--rooms", type=int, default=len(DEMO_ROOMS), help="room (environment) sensors, at most 999")
+    parser.add_argument("--trackers", type=int, help="trackers per tracking group (default: the demo's 10/10/5/5)")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between samples from one device")
+    parser.add_argument("--movement", choices=["random", "walk", "dwell"], default="random")
+    parser.add_argument("--dwell", type=float, default=15, help="mean minutes in a room for --movement dwell")
+    parser.add_argument("--days", type=float, default=1, help="backfill: days of history")
+    parser.add_argument("--load-data", action="store_true", help="backfill: use LOAD DATA LOCAL INFILE (needs local_infile on the server)")
+    parser.add_argument("--rate", type=float, default=100, help="mqtt: messages per second")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0, help="mqtt: publish QoS")
+    parser.add_argument("--duration", type=float, default=0, help="mqtt: seconds to run, 0 for until stopped")
+    parser.add_argument("--seed", action="store_true", help="also create the demo account and preset (always done in live mode)")
+    args = parser.parse_args()
+    if not 1 <= args.rooms <= 999:
+        parser.error("--rooms must be between 1 and 999")
+    if args.interval < 1:
+        parser.error("--interval must be at least 1")
+    return args
+
 if __name__ == '__main__':
-    conn = get_connection()
+    args = parse_args()
+    conn = get_connection(allow_local_infile=args.load_data)
     if not conn:
         print("Database connection failed, exiting.")
         exit(1)
@@ -303,134 +521,32 @@ if __name__ == '__main__':
     # Switch to the pico database.
     switch_database(conn, "pico")
 
-    # 1) Insert environment sensor devices for each room.
-    env_rooms = ['d83add67ed84', 'd83add41a997', 'd83add8af3cf']
-    for room in env_rooms:
-        # Use a short hash to ensure unique readable IDs
-        import hashlib
-        short_hash = hashlib.md5(room.encode()).hexdigest()[:6]
-        env_readable = f"Env-{short_hash}"
-        insert_pico_device(conn, room, env_readable, None, 1)
-
-    # 2) Ensure tracking groups exist for built-in types + "unknown"
-    tracking_groups = {}
-    for grp in ["user", "luggage", "staff", "security", "unknown"]:
-        tracking_groups[grp] = ensure_tracking_group_exists(conn, grp)
-
-    # 3) Create Bluetooth tracker devices for each type.
-    devices_by_type = {"User": [], "Luggage": [], "Staff": [], "Security": []}
-    tracker_counts = {"User": 10, "Luggage": 10, "Staff": 5, "Security": 5}
-    for tracker, cnt in tracker_counts.items():
-        for i in range(cnt):
-            mac = generate_mac_address()
-            short_hash = hashlib.md5(mac.encode()).hexdigest()[:6]
-            # e.g. "User-01-abc123"
-            readable = f"{tracker}-{i+1:02d}-{short_hash}"
-            insert_pico_device(conn, mac, readable, None, 2)
-            grp_name = tracker.lower()  # "user", "luggage", etc.
-            grp_id = tracking_groups[grp_name]
-            insert_or_update_bluetooth_tracker(conn, mac, grp_id)
-            devices_by_type[tracker].append(mac)
-
-    # 4) Generate and insert dummy tracking data into bluetooth_tracker_data.
-    bt_data = []
-    for tracker, macs in devices_by_type.items():
-        bt_data.extend(generate_dummy_tracking_data_for_devices(macs, 60))
-    insert_bluetooth_tracker_data(conn, bt_data)
-
-    # 5) Generate and insert dummy environment sensor data.
-    env_data = generate_dummy_environment_data()
-    insert_environment_sensor_data(conn, env_data)
-
-    # 6) Switch to accounts and assets to create a dummy account and preset.
-    try:
-        switch_database(conn, "accounts")
-        try:
-            account_id = create_account(conn, "filler", "Super Admin", "filler", "filler@fakecompany.co.uk")
-        except Error as e:
-            # If it already exists, just find the existing one
-            if "Duplicate entry" in str(e):
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id FROM users WHERE email=%s", ("filler@fakecompany.co.uk",))
-                row = cursor.fetchone()
-                if row:
-                    account_id = row[0]
-                else:
-                    raise
-            else:
-                raise
-
-        switch_database(conn, "assets")
-        image_data = ""
-        if os.path.exists("store.png"):
-            image_data = convert_image_to_base64("store.png")
-
-        preset_id = create_preset(conn, "Default", account_id, "store.png", image_data)
-        create_map_block(conn, preset_id, env_rooms[0], 30, 20, 300, 300, "#ab28b2", "Reception")
-        create_map_block(conn, preset_id, env_rooms[1], 330, 20, 300, 300, "#3a5fcd", "Security")
-        create_map_block(conn, preset_id, env_rooms[2], 30, 320, 300, 300, "#e94d1b", "Lobby")
-        set_default_preset(conn, preset_id)
-    except Error as e:
-        print("Error creating account or preset:", e)
-
-    # 7) Live Simulation: Inserting live tracking and environment data every minute.
-    switch_database(conn, "pico")
-    ROOMS = env_rooms
-    live_states = {
-        "User": {mac: random.choice(ROOMS) for mac in devices_by_type["User"]},
-        "Luggage": {mac: random.choice(ROOMS) for mac in devices_by_type["Luggage"]},
-        "Staff": {mac: random.choice(ROOMS) for mac in devices_by_type["Staff"]},
-        "Security": {mac: random.choice(ROOMS) for mac in devices_by_type["Security"]}
-    }
-
-    def simulate_minute(current_time, state):
-        recs = []
-        for picoID, cur_room in state.items():
-            # decide if room changes
-            if random.random() < 0.30:
-                new_room = random.choice([r for r in ROOMS if r != cur_room])
-                state[picoID] = new_room
-            else:
-                new_room = cur_room
-            # add random seconds offset
-            ts = current_time + timedelta(seconds=random.randint(0, 59))
-            recs.append((picoID, new_room, ts.strftime("%Y-%m-%d %H:%M:%S")))
-        return recs
-
-    def simulate_environment(current_time):
-        recs = []
-        for rm in ROOMS:
-            picoID = rm
-            sound = round(random.uniform(40, 70), 2)
-            light = round(random.uniform(200, 800), 2)
-            temperature = round(random.uniform(18, 26), 2)
-            IAQ = round(random.uniform(50, 150), 2)
-            pressure = round(random.uniform(1000, 1020), 2)
-            humidity = round(random.uniform(30, 70), 2)
-            ts = current_time + timedelta(seconds=random.randint(0, 59))
-            recs.append((picoID, ts.strftime("%Y-%m-%d %H:%M:%S"),
-                         sound, light, temperature, IAQ, pressure, humidity))
-        return recs
+    rooms = room_ids(args.rooms)
+    trackers = tracker_ids(DEMO_TRACKER_COUNTS if args.trackers is None else {tracker: args.trackers for tracker in TRACKER_GROUPS})
+    create_fleet(conn, rooms, trackers)
+
+    if args.mode == "live" or args.seed:
+        # An hour of history so the dashboards have something to show straight away
+        pico_ids = [mac for macs in trackers.values() for mac in macs]
+        writer = BulkWriter(conn)
+        end = datetime.now().replace(second=0, microsecond=0)
+        for kind, row in simulate_samples(Movement("random", rooms, pico_ids), rooms, end - timedelta(hours=1), end, 60):
+            writer.add(kind, row)
+        writer.flush()
+        print(f"dummy  | Inserted {writer.written['tracker']} rows into bluetooth_tracker_data")
+        print(f"dummy  | Inserted {writer.written['environment']} rows into environment_sensor_data")
+        seed_demo_assets(conn, rooms)
 
-    print("Starting live simulation (press CTRL+C to stop)...")
     try:
-        while True:
-            current_time = datetime.now()
-            print(f"\n--- Live Simulation: {current_time.strftime('%Y-%m-%d %H:%M:%S')} ---")
-
-            # Insert tracking data
-            for tracker, st in live_states.items():
-                new_data = simulate_minute(current_time, st)
-                insert_bluetooth_tracker_data(conn, new_data)
-
-            # Insert environment data
-            env_live = simulate_environment(current_time)
-            insert_environment_sensor_data(conn, env_live)
-
-            time.sleep(60)
+        if args.mode == "backfill":
+            run_backfill(conn, args, rooms, trackers)
+        elif args.mode == "mqtt":
+            run_mqtt(conn, args, rooms, trackers)
+        else:
+            run_live(conn, args, rooms, trackers)
     except KeyboardInterrupt:
-        print("Live simulation interrupted by user.")
+        print("Simulation interrupted by user.")
     except Exception as e:
-        print("Error during live simulation:", e)
+        print("Error during simulation:", e)
     finally:
         conn.close()
@@ -2,33 +2,22 @@
 import paho.mqtt.client as mqtt
 import os
 import json
+import threading
+import time
 from pydantic import BaseModel, ValidationError
-import mysql.connector
 from mysql.connector import Error
+from shared import metrics, db, telemetry, broker
 
 UNASSIGNED_PICO_TYPE = 0
 ENVIRONMENT_PICO_TYPE = 1
 BT_TRACKER_PICO_TYPE = 2
 tests_allowed = True
 
-db_connection = None
+# The MQTT thread and the reply worker each keep one pooled connection
+database = db.Database("hardware_config", pool_size=2)
 
 def get_db_connection():
-    global db_connection
-    if db_connection is None or not db_connection.is_connected():
-        try:
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-        except e:
-            print("Unknown error", e)
-    return db_connection
+    return database.connection()
 
 
 #on connection or reconnection, subscribe to all hardware config message feeds
@@ -39,140 +28,258 @@ def on_connect(client, user_data, connect_flags, result_code, properties):
     #subscribe to all hardware data feeds
     client.subscribe("hardware_config/hardware_message/#")
     client.subscribe("test/hardware_config/hardware_message/#")
+    client.subscribe(INVALIDATE_TOPIC)
     print("Subscribed to hardware feeds")
 
 
 class ConfigRequest(BaseModel):
     PicoID: str
+    PayloadFormats: list = []   # telemetry formats the device can send, see shared/telemetry.py
+
+
+class InvalidateRequest(BaseModel):
+    PicoIDs: list = []
+    TrackingGroupID: int = None
+
+
+# -------------------------------
+# Device config cache
+# -------------------------------
+# When power comes back the whole fleet boots at once. Boot messages are only queued on the
+# MQTT thread; a worker collects them for REPLY_BATCH_SECONDS, answers from the cache and
+# looks up every miss in one query. hardware/editing publishes to INVALIDATE_TOPIC whenever
+# it changes a device or tracking group, and entries also expire after CONFIG_CACHE_SECONDS
+# in case an invalidation is missed.
+CONFIG_CACHE_SECONDS = int(os.getenv("CONFIG_CACHE_SECONDS", 300))
+REPLY_BATCH_SECONDS = 0.05
+REPLY_COALESCE_SECONDS = 5      # devices re-ask every 30s, so a repeat inside this window is a duplicate
+LOOKUP_CHUNK_SIZE = 500
+INVALIDATE_TOPIC = "hardware_config/invalidate"
+SERVER_MESSAGE_TOPIC = "hardware_config/server_message/"
+
+device_configs = {}     # picoID -> (cached_at, reply, trackingGroupID)
+recent_replies = {}     # picoID -> (sent_at, payload)
+cache_lock = threading.Lock()
+config_generation = 0   # bumped under cache_lock by every invalidation
+
+pending_boots = set()
+pending_condition = threading.Condition()
+payload_formats = {}    # picoID -> negotiated telemetry format, for devices that advertised any
+
+cache_stats = {"boots": 0, "coalesced": 0, "hits": 0, "misses": 0, "new_devices": 0, "replies": 0, "lookups": 0}
+
+
+def count(stat, amount=1):
+    # Updated from the MQTT and reply worker threads
+    with cache_lock:
+        cache_stats[stat] += amount
+
+
+def config_reply(readable_id, bt_id, pico_type, group_name):
+    tracking_group = ""
+    if pico_type == BT_TRACKER_PICO_TYPE and group_name is not None:
+        tracking_group = group_name
+    return {"ReadableID" : readable_id,
+            "BluetoothID" : 0 if bt_id is None else int(bt_id),
+            "PicoType" : pico_type,
+            "TrackerGroup" : tracking_group}
+
+
+def load_device_configs(cursor, pico_ids=None):
+    """picoID -> (reply, trackingGroupID) for the given devices, or every device if None."""
+    select_statement = """SELECT pico_device.picoID, pico_device.readablePicoID, pico_device.bluetoothID, pico_device.picoType,
+                                 bluetooth_tracker.trackingGroupID, tracking_groups.groupName
+                          FROM pico_device
+                          LEFT JOIN bluetooth_tracker ON pico_device.picoID = bluetooth_tracker.picoID
+                          LEFT JOIN tracking_groups ON tracking_groups.groupID = bluetooth_tracker.trackingGroupID"""
+    chunks = [None] if pico_ids is None else [pico_ids[i:i + LOOKUP_CHUNK_SIZE] for i in range(0, len(pico_ids), LOOKUP_CHUNK_SIZE)]
+    configs = {}
+    for chunk in chunks:
+        if chunk is None:
+            cursor.execute(select_statement)
+        else:
+            cursor.execute(select_statement + " WHERE pico_device.picoID IN (" + ", ".join(["%s"] * len(chunk)) + ")", tuple(chunk))
+        count("lookups")
+        for pico_id, readable_id, bt_id, pico_type, group_id, group_name in cursor.fetchall():
+            configs[pico_id] = (config_reply(readable_id, bt_id, pico_type, group_name), group_id)
+    return configs
+
+
+def current_generation():
+    with cache_lock:
+        return config_generation
+
+
+def cache_configs(configs, generation):
+    """
+    Caches configs read after `generation` was taken. If an invalidation has landed since, the
+    rows may predate the change it announced, so nothing is cached and the next boot reads again.
+    """
+    now = time.monotonic()
+    with cache_lock:
+        if generation != config_generation:
+            return
+        for pico_id, (reply, group_id) in configs.items():
+            device_configs[pico_id] = (now, reply, group_id)
 
 
-def handle_new_device(client, cursor, pico_id):
-    print("Handling new device with picoid " + pico_id)
-    print("Inserting into db")
-    insert_statement = "INSERT INTO pico_device(picoID, readablePicoID) VALUES (%s, %s);"
-    cursor.execute(insert_statement, (pico_id, pico_id));
-    print("Inserted")
+def cached_config(pico_id):
+    with cache_lock:
+        entry = device_configs.get(pico_id)
+    if entry is None or time.monotonic() - entry[0] > CONFIG_CACHE_SECONDS:
+        return None
+    return entry[1]
 
-    print("sending response")
-    try:
-        response = json.dumps({"ReadableID" : pico_id, "BluetoothID" : 0, "PicoType" : UNASSIGNED_PICO_TYPE, "TrackerGroup" : ""})
-        client.publish("hardware_config/server_message/" + pico_id, response, qos=2)
-    except e:
-        print(str(e))
-    print("Published msg")
-    print(response)
-    print("")
-
-
-def handle_known_device(client, cursor, pico_id, current_device_data):
-    print("Handling known device with picoid " + pico_id)
-    print("Device data: ", current_device_data)
-    readable_id = current_device_data[0]
-    bt_id = current_device_data[1]
-    if bt_id == None:
-        bt_id = 0
-    else:
-        bt_id = int(bt_id)
-
-    pico_type = current_device_data[2]
-    
-    if (pico_type == UNASSIGNED_PICO_TYPE):
-        response = json.dumps({"ReadableID" : readable_id, "BluetoothID" : bt_id, "PicoType" : UNASSIGNED_PICO_TYPE, "TrackerGroup" : ""})
-        client.publish("hardware_config/server_message/" + pico_id, response, qos=2)
-#
-        print("Published msg")
-        print(response)
-        print("")
-
-    elif (pico_type == BT_TRACKER_PICO_TYPE):
-        bt_tracker_select_statement = """SELECT tracking_groups.groupName
-                                            FROM tracking_groups
-                                            INNER JOIN bluetooth_tracker ON tracking_groups.groupID = bluetooth_tracker.trackingGroupID
-                                            WHERE bluetooth_tracker.picoID = %s;"""
-        cursor.execute(bt_tracker_select_statement, (pico_id,))
-
-        bt_tracker_data = cursor.fetchone()
-
-        tracking_group = ""
-
-        if bt_tracker_data != None:
-            tracking_group = bt_tracker_data[0] 
-
-        response = json.dumps({"ReadableID" : readable_id, "BluetoothID" : bt_id, "PicoType" : BT_TRACKER_PICO_TYPE, "TrackerGroup" : tracking_group})
-        client.publish("hardware_config/server_message/" + pico_id, response, qos=2)
-
-        
-        print("Published msg")
-        print(response)
-        print("")
-
-    elif(pico_type == ENVIRONMENT_PICO_TYPE):
-        response = json.dumps({"ReadableID" : readable_id, "BluetoothID" : bt_id, "PicoType" : ENVIRONMENT_PICO_TYPE, "TrackerGroup" : ""})
-        client.publish("hardware_config/server_message/" + pico_id, response, qos=2)
-        
-        print("Published msg")
-        print(response)
-        print("")
-
-
-#whenever a message is recieved from a feed, print it and its details
-def on_message(client, user_data, message):
-    # Make sure there is SQL connection
+
+def invalidate_configs(pico_ids=(), group_id=None):
+    global config_generation
+    with cache_lock:
+        config_generation += 1
+        if group_id is not None:
+            pico_ids = list(pico_ids) + [pico_id for pico_id, entry in device_configs.items() if entry[2] == group_id]
+        for pico_id in pico_ids:
+            device_configs.pop(pico_id, None)
+            recent_replies.pop(pico_id, None)
+    print(f"Invalidated {len(pico_ids)} cached device configs")
+
+
+def warm_config_cache():
     db_connection = get_db_connection()
     if db_connection is None:
-        print("ERR: No database connection, check the DB is up!")
         return
     cursor = db_connection.cursor()
-
     try:
-        print(f'message from "{message.topic}":')
-        # print(str(message.payload))
-
-        # Decode message into utf-8
-        payload_str = message.payload.decode("utf-8", errors="ignore")
-
-        print(payload_str)
-
-        # Make sure it is a json
-        try:
-            hardware_request_data = ConfigRequest.parse_raw(payload_str)
-        except json.JSONDecodeError:
-            print("ERR: invalid json")
-            cursor.close()
-            return
-        except ValidationError as e:
-            print("ERR: invalid structure", e)
-            cursor.close()
-            return
-        except e:
-            print("Unknown error", e)
-            cursor.close()
-            return
-
-        if not tests_allowed:
-            if hardware_request_data.PicoID.lower().startswith("test"):
-                print("Test ID not allowed outside of tests")
-                cursor.close()
-                return
-
-        select_statement = "SELECT readablePicoID, bluetoothID, picoType FROM pico_device WHERE picoID = %s;"
-
-        cursor.execute(select_statement, (hardware_request_data.PicoID,))
+        generation = current_generation()
+        configs = load_device_configs(cursor)
+        cache_configs(configs, generation)
+        print(f"Cached {len(configs)} device configs")
+    except Error as e:
+        print(f"Error warming the config cache: {e}")
+    finally:
+        cursor.close()
 
-        current_device_data = cursor.fetchone()
 
-        if current_device_data is None:
-            handle_new_device(client, cursor, pico_id=hardware_request_data.PicoID)
+def handle_new_devices(cursor, pico_ids):
+    """Registers unknown devices and writes their default config through to the cache."""
+    print("Handling new devices with picoids " + ", ".join(pico_ids))
+    insert_statement = "INSERT IGNORE INTO pico_device(picoID, readablePicoID) VALUES (%s, %s);"
+    cursor.executemany(insert_statement, [(pico_id, pico_id) for pico_id in pico_ids])
+    configs = {pico_id: (config_reply(pico_id, 0, UNASSIGNED_PICO_TYPE, None), None) for pico_id in pico_ids}
+    count("new_devices", len(pico_ids))
+    return configs
+
+
+def resolve_configs(pico_ids):
+    """picoID -> reply, from the cache where possible and one lookup for the rest."""
+    replies = {}
+    misses = []
+    for pico_id in pico_ids:
+        reply = cached_config(pico_id)
+        if reply is None:
+            misses.append(pico_id)
         else:
-            handle_known_device(client, cursor, hardware_request_data.PicoID, current_device_data)
+            replies[pico_id] = reply
+    with cache_lock:
+        cache_stats["hits"] += len(replies)
+        cache_stats["misses"] += len(misses)
+    if not misses:
+        return replies
 
-        cursor.close()
+    db_connection = get_db_connection()
+    if db_connection is None:
+        print("ERR: No database connection, check the DB is up!")
+        return replies
+    cursor = db_connection.cursor()
+    try:
+        generation = current_generation()
+        configs = load_device_configs(cursor, misses)
+        unknown = [pico_id for pico_id in misses if pico_id not in configs]
+        if unknown:
+            configs.update(handle_new_devices(cursor, unknown))
         db_connection.commit()
+        cache_configs(configs, generation)
+        replies.update({pico_id: config[0] for pico_id, config in configs.items()})
     except Exception as e:
         db_connection.rollback()
         print(str(e))
     finally:
         cursor.close()
+    return replies
+
+
+def send_replies(client, replies):
+    now = time.monotonic()
+    for pico_id, reply in replies.items():
+        if pico_id in payload_formats:
+            # Cached replies are reused, so the format goes on a copy
+            reply = dict(reply, PayloadFormat=payload_formats[pico_id])
+        response = json.dumps(reply)
+        with cache_lock:
+            previous = recent_replies.get(pico_id)
+            if previous is not None and previous[1] == response and now - previous[0] < REPLY_COALESCE_SECONDS:
+                cache_stats["coalesced"] += 1
+                continue
+            recent_replies[pico_id] = (now, response)
+        client.publish(SERVER_MESSAGE_TOPIC + pico_id, response, qos=2)
+        count("replies")
+
+
+def reply_worker(client):
+    while True:
+        with pending_condition:
+            while not pending_boots:
+                pending_condition.wait()
+        # Let the rest of a reboot storm arrive so it is answered in one pass
+        time.sleep(REPLY_BATCH_SECONDS)
+        with pending_condition:
+            pico_ids = list(pending_boots)
+            pending_boots.clear()
+        send_replies(client, resolve_configs(pico_ids))
+
+
+def queue_boot(pico_id, advertised_formats=None):
+    with pending_condition:
+        if advertised_formats:
+            payload_formats[pico_id] = telemetry.negotiate(advertised_formats)
+        else:
+            payload_formats.pop(pico_id, None)
+        count("boots")
+        if pico_id in pending_boots:
+            count("coalesced")
+        pending_boots.add(pico_id)
+        pending_condition.notify()
+
+
+#whenever a message is recieved from a feed, queue the device for a reply
+def on_message(client, user_data, message):
+    # Decode message into utf-8
+    payload_str = message.payload.decode("utf-8", errors="ignore")
+
+    if message.topic == INVALIDATE_TOPIC:
+        try:
+            invalidate_request = InvalidateRequest.parse_raw(payload_str)
+        except (json.JSONDecodeError, ValidationError) as e:
+            print("ERR: invalid invalidation message", e)
+            return
+        invalidate_configs(invalidate_request.PicoIDs, invalidate_request.TrackingGroupID)
+        return
+
+    # Make sure it is a json
+    try:
+        hardware_request_data = ConfigRequest.parse_raw(payload_str)
+    except json.JSONDecodeError:
+        print("ERR: invalid json")
+        return
+    except ValidationError as e:
+        print("ERR: invalid structure", e)
+        return
+
+    if not tests_allowed:
+        if hardware_request_data.PicoID.lower().startswith("test"):
+            print("Test ID not allowed outside of tests")
+            return
+
+    queue_boot(hardware_request_data.PicoID, hardware_request_data.PayloadFormats)
 
 
 #set up the client to recieve messages
@@ -197,12 +304,19 @@ def main():
     #set the mqtt client to handle connections and messages
     client.on_connect = on_connect
     client.on_message = on_message
+    metrics.instrument_mqtt_client(client)
+    metrics.QUEUE_DEPTH.set_function(lambda: len(pending_boots), "pending_boots")
+    metrics.serve_metrics("hardware_config")
 
     #set the token to authorise the client
     client.username_pw_set(access_token, None)
+    client.max_inflight_messages_set(100)
+
+    warm_config_cache()
+    threading.Thread(target=reply_worker, args=(client,), daemon=True).start()
 
     #connect
-    client.connect("mqtt.flespi.io", 1883)
+    broker.connect(client)
     client.loop_forever()
 
 
@@ -1,17 +1,21 @@
 import json
 from flask import Flask, request, jsonify, make_response
-import mysql.connector
 import paho.mqtt.client as mqtt
 from flask_cors import CORS
 from mysql.connector import Error
+import bisect
 import os
+import queue
 import requests
+import threading
 import time
+from shared import metrics, log, db, broker
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "hardware_editor")
+logger = log.setup("hardware_editor")
 
-db_connection = None
 
 UNASSIGNED_PICO_TYPE = 0
 ENVIRONMENT_PICO_TYPE = 1
@@ -23,25 +27,12 @@ HIGHEST_PICO_TYPE = BT_TRACKER_PICO_TYPE
 MQTT_TOKEN = os.getenv("mqtt_token")
 
 
-def get_db_connection(retries=5, delay=1):
-    global db_connection
-    for _ in range(retries):
-        try:
-            if db_connection != None and db_connection.is_connected():
-                return db_connection
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-            time.sleep(delay)
-    
-    print("Failed to establish database connection after retries")
-    return None
+# Pooled connections; each request (or background thread) gets its own
+database = db.Database("hardware_editor")
+database.init_app(app)
+
+def get_db_connection():
+    return database.connection()
 
 
 def validate_session_cookie(request):
@@ -49,44 +40,199 @@ def validate_session_cookie(request):
     cookie = request.cookies.get("session_id")
 
     if not cookie:
-        print("No session_id cookie found.")
+        logger.debug("No session_id cookie found")
         return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
 
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
+    with metrics.span("validate_cookie"):
+        r = requests.get(VALIDATION_SITE, headers={"session-id": cookie, **metrics.trace_headers()})
     if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
+        logger.info("Invalid cookie detected")
         return {"error": "Invalid cookie"}, 401 #, "message": r.text
     
     data = r.json()
     if data.get("authority") not in ["Admin", "Super Admin"]:
-        print("ERR: Non-admin cookie")
+        logger.info("Non-admin cookie")
         return {"error": "Forbidden", "message": "User isn't a valid admin"}, 403
     
     return [data.get("uid")]
 
 
-def send_individual_pico_message(pico_id, hardware_message):
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-    
-    #set the token to authorise the client
-    client.username_pw_set(MQTT_TOKEN, None)
+# -------------------------------
+# MQTT publisher
+# -------------------------------
+SERVER_MESSAGE_TOPIC = "hardware_config/server_message/"
+INVALIDATE_TOPIC = "hardware_config/invalidate"     # read by hardware/config's device config cache
+PUBLISH_QUEUE_SIZE = int(os.getenv("PUBLISH_QUEUE_SIZE", 20000))
+PUBLISH_BATCH_SIZE = 200        # messages handed to paho per wake of the sender thread
+MAX_INFLIGHT_MESSAGES = 100     # unacknowledged QoS 2 messages paho keeps on the wire
+DELIVERY_WAIT_SECONDS = 2       # how long a single device PATCH waits for the broker
+FANOUT_FETCH_SIZE = 500
+
+
+class Delivery:
+    """Completed once the broker has acknowledged every message in it (PUBCOMP for QoS 2)."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.confirmed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if expected == 0:
+            self.done.set()
+
+    def add(self, count):
+        with self.lock:
+            self.expected += count
+            self.done.clear()
+
+    def complete(self, ok=True):
+        with self.lock:
+            if ok:
+                self.confirmed += 1
+            else:
+                self.failed += 1
+            if self.confirmed + self.failed >= self.expected:
+                self.done.set()
+
+    def wait(self, timeout):
+        return self.done.wait(timeout) and self.failed == 0
+
+
+class Publisher:
+    """
+    One long-lived paho client per process. Requests queue (topic, payload) pairs and a sender
+    thread publishes them; paho reconnects on its own and resends unacknowledged QoS 2 messages
+    after a reconnect, so nothing is published on a half-open per-request connection any more.
+    """
+
+    def __init__(self):
+        self.outbound = metrics.track_queue("mqtt_outbound", queue.Queue(PUBLISH_QUEUE_SIZE))
+        self.connected = threading.Event()
+        self.started = False
+        self.start_lock = threading.Lock()
+        # mid -> Delivery for messages handed to paho, and mids paho acknowledged before
+        # publish() returned to the sender thread
+        self.pending = {}
+        self.early_acks = set()
+        self.pending_lock = threading.Lock()
+        self.stats = {"queued": 0, "published": 0, "confirmed": 0, "rejected": 0, "reconnects": 0}
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.username_pw_set(MQTT_TOKEN, None)
+        self.client.max_inflight_messages_set(MAX_INFLIGHT_MESSAGES)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        broker.configure(self.client)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        metrics.instrument_mqtt_client(self.client)
+
+    def start(self):
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+            self.client.connect_async(broker.HOST, broker.PORT)
+            self.client.loop_start()
+            threading.Thread(target=self.send_loop, daemon=True).start()
+
+    def on_connect(self, client, user_data, connect_flags, result_code, properties):
+        logger.info("Publisher connected with result code %s", result_code)
+        if not result_code.is_failure:
+            self.connected.set()
+
+    def on_disconnect(self, client, user_data, disconnect_flags, result_code, properties):
+        logger.warning("Publisher disconnected with result code %s, reconnecting", result_code)
+        self.connected.clear()
+        self.stats["reconnects"] += 1
+
+    def on_publish(self, client, user_data, mid, result_code, properties):
+        # Runs on paho's network thread; never call back into the client from here
+        with self.pending_lock:
+            delivery = self.pending.pop(mid, None)
+            if delivery is None:
+                self.early_acks.add(mid)
+                return
+        self.stats["confirmed"] += 1
+        delivery.complete()
+
+    def publish(self, pico_id, payload, delivery=None):
+        """Queues one message for a device; returns its Delivery."""
+        return self.publish_topic(SERVER_MESSAGE_TOPIC + pico_id, payload, delivery)
+
+    def publish_topic(self, topic, payload, delivery=None):
+        self.start()
+        if delivery is None:
+            delivery = Delivery(1)
+        try:
+            self.outbound.put((topic, payload, delivery), timeout=1)
+            self.stats["queued"] += 1
+        except queue.Full:
+            logger.warning("Publish queue full, dropping message", extra={"topic": topic})
+            self.stats["rejected"] += 1
+            delivery.complete(ok=False)
+        return delivery
+
+    def send_loop(self):
+        while True:
+            batch = [self.outbound.get()]
+            while len(batch) < PUBLISH_BATCH_SIZE:
+                try:
+                    batch.append(self.outbound.get_nowait())
+                except queue.Empty:
+                    break
+            self.connected.wait()
+            for topic, payload, delivery in batch:
+                info = self.client.publish(topic, payload, qos=2)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS and info.rc != mqtt.MQTT_ERR_NO_CONN:
+                    # NO_CONN messages stay queued inside paho and go out after reconnecting
+                    logger.error("Publish failed: %s", mqtt.error_string(info.rc), extra={"topic": topic})
+                    self.stats["rejected"] += 1
+                    delivery.complete(ok=False)
+                    continue
+                self.stats["published"] += 1
+                with self.pending_lock:
+                    if info.mid in self.early_acks:
+                        self.early_acks.discard(info.mid)
+                        acked = True
+                    else:
+                        self.pending[info.mid] = delivery
+                        acked = False
+                if acked:
+                    self.stats["confirmed"] += 1
+                    delivery.complete()
+
+    def status(self):
+        with self.pending_lock:
+            awaiting_ack = len(self.pending)
+        return dict(self.stats, connected=self.connected.is_set(),
+                    outbound=self.outbound.qsize(), awaiting_ack=awaiting_ack)
+
+
+publisher = Publisher()
 
-    #connect
-    client.connect("mqtt.flespi.io", 1883)
-    client.loop_start()
 
-    client.publish("hardware_config/server_message/" + pico_id, hardware_message, qos=2)
+def send_individual_pico_message(pico_id, hardware_message):
+    return publisher.publish(pico_id, hardware_message)
+
 
-    client.loop_stop()
-    client.disconnect()
+def invalidate_device_configs(pico_ids=(), group_id=None, delivery=None):
+    """Drops the cached boot replies hardware/config holds for these devices or group members."""
+    device_snapshot.mark_stale()
+    if delivery is not None:
+        delivery.add(1)
+    return publisher.publish_topic(INVALIDATE_TOPIC, json.dumps({"PicoIDs" : list(pico_ids), "TrackingGroupID" : group_id}), delivery)
 
 
 def sync_tracking_grp_name_with_hardware(group_id, new_group_name = ""):
+    """Queues the new group name for every member device; returns (device count, Delivery)."""
     connection = get_db_connection()
     if connection is None:
-        return
+        return 0, Delivery(0)
 
-    cursor = connection.cursor(dictionary=True)
+    # Unbuffered so a group with thousands of members is streamed, not loaded in one go
+    cursor = connection.cursor(dictionary=True, buffered=False)
 
     select_query = """SELECT picoID
                       FROM bluetooth_tracker
@@ -94,69 +240,310 @@ def sync_tracking_grp_name_with_hardware(group_id, new_group_name = ""):
     
     cursor.execute(select_query, (group_id, ))
 
-    pico_data = cursor.fetchall()
-
-    cursor.close() 
-
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-    
-    #set the token to authorise the client
-    client.username_pw_set(MQTT_TOKEN, None)
+    hardware_message = json.dumps({"TrackerGroup" : new_group_name})
+    delivery = Delivery(0)
+    count = 0
+    try:
+        while True:
+            pico_data = cursor.fetchmany(FANOUT_FETCH_SIZE)
+            if not pico_data:
+                break
+            delivery.add(len(pico_data))
+            for pico in pico_data:
+                publisher.publish(pico["picoID"], hardware_message, delivery)
+            count += len(pico_data)
+    finally:
+        cursor.close()
 
-    #connect
-    client.connect("mqtt.flespi.io", 1883)
-    client.loop_start()
+    return count, delivery
+
+
+# -------------------------------
+# Bluetooth ID allocator
+# -------------------------------
+# Environment sensors broadcast their bluetoothID as the iBeacon major (uint16), trackers use
+# 1000 upwards. IDs come from a per-type counter row in bluetooth_id_allocator, locked only
+# until the transaction commits, and IDs released by unassigned, retyped or deleted devices
+# are handed out again first from bluetooth_id_free.
+BULK_MAX_DEVICES = 1000     # per request for /provision/devices and /patch/device/configs
+
+
+def in_clause(values):
+    return "(" + ", ".join(["%s"] * len(values)) + ")"
+
+
+def allocate_bluetooth_ids(cursor, pico_type, count):
+    """Up to `count` unused IDs for the type; fewer if its range is used up."""
+    cursor.execute("""SELECT bluetoothID
+                      FROM bluetooth_id_free
+                      WHERE picoType = %s
+                      ORDER BY bluetoothID
+                      LIMIT %s
+                      FOR UPDATE SKIP LOCKED;""", (pico_type, count))
+    ids = [row["bluetoothID"] for row in cursor.fetchall()]
+    if ids:
+        cursor.execute("DELETE FROM bluetooth_id_free WHERE bluetoothID IN " + in_clause(ids), tuple(ids))
+
+    remaining = count - len(ids)
+    if remaining > 0:
+        # LAST_INSERT_ID(expr) keeps the old counter for this session only, so no other
+        # allocation can see or reuse the block between the UPDATE and the SELECT
+        cursor.execute("""UPDATE bluetooth_id_allocator
+                          SET nextID = LEAST(LAST_INSERT_ID(nextID) + %s, lastID + 1)
+                          WHERE picoType = %s;""", (remaining, pico_type))
+        if cursor.rowcount:
+            cursor.execute("SELECT LAST_INSERT_ID() AS firstID, nextID FROM bluetooth_id_allocator WHERE picoType = %s;", (pico_type,))
+            row = cursor.fetchone()
+            ids.extend(range(row["firstID"], row["nextID"]))
+    return ids
+
+
+def release_bluetooth_ids(cursor, bt_ids):
+    cursor.executemany("""INSERT IGNORE INTO bluetooth_id_free (bluetoothID, picoType)
+                          SELECT %s, picoType
+                          FROM bluetooth_id_allocator
+                          WHERE %s BETWEEN firstID AND lastID;""", [(bt_id, bt_id) for bt_id in bt_ids])
+
+
+def lock_devices(cursor, pico_ids):
+    """picoID -> current row for the devices that exist, locked until commit."""
+    cursor.execute("""SELECT picoID, readablePicoID, bluetoothID, picoType
+                      FROM pico_device
+                      WHERE picoID IN """ + in_clause(pico_ids) + " FOR UPDATE;", tuple(pico_ids))
+    return {row["picoID"]: row for row in cursor.fetchall()}
+
+
+def assign_bluetooth_ids(cursor, changes):
+    """
+    Applies (picoID, current bluetoothID, current picoType, new picoType) changes to pico_device and
+    returns picoID -> bluetoothID. A device keeping its type keeps its ID; None means unassigned or
+    that the type's range is full.
+    """
+    assigned = {}
+    needed = {ENVIRONMENT_PICO_TYPE: [], BT_TRACKER_PICO_TYPE: []}
+    released = []
+    for pico_id, bt_id, old_type, new_type in changes:
+        if new_type == old_type and (bt_id is not None or new_type == UNASSIGNED_PICO_TYPE):
+            assigned[pico_id] = bt_id
+            continue
+        if bt_id is not None:
+            released.append(bt_id)
+        if new_type == UNASSIGNED_PICO_TYPE:
+            assigned[pico_id] = None
+        else:
+            needed[new_type].append(pico_id)
+
+    for pico_type, pico_ids in needed.items():
+        if pico_ids:
+            ids = allocate_bluetooth_ids(cursor, pico_type, len(pico_ids))
+            for index, pico_id in enumerate(pico_ids):
+                assigned[pico_id] = ids[index] if index < len(ids) else None
+
+    new_types = {change[0]: change[3] for change in changes}
+    # Clear first so IDs can move between devices without tripping the unique index
+    cursor.executemany("UPDATE pico_device SET bluetoothID = NULL WHERE picoID = %s;",
+                       [(pico_id,) for pico_id in assigned])
+    cursor.executemany("UPDATE pico_device SET picoType = %s, bluetoothID = %s WHERE picoID = %s;",
+                       [(new_types[pico_id], bt_id, pico_id) for pico_id, bt_id in assigned.items()])
+    # Released after allocating so this transaction never hands out an ID it just freed
+    if released:
+        release_bluetooth_ids(cursor, released)
+    return assigned
+
+
+def sync_bluetooth_allocator():
+    """Moves each counter past IDs already in pico_device, e.g. ones assigned before the allocator existed."""
+    connection = get_db_connection()
+    if connection is None:
+        return
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""UPDATE bluetooth_id_allocator
+                          SET nextID = GREATEST(nextID, (SELECT COALESCE(MAX(bluetoothID), 0) + 1
+                                                         FROM pico_device
+                                                         WHERE bluetoothID BETWEEN firstID AND lastID));""")
+        connection.commit()
+    except Error as e:
+        logger.error("Error syncing bluetooth ID allocator: %s", e)
+        connection.rollback()
+    finally:
+        cursor.close()
 
-    for pico in pico_data:
-        pico_id = pico["picoID"]
 
-        hardware_message = json.dumps({"TrackerGroup" : new_group_name})
-        client.publish("hardware_config/server_message/" + pico_id, hardware_message, qos=2)
-    
-    client.loop_stop()
-    client.disconnect()
+# -------------------------------
+# Device config snapshot
+# -------------------------------
+# /get/device/configs is served from an in-memory copy of pico_device joined with
+# bluetooth_tracker. Writes through this service mark it stale, and devices that hardware/config
+# registers on boot are picked up once the copy is older than SNAPSHOT_MAX_AGE_SECONDS. Every
+# reload is diffed against the previous copy and changed devices are stamped with a new
+# version, which is what ?since= returns.
+SNAPSHOT_MAX_AGE_SECONDS = 30
+CONFIG_PAGE_MAX = 1000
+SNAPSHOT_TOMBSTONES = 10000
+
+
+class DeviceSnapshot:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Versions start at the process start time in ms, so a version from an earlier process
+        # is always older than oldest_delta and gets a full listing
+        self.version = int(time.time() * 1000)
+        self.oldest_delta = self.version
+        self.devices = {}       # picoID -> config
+        self.order = []         # sorted picoIDs
+        self.versions = {}      # picoID -> version it last changed at
+        self.deleted = {}       # picoID -> version it was removed at
+        self.loaded_at = None
+        self.stale = True
+
+    def mark_stale(self):
+        self.stale = True
+
+    def current(self):
+        """The snapshot as a tuple of (version, devices, order, versions, deleted), reloading it if stale."""
+        with self.lock:
+            if self.stale or self.loaded_at is None or time.monotonic() - self.loaded_at > SNAPSHOT_MAX_AGE_SECONDS:
+                try:
+                    self.reload()
+                except Error as e:
+                    if self.loaded_at is None:
+                        raise
+                    logger.warning("Error reloading device snapshot, serving the previous one: %s", e)
+            return self.version, self.devices, self.order, self.versions, self.deleted
+
+    def reload(self):
+        # Own pooled connection: the calling request's may be mid-transaction
+        connection = database.checkout()
+        # Cleared before reading so a write landing during the query marks it stale again
+        self.stale = False
+        cursor = connection.cursor()
+        try:
+            cursor.execute("""SELECT pico_device.picoID, pico_device.readablePicoID, pico_device.picoType, bluetooth_tracker.trackingGroupID
+                              FROM pico_device
+                              LEFT JOIN bluetooth_tracker
+                              ON pico_device.picoID = bluetooth_tracker.picoID;""")
+            fresh = {row[0]: {"picoID" : row[0],
+                              "readablePicoID" : row[1],
+                              "picoType" : row[2],
+                              "trackingGroupID" : row[3]} for row in cursor.fetchall()}
+        except Error:
+            self.stale = True
+            raise
+        finally:
+            cursor.close()
+            connection.close()
+
+        # Replaced rather than updated in place so requests holding the old copy stay consistent
+        version = self.version + 1
+        versions = dict(self.versions)
+        deleted = dict(self.deleted)
+        changed = False
+        for pico_id, config in fresh.items():
+            if self.devices.get(pico_id) != config:
+                versions[pico_id] = version
+                deleted.pop(pico_id, None)
+                changed = True
+        for pico_id in self.devices.keys() - fresh.keys():
+            versions.pop(pico_id, None)
+            deleted[pico_id] = version
+            changed = True
+        if len(deleted) > SNAPSHOT_TOMBSTONES:
+            dropped = sorted(deleted.items(), key=lambda item: item[1])[:len(deleted) - SNAPSHOT_TOMBSTONES]
+            for pico_id, _ in dropped:
+                del deleted[pico_id]
+            self.oldest_delta = dropped[-1][1]
+
+        if changed or self.loaded_at is None:
+            self.version = version
+            self.devices = fresh
+            self.order = sorted(fresh)
+            self.versions = versions
+            self.deleted = deleted
+        self.loaded_at = time.monotonic()
+
+
+device_snapshot = DeviceSnapshot()
+
+
+def int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return int(value)
 
 
 @app.route('/get/device/configs', methods=['GET'])
 def get_configs():
+    """
+    Optional query parameters:
+      picoType, trackingGroupID (or "none"), prefix (readablePicoID prefix)  filters
+      limit, after      page size (at most CONFIG_PAGE_MAX) and the next_cursor of the previous page
+      since             only devices changed after this version, plus the picoIDs that were deleted
+                        or no longer match the filters. "full" is true when since is too old.
+    """
     cookie_validation_error = validate_session_cookie(request)
     if len(cookie_validation_error) == 2:
         return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
-    
-    connection = get_db_connection()
-    if connection is None:
-        return jsonify({"error": "MySQL connection unavailable"}), 500
 
-    cursor = connection.cursor()
     try:
-        query = """SELECT pico_device.picoID, pico_device.readablePicoID, pico_device.picoType, bluetooth_tracker.trackingGroupID
-                   FROM pico_device
-                   LEFT JOIN bluetooth_tracker
-                   ON pico_device.picoID = bluetooth_tracker.picoID;
-                """
-       
-        cursor.execute(query)
-
-        data = cursor.fetchall()
+        pico_type = int_arg("picoType")
+        group_arg = request.args.get("trackingGroupID")
+        group_id = None if group_arg in (None, "none") else int(group_arg)
+        limit = int_arg("limit")
+        since = int_arg("since")
+    except ValueError:
+        return jsonify({"error": "Invalid query", "message": "picoType, trackingGroupID, limit and since must be integers"}), 400
+    if limit is not None and not 1 <= limit <= CONFIG_PAGE_MAX:
+        return jsonify({"error": "Invalid query", "message": f"limit must be between 1 and {CONFIG_PAGE_MAX}"}), 400
+    prefix = request.args.get("prefix")
+    after = request.args.get("after")
 
-        data_to_send = []
-
-        for row in data:
-            current_config = {"picoID" : row[0],
-                              "readablePicoID" : row[1],
-                              "picoType" : row[2],
-                              "trackingGroupID" : row[3]}
-           
-            data_to_send.append(current_config)
-
-        return jsonify({"configs" : data_to_send}), 200
-    
+    try:
+        version, devices, order, versions, deleted = device_snapshot.current()
     except Error as e:
         print(f"Error querying data: {e}")
         return jsonify({"error": "Error querying data", "message": str(e)}), 500
-    finally:
-        cursor.close()
-        connection.close()
+
+    etag = f'W/"configs-{version}"'
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304, {"ETag": etag}
+
+    def matches(config):
+        return ((pico_type is None or config["picoType"] == pico_type)
+                and (group_arg is None or config["trackingGroupID"] == group_id)
+                and (prefix is None or config["readablePicoID"].startswith(prefix)))
+
+    full = since is None or since < device_snapshot.oldest_delta
+    start = 0 if after is None else bisect.bisect_right(order, after)
+    configs = []
+    next_cursor = None
+    removed = []
+    for pico_id in order[start:]:
+        if not full and versions.get(pico_id, 0) <= since:
+            continue
+        config = devices[pico_id]
+        if not matches(config):
+            if not full:
+                removed.append(pico_id)
+            continue
+        if limit is not None and len(configs) == limit:
+            next_cursor = configs[-1]["picoID"]
+            break
+        configs.append(config)
+
+    response = {"configs" : configs, "version" : version, "full" : full}
+    if next_cursor is not None:
+        response["next_cursor"] = next_cursor
+    if not full:
+        # Only sent with the first page, tombstones are not part of the cursor order
+        if after is None:
+            removed.extend(pico_id for pico_id, removed_at in deleted.items() if removed_at > since)
+        response["deleted"] = sorted(removed)
+
+    resp = make_response(jsonify(response), 200)
+    resp.headers["ETag"] = etag
+    return resp
 
 
 @app.route('/patch/device/config/<pico_id>', methods=['PATCH'])
@@ -198,55 +585,13 @@ def patch_config(pico_id = None):
             
             cursor.execute(delete_query, (pico_id,))
 
-            new_bt_id = 0
-            
-            if (data["picoType"] == UNASSIGNED_PICO_TYPE):
-                update_query = """UPDATE pico_device
-                                    SET picoType = %s, bluetoothID = NULL
-                                    WHERE picoID = %s;"""
-                
-                cursor.execute(update_query, (UNASSIGNED_PICO_TYPE, pico_id))
-
-            elif (data["picoType"] == ENVIRONMENT_PICO_TYPE):
-                select_query = """SELECT MAX(bluetoothID) AS btMax
-                                  FROM pico_device
-                                  WHERE bluetoothID < 1000;"""
-
-                cursor.execute(select_query)
-                current_bt_max = cursor.fetchone()
-                if current_bt_max["btMax"] is None:
-                    new_bt_id = 1000
-                elif current_bt_max["btMax"] == 999:
-                    new_bt_id = None
-                else:
-                    new_bt_id = current_bt_max["btMax"] + 1
-
-                update_query = """UPDATE pico_device
-                                  SET picoType = %s, bluetoothID = %s
-                                  WHERE picoID = %s;"""
-                
-                cursor.execute(update_query, (ENVIRONMENT_PICO_TYPE, new_bt_id, pico_id))
-
-                if new_bt_id is None:
-                    new_bt_id = 0
-
-            elif (data["picoType"] == BT_TRACKER_PICO_TYPE):
-                select_query = """SELECT MAX(bluetoothID) AS btMax
-                                  FROM pico_device
-                                  WHERE bluetoothID >= 1000;"""
-
-                cursor.execute(select_query)
-                current_bt_max = cursor.fetchone()
-                if current_bt_max["btMax"] is None:
-                    new_bt_id = 1000
-                else:
-                    new_bt_id = current_bt_max["btMax"] + 1
-
-                update_query = """UPDATE pico_device
-                                  SET picoType = %s, bluetoothID = %s
-                                  WHERE picoID = %s;"""
-                
-                cursor.execute(update_query, (BT_TRACKER_PICO_TYPE, new_bt_id, pico_id))
+            current = lock_devices(cursor, [pico_id]).get(pico_id)
+            if current is None:
+                connection.rollback()
+                return jsonify({"error": "Error querying data", "message": "Unknown picoID"}), 404
+
+            new_bt_ids = assign_bluetooth_ids(cursor, [(pico_id, current["bluetoothID"], current["picoType"], data["picoType"])])
+            new_bt_id = new_bt_ids[pico_id] or 0
 
             hardware_message.update({"BluetoothID" : new_bt_id})
             hardware_message.update({"PicoType" : data["picoType"]})
@@ -278,11 +623,12 @@ def patch_config(pico_id = None):
             else:
                 hardware_message.update({"TrackerGroup" : tracking_group_data["groupName"]})
 
-        send_individual_pico_message(pico_id, json.dumps(hardware_message))
-
         connection.commit()
 
-        return jsonify({"message" : "success"}), 200
+        delivery = send_individual_pico_message(pico_id, json.dumps(hardware_message))
+        invalidate_device_configs([pico_id], delivery=delivery)
+
+        return jsonify({"message" : "success", "delivered" : delivery.wait(DELIVERY_WAIT_SECONDS)}), 200
     
     except Error as e:
         print(f"Error querying data: {e}")
@@ -293,6 +639,233 @@ def patch_config(pico_id = None):
         connection.close()
 
 
+def validate_device_change(change):
+    if not isinstance(change, dict) or not isinstance(change.get("picoID"), str):
+        return "Every change needs a picoID"
+    if "readablePicoID" in change and (not isinstance(change["readablePicoID"], str) or change["readablePicoID"] == ""):
+        return "Invalid readablePicoID"
+    if "picoType" in change and (not isinstance(change["picoType"], int) or change["picoType"] < LOWEST_PICO_TYPE or change["picoType"] > HIGHEST_PICO_TYPE):
+        return "Invalid picoType"
+    if "trackingGroupID" in change and change["trackingGroupID"] is not None and not isinstance(change["trackingGroupID"], int):
+        return "Invalid trackingGroupID"
+    return None
+
+
+@app.route('/patch/device/configs', methods=['PATCH'])
+def patch_configs():
+    """
+    Bulk version of /patch/device/config/<pico_id>, applied in one transaction.
+    Body: {"changes": [{"picoID": "...", "readablePicoID": "...", "picoType": 2, "trackingGroupID": 1}, ...]}
+    A change that cannot be applied (unknown device, name in use, ...) is reported in its result and
+    skipped; the rest still go through. ?wait=true waits for the broker to confirm each device's message.
+    """
+    cookie_validation_error = validate_session_cookie(request)
+    if len(cookie_validation_error) == 2:
+        return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
+
+    data = request.json
+    changes = data.get("changes") if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not changes:
+        return jsonify({"error": "Error querying data", "message": "A list of changes must be supplied"}), 400
+    if len(changes) > BULK_MAX_DEVICES:
+        return jsonify({"error": "Error querying data", "message": f"At most {BULK_MAX_DEVICES} changes per request"}), 400
+
+    results = {}
+    requested = {}
+    for change in changes:
+        error = validate_device_change(change)
+        if error is not None:
+            if not isinstance(change, dict) or not isinstance(change.get("picoID"), str):
+                return jsonify({"error": "Error querying data", "message": error}), 400
+            results[change["picoID"]] = {"picoID" : change["picoID"], "status" : "error", "error" : error}
+        elif change["picoID"] in requested:
+            results[change["picoID"]] = {"picoID" : change["picoID"], "status" : "error", "error" : "picoID listed more than once"}
+        else:
+            requested[change["picoID"]] = change
+    for pico_id in results:
+        requested.pop(pico_id, None)
+
+    connection = get_db_connection()
+    if connection is None:
+        return jsonify({"error": "MySQL connection unavailable"}), 500
+
+    def reject(pico_id, error):
+        results[pico_id] = {"picoID" : pico_id, "status" : "error", "error" : error}
+        requested.pop(pico_id, None)
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        current = lock_devices(cursor, list(requested)) if requested else {}
+        for pico_id in [pico_id for pico_id in requested if pico_id not in current]:
+            reject(pico_id, "Unknown picoID")
+
+        # readablePicoID is unique, so check names against the table and within the request
+        renames = {pico_id: change["readablePicoID"] for pico_id, change in requested.items()
+                   if "readablePicoID" in change and change["readablePicoID"] != current[pico_id]["readablePicoID"]}
+        if renames:
+            names = list(set(renames.values()))
+            cursor.execute("SELECT picoID, readablePicoID FROM pico_device WHERE readablePicoID IN " + in_clause(names), tuple(names))
+            taken = {row["readablePicoID"] for row in cursor.fetchall()}
+            seen = set()
+            for pico_id, name in list(renames.items()):
+                if name in taken or name in seen:
+                    reject(pico_id, "readablePicoID already in use")
+                    del renames[pico_id]
+                seen.add(name)
+
+        group_ids = list({change["trackingGroupID"] for change in requested.values() if change.get("trackingGroupID") is not None})
+        group_names = {}
+        if group_ids:
+            cursor.execute("SELECT groupID, groupName FROM tracking_groups WHERE groupID IN " + in_clause(group_ids), tuple(group_ids))
+            group_names = {row["groupID"]: row["groupName"] for row in cursor.fetchall()}
+            for pico_id in [pico_id for pico_id, change in requested.items()
+                            if change.get("trackingGroupID") is not None and change["trackingGroupID"] not in group_names]:
+                reject(pico_id, "Unknown trackingGroupID")
+                renames.pop(pico_id, None)
+
+        if renames:
+            cursor.executemany("UPDATE pico_device SET readablePicoID = %s WHERE picoID = %s;",
+                               [(name, pico_id) for pico_id, name in renames.items()])
+
+        retyped = [pico_id for pico_id, change in requested.items() if "picoType" in change]
+        assigned = {}
+        if retyped:
+            cursor.executemany("DELETE FROM bluetooth_tracker WHERE picoID = %s;", [(pico_id,) for pico_id in retyped])
+            assigned = assign_bluetooth_ids(cursor, [
+                (pico_id, current[pico_id]["bluetoothID"], current[pico_id]["picoType"], requested[pico_id]["picoType"])
+                for pico_id in retyped
+            ])
+
+        regrouped = [(pico_id, change["trackingGroupID"]) for pico_id, change in requested.items() if "trackingGroupID" in change]
+        if regrouped:
+            cursor.executemany("""INSERT INTO bluetooth_tracker (picoID, trackingGroupID)
+                                  VALUES (%s, %s)
+                                  ON DUPLICATE KEY UPDATE trackingGroupID = VALUES(trackingGroupID);""", regrouped)
+
+        connection.commit()
+    except Error as e:
+        print(f"Error querying data: {e}")
+        connection.rollback()
+        return jsonify({"error": "Error querying data", "message": str(e)}), 500
+    finally:
+        cursor.close()
+        connection.close()
+
+    # Same messages patch_config would send, all queued on the shared publisher
+    deliveries = {}
+    for pico_id, change in requested.items():
+        hardware_message = {}
+        if "readablePicoID" in change:
+            hardware_message["ReadableID"] = change["readablePicoID"]
+        if "picoType" in change:
+            hardware_message["BluetoothID"] = assigned[pico_id] or 0
+            hardware_message["PicoType"] = change["picoType"]
+        if "trackingGroupID" in change:
+            hardware_message["TrackerGroup"] = group_names.get(change["trackingGroupID"], "")
+        deliveries[pico_id] = send_individual_pico_message(pico_id, json.dumps(hardware_message))
+        results[pico_id] = {"picoID" : pico_id, "status" : "updated"}
+        if pico_id in assigned:
+            results[pico_id]["bluetoothID"] = assigned[pico_id]
+    if requested:
+        invalidate_device_configs(list(requested))
+
+    if request.args.get("wait") == "true":
+        deadline = time.monotonic() + DELIVERY_WAIT_SECONDS
+        for pico_id, delivery in deliveries.items():
+            results[pico_id]["delivered"] = delivery.wait(max(0, deadline - time.monotonic()))
+
+    ordered = [results[change["picoID"]] for change in changes if change["picoID"] in results]
+    # A picoID listed twice is reported once
+    ordered = list({result["picoID"]: result for result in ordered}.values())
+    return jsonify({"message" : "success",
+                    "updated" : len(requested),
+                    "failed" : len(ordered) - len(requested),
+                    "results" : ordered}), 200
+
+
+@app.route('/provision/devices', methods=['POST'])
+def provision_devices():
+    """
+    Sets the picoType (and optionally the tracking group) of many devices in one transaction.
+    Body: {"devices": [{"picoID": "...", "picoType": 2, "trackingGroupID": 1}, ...]}
+    """
+    cookie_validation_error = validate_session_cookie(request)
+    if len(cookie_validation_error) == 2:
+        return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
+
+    data = request.json
+    devices = data.get("devices") if isinstance(data, dict) else None
+    if not isinstance(devices, list) or not devices:
+        return jsonify({"error": "Error querying data", "message": "A list of devices must be supplied"}), 400
+    if len(devices) > BULK_MAX_DEVICES:
+        return jsonify({"error": "Error querying data", "message": f"At most {BULK_MAX_DEVICES} devices per request"}), 400
+
+    requested = {}
+    for device in devices:
+        if not isinstance(device, dict) or not isinstance(device.get("picoID"), str):
+            return jsonify({"error": "Error querying data", "message": "Every device needs a picoID"}), 400
+        pico_type = device.get("picoType")
+        if not isinstance(pico_type, int) or pico_type < LOWEST_PICO_TYPE or pico_type > HIGHEST_PICO_TYPE:
+            return jsonify({"error": "Error querying data", "message": f"Invalid picoType for {device['picoID']}"}), 400
+        requested[device["picoID"]] = device
+
+    connection = get_db_connection()
+    if connection is None:
+        return jsonify({"error": "MySQL connection unavailable"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        current = {}
+        pico_ids = list(requested)
+        for i in range(0, len(pico_ids), BULK_MAX_DEVICES):
+            current.update(lock_devices(cursor, pico_ids[i:i + BULK_MAX_DEVICES]))
+        unknown = [pico_id for pico_id in pico_ids if pico_id not in current]
+        found = [pico_id for pico_id in pico_ids if pico_id in current]
+        if not found:
+            connection.rollback()
+            return jsonify({"error": "Error querying data", "message": "None of the devices exist", "unknown": unknown}), 404
+
+        assigned = assign_bluetooth_ids(cursor, [
+            (pico_id, current[pico_id]["bluetoothID"], current[pico_id]["picoType"], requested[pico_id]["picoType"])
+            for pico_id in found
+        ])
+
+        cursor.execute("DELETE FROM bluetooth_tracker WHERE picoID IN " + in_clause(found), tuple(found))
+        trackers = [(pico_id, requested[pico_id]["trackingGroupID"]) for pico_id in found
+                    if requested[pico_id]["picoType"] == BT_TRACKER_PICO_TYPE and requested[pico_id].get("trackingGroupID") is not None]
+        if trackers:
+            cursor.executemany("INSERT INTO bluetooth_tracker (picoID, trackingGroupID) VALUES (%s, %s);", trackers)
+
+        group_ids = list({group_id for _, group_id in trackers})
+        group_names = {}
+        if group_ids:
+            cursor.execute("SELECT groupID, groupName FROM tracking_groups WHERE groupID IN " + in_clause(group_ids), tuple(group_ids))
+            group_names = {row["groupID"]: row["groupName"] for row in cursor.fetchall()}
+
+        connection.commit()
+    except Error as e:
+        print(f"Error querying data: {e}")
+        connection.rollback()
+        return jsonify({"error": "Error querying data", "message": str(e)}), 500
+    finally:
+        cursor.close()
+        connection.close()
+
+    results = []
+    for pico_id in found:
+        pico_type = requested[pico_id]["picoType"]
+        group_name = group_names.get(requested[pico_id].get("trackingGroupID"), "") if pico_type == BT_TRACKER_PICO_TYPE else ""
+        hardware_message = {"ReadableID" : current[pico_id]["readablePicoID"],
+                            "BluetoothID" : assigned[pico_id] or 0,
+                            "PicoType" : pico_type,
+                            "TrackerGroup" : group_name}
+        send_individual_pico_message(pico_id, json.dumps(hardware_message))
+        results.append({"picoID" : pico_id, "bluetoothID" : assigned[pico_id], "picoType" : pico_type})
+    invalidate_device_configs(found)
+
+    return jsonify({"message" : "success", "devices" : results, "unknown" : unknown}), 200
+
+
 # MUST ONLY BE USED IN TESTING
 @app.route("/delete/device/config/<pico_id>", methods=['POST'])
 def delete_config(pico_id = None):
@@ -309,13 +882,21 @@ def delete_config(pico_id = None):
 
     cursor = connection.cursor(dictionary=True)
     try:
+        current = lock_devices(cursor, [pico_id]).get(pico_id)
+
         delete_sql = """DELETE FROM pico_device WHERE picoID = %s"""
 
         cursor.execute(delete_sql, (pico_id,))
         cursor.fetchall()
 
+        if current is not None and current["bluetoothID"] is not None:
+            release_bluetooth_ids(cursor, [current["bluetoothID"]])
+
         connection.commit()
 
+        # Wait for the broker so a device re-registering straight after is not answered from the cache
+        invalidate_device_configs([pico_id]).wait(DELIVERY_WAIT_SECONDS)
+
         return jsonify({"message" : "success"}), 200
     
     except Error as e:
@@ -453,9 +1034,10 @@ def patch_tracking_group(group_id = None):
 
         connection.commit()
 
-        sync_tracking_grp_name_with_hardware(group_id, data["groupName"])
+        invalidate_device_configs(group_id=group_id)
+        devices, _ = sync_tracking_grp_name_with_hardware(group_id, data["groupName"])
 
-        return jsonify({"message" : "success"}), 200
+        return jsonify({"message" : "success", "devices" : devices}), 200
     
     except Error as e:
         print(f"Error querying data: {e}")
@@ -481,7 +1063,7 @@ def delete_tracking_group(group_id = None):
 
     cursor = connection.cursor(dictionary=True)
     try:
-        sync_tracking_grp_name_with_hardware(group_id, "")
+        devices, _ = sync_tracking_grp_name_with_hardware(group_id, "")
 
         delete_query = """DELETE FROM tracking_groups 
                           WHERE groupID = %s;"""
@@ -491,7 +1073,9 @@ def delete_tracking_group(group_id = None):
 
         connection.commit()
 
-        return jsonify({"message" : "success"}), 200
+        invalidate_device_configs(group_id=group_id)
+
+        return jsonify({"message" : "success", "devices" : devices}), 200
     
     except Error as e:
         print(f"Error querying data: {e}")
@@ -502,6 +1086,18 @@ def delete_tracking_group(group_id = None):
         connection.close()
 
 
+@app.route('/publisher/status', methods=['GET'])
+def publisher_status():
+    cookie_validation_error = validate_session_cookie(request)
+    if len(cookie_validation_error) == 2:
+        return jsonify(cookie_validation_error[0]), cookie_validation_error[1]
+
+    return jsonify(publisher.status()), 200
+
+
 if __name__ == '__main__':
-    get_db_connection()  # Ensure the connection is established at startup
+    database.pool()  # Ensure the database is reachable at startup
+    sync_bluetooth_allocator()
+    database.discard()  # Return the startup thread's connection to the pool
+    publisher.start()
     app.run(host='0.0.0.0', port=5006)
\ No newline at end of file
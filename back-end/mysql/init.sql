@@ -15,6 +15,7 @@ CREATE TABLE IF NOT EXISTS users (
 	full_name VARCHAR(100) NOT NULL,
 	authority ENUM('Reception', 'Admin', 'Super Admin') NOT NULL DEFAULT 'Reception',
 	pass_hash CHAR(60) NOT NULL COMMENT 'BCrypt hashed',
+	pass_cost TINYINT UNSIGNED COMMENT 'BCrypt cost factor of pass_hash',
 	email VARCHAR(100) NOT NULL UNIQUE,
 	cookie CHAR(64) COMMENT 'Secure session token',
 	created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -30,6 +31,8 @@ CREATE TABLE IF NOT EXISTS messages (
 	left_message VARCHAR(1000),
 	time_sent TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 	is_read BOOLEAN DEFAULT 0,
+	INDEX idx_receiver_read (receiver_id, is_read),                 -- unread counts
+	INDEX idx_sender_receiver_time (sender_id, receiver_id, time_sent),  -- one direction of a conversation, in order
 	FOREIGN KEY (receiver_id) REFERENCES accounts.users(user_id) ON DELETE SET NULL,
 	FOREIGN KEY (sender_id) REFERENCES accounts.users(user_id) ON DELETE CASCADE
 );
@@ -45,6 +48,25 @@ CREATE TABLE IF NOT EXISTS pico_device (
 	picoType INT DEFAULT 0  -- may 0 is unassigned, 1 is environment, 2 is bluetooth tracker
 );
 
+-- Next unused bluetoothID per picoType. Environment sensors use 1-999 and trackers 1000 upwards,
+-- both capped at 65535 as the ID is broadcast as an iBeacon major
+CREATE TABLE IF NOT EXISTS bluetooth_id_allocator (
+	picoType INT PRIMARY KEY,
+	firstID INT NOT NULL,
+	lastID INT NOT NULL,
+	nextID INT NOT NULL
+);
+
+INSERT INTO bluetooth_id_allocator (picoType, firstID, lastID, nextID) VALUES (1, 1, 999, 1), (2, 1000, 65535, 1000)
+ON DUPLICATE KEY UPDATE picoType = picoType;
+
+-- bluetoothIDs given up by unassigned, retyped or deleted devices, reused before nextID
+CREATE TABLE IF NOT EXISTS bluetooth_id_free (
+	bluetoothID INT PRIMARY KEY,
+	picoType INT NOT NULL,
+	INDEX idx_free_type (picoType, bluetoothID)
+);
+
 CREATE TABLE IF NOT EXISTS tracking_groups (
 	groupID INT AUTO_INCREMENT PRIMARY KEY,
 	groupName VARCHAR(50) NOT NULL UNIQUE
@@ -63,6 +85,7 @@ CREATE TABLE IF NOT EXISTS bluetooth_tracker_data -- 1 to 1 relationship with pi
 	picoID VARCHAR(17) NOT NULL,  -- Mac addresses have a maximum length of 17 characters, storing more is unnecessary
 	roomID VARCHAR(17) NOT NULL,  -- Mac addresses have a maximum length of 17 characters, storing more is unnecessary
 	logged_at TIMESTAMP NOT NULL,
+	INDEX idx_bt_data_logged_at (logged_at),
 	FOREIGN KEY (picoID) REFERENCES pico_device(picoID) ON DELETE CASCADE
 );
 
@@ -94,10 +117,30 @@ CREATE TABLE IF NOT EXISTS presets (
 	preset_name VARCHAR(255) NOT NULL,
 	owner_id INT DEFAULT NULL,
 	image_name VARCHAR(255) DEFAULT NULL,
-	image_data LONGBLOB DEFAULT NULL,
+	image_type VARCHAR(100) DEFAULT NULL,
+	image_hash CHAR(64) DEFAULT NULL COMMENT 'SHA-256 of image_data, NULL for legacy base64 rows',
+	image_data LONGBLOB DEFAULT NULL COMMENT 'Raw image bytes',
+	image_width INT DEFAULT NULL,   -- filled in once the derivatives are built
+	image_height INT DEFAULT NULL,
 	FOREIGN KEY (owner_id) REFERENCES accounts.users(user_id) ON DELETE SET NULL
 );
 
+-- Thumbnails (kind 'thumb', level = width) and tile pyramid (kind 'tile', level = zoom) of the preset image
+CREATE TABLE IF NOT EXISTS preset_image_derivatives (
+	preset_id INT NOT NULL,
+	image_hash CHAR(64) NOT NULL,
+	kind ENUM('thumb', 'tile') NOT NULL,
+	level INT NOT NULL,
+	x INT NOT NULL DEFAULT 0,
+	y INT NOT NULL DEFAULT 0,
+	width INT NOT NULL,
+	height INT NOT NULL,
+	content_type VARCHAR(100) NOT NULL,
+	data MEDIUMBLOB NOT NULL,
+	PRIMARY KEY (preset_id, kind, level, x, y),
+	FOREIGN KEY (preset_id) REFERENCES presets(preset_id) ON DELETE CASCADE
+);
+
 CREATE TABLE IF NOT EXISTS map_blocks (
 	id INT AUTO_INCREMENT PRIMARY KEY,
 	preset_id INT NOT NULL,
@@ -136,7 +179,8 @@ CREATE TABLE IF NOT EXISTS config (
 	hero_title VARCHAR(250) NOT NULL,
 	hero_subtitle VARCHAR(250) NOT NULL,
 	image_name VARCHAR(250) NOT NULL,
-	image_data LONGBLOB DEFAULT NULL
+	image_data LONGBLOB DEFAULT NULL,
+	version INT NOT NULL DEFAULT 1  -- bumped on every front page update, readers rebuild their cached /home on change
 );
 
 CREATE TABLE IF NOT EXISTS features (
@@ -314,30 +358,33 @@ ON DUPLICATE KEY UPDATE id = 1;
 -- =============================================
 -- Microservice-specific Accounts
 -- =============================================
+-- MAX_USER_CONNECTIONS must cover the service's connection pool (shared/db.py opens all
+-- of it at startup, 10 by default) plus a little headroom for sessions the server has not
+-- yet dropped after a reconnect or restart.
 
 -- Account Registration Service (Insert only)
 CREATE USER IF NOT EXISTS 'account_registration'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'reg_password';
 GRANT INSERT ON accounts.users TO 'account_registration'@'%';
-ALTER USER 'account_registration'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'account_registration'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
 -- Account Messaging Service (Read and Write)
 CREATE USER IF NOT EXISTS 'account_messages'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'message_password';
 GRANT SELECT, INSERT, UPDATE, DELETE ON accounts.messages TO 'account_messages'@'%';
 GRANT SELECT, INSERT, UPDATE, DELETE ON accounts.users TO 'account_messages'@'%';
-ALTER USER 'account_messages'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'account_messages'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
--- Account Cookie Management Service (Update cookie + Read)
+-- Account Cookie Management Service (Update cookie, rehash on login + Read)
 CREATE USER IF NOT EXISTS 'cookie_manager'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'cookie_password';
-GRANT SELECT, UPDATE(cookie, last_login) ON accounts.users TO 'cookie_manager'@'%';
-ALTER USER 'cookie_manager'@'%' WITH MAX_USER_CONNECTIONS 1;
+GRANT SELECT, UPDATE(cookie, last_login, pass_hash, pass_cost) ON accounts.users TO 'cookie_manager'@'%';
+ALTER USER 'cookie_manager'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
 -- Data Processing Service (pico Insert)
 CREATE USER IF NOT EXISTS 'data_processor'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'process_password';
 GRANT INSERT, SELECT ON pico.* TO 'data_processor'@'%';
-ALTER USER 'data_processor'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'data_processor'@'%' WITH MAX_USER_CONNECTIONS 2;
 FLUSH PRIVILEGES;
 
 -- Data Reading Service (pico Read)
@@ -348,13 +395,13 @@ FLUSH PRIVILEGES;
 -- Hardware Activation Service (pico Read, Insert, Update and Delete)
 CREATE USER IF NOT EXISTS 'hardware_activator'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'hardware_activator_password';
 GRANT SELECT, INSERT, UPDATE, DELETE ON pico.* TO 'hardware_activator'@'%';
-ALTER USER 'hardware_activator'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'hardware_activator'@'%' WITH MAX_USER_CONNECTIONS 4;
 FLUSH PRIVILEGES;
 
 -- Hardware Activation Service (pico Read, Insert, Update and Delete)
 CREATE USER IF NOT EXISTS 'hardware_editor'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'hardware_editor_password';
 GRANT SELECT, INSERT, UPDATE, DELETE ON pico.* TO 'hardware_editor'@'%';
-ALTER USER 'hardware_editor'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'hardware_editor'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
 -- Data Deletion Service (pico Delete + Read)
@@ -366,13 +413,13 @@ FLUSH PRIVILEGES;
 -- Assets Reading Service (Read only)
 CREATE USER IF NOT EXISTS 'assets_reader'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'read_password';
 GRANT SELECT ON assets.* TO 'assets_reader'@'%';
-ALTER USER 'assets_reader'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'assets_reader'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
 -- Assets Editing Service (Full permissions)
 CREATE USER IF NOT EXISTS 'assets_editor'@'%' IDENTIFIED WITH 'caching_sha2_password' BY 'edit_password';
 GRANT SELECT, INSERT, UPDATE, DELETE ON assets.* TO 'assets_editor'@'%';
-ALTER USER 'assets_editor'@'%' WITH MAX_USER_CONNECTIONS 1;
+ALTER USER 'assets_editor'@'%' WITH MAX_USER_CONNECTIONS 12;
 FLUSH PRIVILEGES;
 
 -- warning Editing service
@@ -0,0 +1,24 @@
+"""
+The MQTT broker the services connect to, overridable so everything can run against a local
+broker (see the local-mqtt compose profile).
+
+    from shared import broker
+    broker.connect(client)                  # blocking connect, TLS if MQTT_TLS is set
+
+    broker.configure(client)                # or, for connect_async/loop_start clients
+    client.connect_async(broker.HOST, broker.PORT)
+"""
+import os
+
+HOST = os.getenv("MQTT_HOST", "mqtt.flespi.io")
+PORT = int(os.getenv("MQTT_PORT", 1883))
+TLS = os.getenv("MQTT_TLS", "false").lower() in ("1", "true", "yes")
+CA_CERTS = os.getenv("MQTT_CA_CERTS") or None
+
+def configure(client):
+    if TLS:
+        client.tls_set(ca_certs=CA_CERTS)
+
+def connect(client, keepalive=60):
+    configure(client)
+    client.connect(HOST, PORT, keepalive)
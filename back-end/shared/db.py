@@ -0,0 +1,278 @@
+"""
+Pooled MySQL access shared by the services.
+
+    from shared import db
+    database = db.Database("account_login")
+    database.init_app(app)                  # Flask: release request connections on teardown
+
+    conn = database.connection()            # this request's (or this thread's) connection
+    row = database.query_one("SELECT ... WHERE cookie = %s", (session_id,))  # prepared, retried
+
+Two ways to hold a connection:
+  connection()  Scoped. Inside a Flask request it is checked out on first use and returned
+                to the pool when the request ends; elsewhere (MQTT and worker threads) each
+                thread keeps one. close() on it is a no-op, so code written for the old
+                global connections keeps working.
+  connect()     Checked out for the caller, who must close() it, e.g. for a streamed
+                response that outlives the request.
+
+query/query_one/execute run one statement as a server-side prepared statement, cached on the
+underlying connection, so repeated hot queries skip parsing and planning. The pool therefore
+does not reset sessions on checkout (that would drop them); connections are rolled back as
+they go back to the pool instead. These helpers and run(fn) commit when they return, and
+retry on a fresh connection after a transient error (lost connection, deadlock, lock wait
+timeout), unless the caller already has a transaction open. Every statement is timed through
+shared.metrics.
+"""
+import logging
+import os
+import threading
+import time
+
+from mysql.connector import Error, errorcode, pooling
+
+from shared import metrics
+
+# Not log.setup(): that would claim the service name before the service sets it up
+logger = logging.getLogger("db")
+
+# The whole pool is opened up front, so each user's MAX_USER_CONNECTIONS in mysql/init.sql
+# has to allow it. mysql-connector caps pools at 32.
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT_SECONDS", 5))
+CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", 30))
+CONNECT_DELAY = 2
+RETRIES = 3
+RETRY_DELAY = 0.05
+TRANSIENT_ERRORS = {
+    errorcode.CR_SERVER_GONE_ERROR,     # 2006
+    errorcode.CR_SERVER_LOST,           # 2013
+    errorcode.CR_CONN_HOST_ERROR,       # 2003
+    2055,                               # lost connection to server at '...'
+    errorcode.ER_LOCK_DEADLOCK,         # 1213
+    errorcode.ER_LOCK_WAIT_TIMEOUT,     # 1205
+    errorcode.ER_UNKNOWN_STMT_HANDLER,  # 1243, prepared statement lost with its session
+}
+PREPARED_CACHE_SIZE = 64
+
+def is_transient(error):
+    return getattr(error, "errno", None) in TRANSIENT_ERRORS
+
+def raw_connection(connection):
+    """The MySQLConnection under any TimedConnection/pool wrappers, which owns the prepared statements."""
+    while isinstance(connection, metrics.TimedConnection):
+        connection = connection.connection
+    return getattr(connection, "_cnx", connection)
+
+def forget_prepared(connection):
+    """Drops the cached prepared statements, which do not survive a reconnect."""
+    raw = raw_connection(connection)
+    cache = getattr(raw, "prepared_statements", None) or {}
+    raw.prepared_statements = {}
+    for cursor in cache.values():
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+class PooledConnection(metrics.TimedConnection):
+    """A checked out connection. Sessions are not reset by the pool, so close() rolls back
+    first rather than handing the next borrower an open transaction and its stale snapshot."""
+    def close(self):
+        try:
+            self.connection.rollback()
+        except Error:
+            pass
+        finally:
+            self.connection.close()
+
+class ScopedConnection(PooledConnection):
+    """A pooled connection lent to a request or thread; the Database decides when it goes back."""
+    def close(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+    def release(self):
+        PooledConnection.close(self)
+
+class Database:
+    def __init__(self, name, database=None, pool_size=POOL_SIZE):
+        self.name = name
+        self.database = database or os.getenv("DB_NAME")
+        self.pool_size = pool_size
+        self.connection_pool = None
+        self.pool_lock = threading.Lock()
+        self.local = threading.local()
+
+    # -------------------------------
+    # Connections
+    # -------------------------------
+    def pool(self):
+        with self.pool_lock:
+            attempt = 0
+            while self.connection_pool is None:
+                try:
+                    self.connection_pool = metrics.watch_pool(pooling.MySQLConnectionPool(
+                        pool_name=self.name,
+                        pool_size=self.pool_size,
+                        pool_reset_session=False,
+                        host=os.getenv("DB_HOST"),
+                        user=os.getenv("DB_USER"),
+                        password=os.getenv("DB_PASSWORD"),
+                        database=self.database,
+                    ))
+                except Error as e:
+                    attempt += 1
+                    logger.error("Error creating connection pool (attempt %s/%s): %s", attempt, CONNECT_RETRIES, e,
+                                 extra={"pool": self.name})
+                    if attempt >= CONNECT_RETRIES:
+                        raise
+                    time.sleep(CONNECT_DELAY)
+            return self.connection_pool
+
+    def checkout(self):
+        """A pooled connection, waiting up to POOL_WAIT_SECONDS when all of them are lent out."""
+        pool = self.pool()
+        connection = PooledConnection(metrics.pooled_connection(pool, POOL_WAIT_SECONDS, pooling.PoolError).connection)
+        if not connection.is_connected():
+            forget_prepared(connection)
+            try:
+                connection.reconnect(attempts=2, delay=0.1)
+            except Error:
+                connection.connection.close()
+                raise
+        return connection
+
+    def connect(self):
+        """A connection for the caller to close(), or None if the database is unavailable."""
+        try:
+            return self.checkout()
+        except Error as e:
+            logger.error("Error getting connection from pool: %s", e, extra={"pool": self.name})
+            return None
+
+    def scope(self):
+        """Where the scoped connection lives: flask.g inside a request, else a thread-local."""
+        try:
+            from flask import g, has_app_context
+        except ImportError:
+            return self.local
+        return g if has_app_context() else self.local
+
+    def connection(self):
+        """This request's or thread's connection, or None if the database is unavailable."""
+        scope = self.scope()
+        connection = getattr(scope, "db_connection", None)
+        if connection is not None:
+            try:
+                if connection.is_connected():
+                    return connection
+            except Error:
+                pass
+            self.discard(scope)
+        try:
+            connection = ScopedConnection(self.checkout().connection)
+        except Error as e:
+            logger.error("Error getting connection from pool: %s", e, extra={"pool": self.name})
+            return None
+        scope.db_connection = connection
+        return connection
+
+    def discard(self, scope=None):
+        """Returns the scoped connection to the pool, e.g. after it failed."""
+        scope = scope or self.scope()
+        connection = getattr(scope, "db_connection", None)
+        scope.db_connection = None
+        if connection is not None:
+            try:
+                connection.release()
+            except Error:
+                pass
+
+    def init_app(self, app):
+        @app.teardown_appcontext
+        def release_db_connection(exception=None):
+            from flask import g
+            if getattr(g, "db_connection", None) is not None:
+                self.discard(g)
+
+    # -------------------------------
+    # Statements
+    # -------------------------------
+    def prepared(self, connection, sql):
+        """A cursor holding `sql` prepared on the server, cached on the underlying connection. Do not close it."""
+        raw = raw_connection(connection)
+        cache = getattr(raw, "prepared_statements", None)
+        if cache is None:
+            cache = raw.prepared_statements = {}
+        cursor = cache.get(sql)
+        if cursor is None:
+            if len(cache) >= PREPARED_CACHE_SIZE:
+                cache.pop(next(iter(cache))).close()
+            cursor = cache[sql] = raw.cursor(prepared=True)
+        return metrics.TimedCursor(cursor)
+
+    def run(self, fn, retries=RETRIES):
+        """
+        fn(connection) on the scoped connection as one transaction: committed when it returns,
+        rolled back and retried on a fresh connection after a transient error. If the caller
+        already has a transaction open on that connection, fn joins it instead and committing,
+        rolling back and retrying are left to the caller.
+        """
+        for attempt in range(retries + 1):
+            connection = self.connection()
+            if connection is None:
+                raise Error("MySQL connection unavailable")
+            if connection.in_transaction:
+                return fn(connection)
+            try:
+                result = fn(connection)
+                connection.commit()  # also ends a read, so the next one sees new rows
+                return result
+            except Error as e:
+                try:
+                    connection.rollback()
+                except Error:
+                    pass
+                if not is_transient(e) or attempt == retries:
+                    raise
+                forget_prepared(connection)
+                logger.warning("Retrying after transient error: %s", e, extra={"pool": self.name})
+                self.discard()
+                time.sleep(RETRY_DELAY * (2 ** attempt))
+
+    def query(self, sql, params=(), dictionary=False):
+        def fetch(connection):
+            cursor = self.prepared(connection, sql)
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            if dictionary:
+                columns = cursor.column_names
+                return [dict(zip(columns, row)) for row in rows]
+            return rows
+        return self.run(fetch)
+
+    def query_one(self, sql, params=(), dictionary=False):
+        rows = self.query(sql, params, dictionary)
+        return rows[0] if rows else None
+
+    def execute(self, sql, params=()):
+        """Runs one statement; returns (rowcount, lastrowid)."""
+        def write(connection):
+            cursor = self.prepared(connection, sql)
+            cursor.execute(sql, params)
+            return cursor.rowcount, cursor.lastrowid
+        return self.run(write)
+
+    def executemany(self, sql, rows):
+        """Runs a batch on a regular cursor, which rewrites an INSERT into one multi-row statement."""
+        def write(connection):
+            cursor = connection.cursor()
+            try:
+                cursor.executemany(sql, rows)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+        return self.run(write)
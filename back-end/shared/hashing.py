@@ -0,0 +1,76 @@
+"""
+bcrypt for the account services (login, registration and messages).
+
+    from shared import hashing
+    pass_hash = hashing.run(hashing.bcrypt_hash, password, hashing.BCRYPT_TARGET_COST)
+
+bcrypt is CPU bound, so hashes and checks run in a small process pool instead of on the
+request threads. At most HASH_BACKLOG jobs may be waiting on the pool; beyond that run()
+raises HashingBusy and the request should be refused with busy_response() rather than
+queueing without bound. Services call start() before Flask starts its threads, so the
+workers are forked from a single-threaded process.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+BCRYPT_TARGET_COST = int(os.getenv("BCRYPT_TARGET_COST", 12))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", 2))
+HASH_BACKLOG = int(os.getenv("HASH_BACKLOG", HASH_WORKERS * 8))
+HASH_WAIT_SECONDS = 5
+
+hash_pool = None
+hash_pool_lock = threading.Lock()
+hash_slots = threading.BoundedSemaphore(HASH_BACKLOG)
+
+class HashingBusy(Exception):
+    pass
+
+def bcrypt_hash(password, cost):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(cost)).decode("utf-8")
+
+def bcrypt_check(password, pass_hash):
+    return bcrypt.checkpw(password.encode("utf-8"), pass_hash.encode("utf-8"))
+
+def bcrypt_cost(pass_hash):
+    # $2b$12$<salt+hash>
+    try:
+        return int(pass_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+def get_pool():
+    global hash_pool
+    with hash_pool_lock:
+        if hash_pool is None:
+            hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return hash_pool
+
+def start():
+    get_pool().submit(int).result()
+
+def run(fn, *args):
+    """fn(*args) in the hashing pool; raises HashingBusy if the backlog is full or a worker died."""
+    global hash_pool
+    if not hash_slots.acquire(timeout=HASH_WAIT_SECONDS):
+        raise HashingBusy()
+    try:
+        pool = get_pool()
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM killed); start a fresh pool for the next request
+        with hash_pool_lock:
+            if hash_pool is pool:
+                hash_pool = None
+        raise HashingBusy()
+    finally:
+        hash_slots.release()
+
+def busy_response(error="Password hashing busy, try again shortly"):
+    from flask import jsonify, make_response
+    response = make_response(jsonify({"error": error}), 503)
+    response.headers["Retry-After"] = "1"
+    return response
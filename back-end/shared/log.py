@@ -0,0 +1,162 @@
+"""
+Structured, non-blocking logging shared by the services.
+
+    from shared import log
+    logger = log.setup("data_processor")
+    logger.info("stored reading", extra={"pico": pico_id})
+    logger.debug("message received", extra={"topic": topic, "sample": 0.01})
+
+Records are put on a bounded in-memory queue and written to stdout by a background thread,
+so a slow or blocked stdout never holds up a request or MQTT thread. When the queue is full
+records are dropped and counted rather than waited on.
+
+On the calling thread, before anything is queued:
+  level       LOG_LEVEL (default INFO)
+  sampling    extra={"sample": 0.01} keeps roughly 1 in 100 of that call's records
+  rate limit  each call site (logger, level, source file and line) may log LOG_RATE_LIMIT
+              records per LOG_RATE_WINDOW seconds; the rest are counted and the next record that
+              gets through carries "suppressed": n
+
+Output is one JSON object per line (LOG_FORMAT=json, the default) or plain text (LOG_FORMAT=text).
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 20))
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", 10))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+TRACEBACKS = logging.Formatter()
+
+# LogRecord attributes that are not user supplied extras
+RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample", "suppressed"}
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        rate = getattr(record, "sample", None)
+        return rate is None or random.random() < rate
+
+class RateLimitFilter(logging.Filter):
+    """Allows `limit` records per call site per `window` seconds."""
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.sites = {}  # key -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if self.limit <= 0:
+            return True
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                suppressed = site[2] if site else 0
+                site = self.sites[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if site[1] >= self.limit:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "service": SERVICE,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if getattr(record, "suppressed", None):
+            entry["suppressed"] = record.suppressed
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{record.levelname:<7} {record.name}: {record.getMessage()}"
+        extras = {key: value for key, value in vars(record).items() if key not in RESERVED and not key.startswith("_")}
+        if extras:
+            line += " " + " ".join(f"{key}={value}" for key, value in extras.items())
+        if getattr(record, "suppressed", None):
+            line += f" (suppressed {record.suppressed})"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records instead of raising when the queue is full."""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Resolves the message while its arguments are current and keeps the traceback as text
+        in exc_text. The base class would fold the traceback into the message and clear
+        exc_info, so the formatters on the listener thread never saw it.
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = TRACEBACKS.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+SERVICE = "unknown"
+listener = None
+handler = None
+setup_lock = threading.Lock()
+
+def setup(service):
+    """Configures the root logger once for this process and returns the service's logger."""
+    global SERVICE, listener, handler
+    with setup_lock:
+        if listener is None:
+            SERVICE = os.getenv("SERVICE_NAME", service)
+            output = logging.StreamHandler(sys.stdout)
+            output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+            handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+            handler.addFilter(SamplingFilter())
+            handler.addFilter(RateLimitFilter())
+
+            root = logging.getLogger()
+            root.handlers = [handler]
+            root.setLevel(LOG_LEVEL)
+            listener = logging.handlers.QueueListener(handler.queue, output)
+            listener.start()
+            atexit.register(listener.stop)
+    return logging.getLogger(service)
+
+def dropped():
+    """Records lost to a full queue since startup."""
+    return handler.dropped if handler else 0
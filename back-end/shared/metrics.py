@@ -0,0 +1,433 @@
+"""
+Prometheus-style metrics and trace IDs shared by every service.
+
+Flask services call instrument_flask(app), which times every route and adds GET /metrics.
+MQTT workers call instrument_mqtt_client(client) and serve_metrics(), which serves the same
+text on METRICS_PORT. Database connections wrapped with timed_connection() (or taken through
+pooled_connection()) time every statement.
+
+Trace IDs travel in the X-Trace-Id header. A request keeps the ID it arrived with, so the
+validate_cookie hop to account_login shares its caller's ID, and every response carries it.
+With TRACE_SPANS=1 each request and span() is also printed as one JSON line.
+
+There is no client library dependency; the three metric types below are all the services need.
+"""
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICE = os.getenv("SERVICE_NAME", "unknown")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+TRACE_SPANS = os.getenv("TRACE_SPANS", "false").lower() in ("1", "true", "yes")
+TRACE_HEADER = "X-Trace-Id"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MAX_SERIES = 500                # label combinations per metric before new ones are folded into "other"
+STATEMENT_LABEL_LENGTH = 120
+
+# -------------------------------
+# Metric types
+# -------------------------------
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        key = tuple(str(label) for label in labels)
+        if key not in self.values and len(self.values) >= MAX_SERIES:
+            key = ("other",) * len(self.labelnames)
+        return key
+
+    def named(self, key, extra=()):
+        return (("service", SERVICE),) + tuple(zip(self.labelnames, key)) + tuple(extra)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [("", self.named(key), value) for key, value in self.values.items()]
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.functions = {}
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, fn, *labels):
+        """Reads the value from fn() at scrape time, e.g. a queue's qsize."""
+        with self.lock:
+            self.functions[self.key(labels)] = fn
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        return [("", self.named(key), value) for key, value in values.items()]
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            key = self.key(labels)
+            series = self.values.get(key)
+            if series is None:
+                # per-bucket counts (not cumulative), then sum and count
+                series = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(series) for key, series in self.values.items()}
+        samples = []
+        for key, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append(("_bucket", self.named(key, [("le", format_value(float(bound)))]), cumulative))
+            samples.append(("_bucket", self.named(key, [("le", "+Inf")]), series[-1]))
+            samples.append(("_sum", self.named(key), series[-2]))
+            samples.append(("_count", self.named(key), series[-1]))
+        return samples
+
+def render():
+    return registry.render()
+
+# -------------------------------
+# Standard metrics
+# -------------------------------
+HTTP_REQUESTS = Histogram("http_request_duration_seconds", "Time to produce a response, by route",
+                          ["method", "route", "status"])
+DB_STATEMENTS = Histogram("db_statement_duration_seconds", "Time spent in cursor.execute/executemany, by statement",
+                          ["statement"])
+DB_ERRORS = Counter("db_statement_errors_total", "Statements that raised, by statement", ["statement"])
+DB_POOL_WAIT = Histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection", ["pool"])
+DB_POOL_IN_USE = Gauge("db_pool_connections_in_use", "Pooled connections currently checked out", ["pool"])
+DB_POOL_EXHAUSTED = Counter("db_pool_exhausted_total", "Checkouts that gave up waiting for a pooled connection", ["pool"])
+MQTT_MESSAGES = Counter("mqtt_messages_total", "MQTT messages by direction and topic pattern", ["direction", "topic"])
+MQTT_HANDLER = Histogram("mqtt_handler_duration_seconds", "Time spent in on_message, by topic pattern", ["topic"])
+QUEUE_DEPTH = Gauge("queue_depth", "Items waiting in an in-process queue", ["queue"])
+SPANS = Histogram("span_duration_seconds", "Duration of named spans", ["span"])
+
+def set_service(name):
+    """Labels everything this process reports; SERVICE_NAME in the environment wins."""
+    global SERVICE
+    SERVICE = os.getenv("SERVICE_NAME", name)
+
+# -------------------------------
+# Tracing
+# -------------------------------
+context = threading.local()
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+def trace_id():
+    """The current thread's trace ID, starting a new trace if there is none."""
+    current = getattr(context, "trace_id", None)
+    if current is None:
+        current = context.trace_id = new_trace_id()
+    return current
+
+def set_trace_id(value=None):
+    context.trace_id = value or new_trace_id()
+    return context.trace_id
+
+def trace_headers():
+    """Headers that carry the current trace to another service."""
+    return {TRACE_HEADER: trace_id()}
+
+def emit_span(name, seconds, **fields):
+    if TRACE_SPANS:
+        print(json.dumps({"trace": trace_id(), "service": SERVICE, "span": name,
+                          "ms": round(seconds * 1000, 2), **fields}), flush=True)
+
+@contextmanager
+def span(name, **fields):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        SPANS.observe(seconds, name)
+        emit_span(name, seconds, **fields)
+
+# -------------------------------
+# Flask
+# -------------------------------
+def instrument_flask(app, service):
+    """Times every request by route, propagates X-Trace-Id and adds GET /metrics."""
+    from flask import Response, g, request
+
+    set_service(service)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        set_trace_id(request.headers.get(TRACE_HEADER))
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            seconds = time.perf_counter() - started
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUESTS.observe(seconds, request.method, route, response.status_code)
+            emit_span(f"{request.method} {route}", seconds, status=response.status_code)
+        response.headers[TRACE_HEADER] = trace_id()
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render(), mimetype=CONTENT_TYPE)
+
+    return app
+
+# -------------------------------
+# Standalone /metrics for MQTT workers
+# -------------------------------
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(service, port=None):
+    """Serves /metrics from a daemon thread."""
+    set_service(service)
+    server = ThreadingHTTPServer(("0.0.0.0", port or METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -------------------------------
+# MQTT
+# -------------------------------
+def topic_pattern(topic):
+    """Replaces device/rule ID levels (anything containing a digit) with + to keep label counts bounded."""
+    return "/".join("+" if any(c.isdigit() for c in level) else level for level in topic.split("/"))
+
+def instrument_mqtt_client(client):
+    """Counts messages in and out by topic pattern and times on_message. Call after setting on_message."""
+    handler = client.on_message
+    publish = client.publish
+
+    def on_message(client, user_data, message):
+        topic = topic_pattern(message.topic)
+        MQTT_MESSAGES.inc("received", topic)
+        set_trace_id()
+        with MQTT_HANDLER.time(topic):
+            handler(client, user_data, message)
+
+    def counted_publish(topic, *args, **kwargs):
+        MQTT_MESSAGES.inc("published", topic_pattern(topic))
+        return publish(topic, *args, **kwargs)
+
+    if handler is not None:
+        client.on_message = on_message
+    client.publish = counted_publish
+    return client
+
+# -------------------------------
+# Database
+# -------------------------------
+PLACEHOLDER_LIST = re.compile(r"(%s|\?)(?:\s*,\s*(?:%s|\?))+")
+ROW_LIST = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+NUMBER = re.compile(r"\b\d+\b")
+
+def statement_name(sql):
+    """A bounded label for a statement: literals and placeholder lists collapsed, then truncated."""
+    if isinstance(sql, (bytes, bytearray)):
+        sql = sql.decode("utf-8", errors="ignore")
+    sql = " ".join(sql.split())
+    sql = NUMBER.sub("?", sql)
+    sql = PLACEHOLDER_LIST.sub(r"\1, ...", sql)
+    sql = ROW_LIST.sub(r"\1, ...", sql)
+    return sql[:STATEMENT_LABEL_LENGTH]
+
+class TimedCursor:
+    """Wraps a mysql-connector cursor so execute and executemany are timed per statement."""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def timed(self, method, operation, *args, **kwargs):
+        name = statement_name(operation)
+        started = time.perf_counter()
+        try:
+            return method(operation, *args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(name)
+            raise
+        finally:
+            DB_STATEMENTS.observe(time.perf_counter() - started, name)
+
+    def execute(self, operation, *args, **kwargs):
+        return self.timed(self.cursor.execute, operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self.timed(self.cursor.executemany, operation, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class TimedConnection:
+    """Wraps a connection so every cursor it hands out is a TimedCursor."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.connection.cursor(*args, **kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.connection.close()
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __setattr__(self, name, value):
+        if name == "connection":
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.connection, name, value)
+
+def timed_connection(connection):
+    if connection is None or isinstance(connection, TimedConnection):
+        return connection
+    return TimedConnection(connection)
+
+def watch_pool(pool):
+    """Reports how many of a mysql-connector pool's connections are checked out."""
+    idle = getattr(pool, "_cnx_queue", None)
+    if idle is not None:
+        DB_POOL_IN_USE.set_function(lambda: pool.pool_size - idle.qsize(), pool.pool_name)
+    return pool
+
+def pooled_connection(pool, wait_seconds=0, exhausted=Exception):
+    """
+    pool.get_connection(), timed and wrapped. While it raises `exhausted` (mysql-connector's
+    PoolError) it is retried with backoff for up to wait_seconds, then the error is raised.
+    The whole wait is one observation, and a checkout that gives up counts once as exhausted.
+    """
+    started = time.perf_counter()
+    deadline = time.monotonic() + wait_seconds
+    delay = 0.005
+    try:
+        while True:
+            try:
+                return TimedConnection(pool.get_connection())
+            except exhausted:
+                if time.monotonic() >= deadline:
+                    DB_POOL_EXHAUSTED.inc(pool.pool_name)
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+    finally:
+        DB_POOL_WAIT.observe(time.perf_counter() - started, pool.pool_name)
+
+def track_queue(name, queue):
+    QUEUE_DEPTH.set_function(queue.qsize, name)
+    return queue
@@ -0,0 +1,46 @@
+"""
+HTTP caching and compression for the Flask read services.
+
+    from shared import responses
+    responses.init_app(app)                     # ETag/304 and gzip on every GET
+
+Buffered 200 responses to GET get a weak content-hash ETag, so a client revalidating with
+If-None-Match gets a 304 instead of the body, and are gzipped when the client accepts it and
+the body is large enough to be worth it. Streamed responses are left alone; they set their
+own headers. With revalidate=True, responses without a max-age are also marked no-cache
+(and private when the request carried a session cookie), so the browser always asks first.
+"""
+import gzip
+
+COMPRESS_MIN_BYTES = 500
+COMPRESS_LEVEL = 6
+
+def compress_response(response):
+    from flask import request
+    response.vary.add("Accept-Encoding")
+    if "gzip" not in request.headers.get("Accept-Encoding", "").lower() or response.content_encoding:
+        return
+    if response.mimetype.startswith("image/"):  # already compressed
+        return
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.content_encoding = "gzip"
+
+def init_app(app, revalidate=False):
+    from flask import request
+
+    @app.after_request
+    def conditional_response(response):
+        if request.method != "GET" or response.status_code != 200 or response.is_streamed:
+            return response
+        if revalidate and not response.cache_control.max_age:
+            response.cache_control.no_cache = True
+            if request.cookies.get("session_id"):
+                response.cache_control.private = True
+        response.add_etag(weak=True)
+        response.make_conditional(request)
+        if response.status_code == 200:
+            compress_response(response)
+        return response
@@ -0,0 +1,74 @@
+"""
+Compact binary encoding for the PicoData messages on feeds/hardware-data/<picoID>.
+
+A device keeps sending JSON until it negotiates the binary format on boot:
+
+    hardware_config/hardware_message/<picoID>   {"PicoID": "...", "PayloadFormats": [0, 1]}
+    hardware_config/server_message/<picoID>     {..., "PayloadFormat": 1}
+
+Devices that do not send PayloadFormats get the same reply as before and stay on JSON.
+
+Version 1 layout, little-endian, with no padding:
+
+    offset  size  field
+    0       1     version (1)
+    1       1     PicoType
+    2       2     RoomID (the bluetooth ID, uint16 as on the devices)
+    4       24    environment sensors only (PicoType 1): six float32 in the order of the JSON
+                  Data string (sound, light, temperature, IAQ, pressure, humidity)
+
+The PicoID is not repeated in the payload, it is the last level of the topic. A tracker
+message is 4 bytes and an environment message 28, against roughly 65 and 100 for JSON.
+
+JSON payloads start with "{" or whitespace, so a first byte below 0x20 that is not
+whitespace marks a binary payload and gives its version.
+
+decode() unpacks the fields in place from the payload buffer with struct.unpack_from, so
+nothing is copied, decoded to text, parsed or split on the way.
+"""
+import struct
+
+JSON_FORMAT = 0
+BINARY_FORMAT = 1
+SUPPORTED_FORMATS = (JSON_FORMAT, BINARY_FORMAT)
+
+VERSION = 1
+ENVIRONMENT_PICO_TYPE = 1
+HEADER = struct.Struct("<BBH")
+ENVIRONMENT = struct.Struct("<6f")
+ENVIRONMENT_FIELDS = ("sound", "light", "temperature", "IAQ", "pressure", "humidity")
+JSON_START = b"{ \t\r\n"
+
+def negotiate(advertised):
+    """The newest format both sides support, JSON if the device advertised nothing usable."""
+    common = [fmt for fmt in advertised or () if fmt in SUPPORTED_FORMATS]
+    return max(common) if common else JSON_FORMAT
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] < 0x20 and payload[0] not in JSON_START
+
+def encode(pico_type, room_id, values=None):
+    """The version 1 payload; `values` are the six environment readings for PicoType 1."""
+    header = HEADER.pack(VERSION, pico_type, room_id)
+    if pico_type == ENVIRONMENT_PICO_TYPE:
+        return header + ENVIRONMENT.pack(*values)
+    return header
+
+def decode(payload):
+    """
+    (PicoType, RoomID, readings) from a binary payload, where readings is the tuple of six
+    environment values or None for other devices. Raises ValueError if it is malformed.
+    """
+    try:
+        version, pico_type, room_id = HEADER.unpack_from(payload)
+        if version != VERSION:
+            raise ValueError(f"unsupported payload version {version}")
+        if pico_type == ENVIRONMENT_PICO_TYPE:
+            return pico_type, room_id, ENVIRONMENT.unpack_from(payload, HEADER.size)
+        return pico_type, room_id, None
+    except struct.error as e:
+        raise ValueError(f"truncated payload: {e}") from None
+
+def pico_id(topic):
+    """The device ID from a feeds/hardware-data/<picoID> topic."""
+    return topic.rsplit("/", 1)[-1]
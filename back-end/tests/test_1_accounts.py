@@ -2,11 +2,14 @@ import requests
 import unittest
 import random
 import string
+import threading
+import time
 
 class TestAccounts(unittest.TestCase):
     # Use container names
     BASE_URL_REGISTRATION = "http://account_registration:5001"
     BASE_URL_LOGIN = "http://account_login:5002"
+    BASE_URL_MESSAGES = "http://account_messages:5007"
 
     @classmethod
     def setUpClass(cls):
@@ -132,5 +135,131 @@ class TestAccounts(unittest.TestCase):
         self.assertIn("users", get_users_response.json())
         self.assertIsInstance(get_users_response.json().get("users"), list)
 
+    def _register_and_login(self, email):
+        requests.post(f"{self.BASE_URL_REGISTRATION}/register", headers={
+            'name': self.full_name,
+            'email': email,
+            'password': self.password,
+            'bypass': 'yes'
+        })
+        login_response = requests.post(f"{self.BASE_URL_LOGIN}/login", headers={
+            'email': email,
+            'password': self.password
+        })
+        self.assertEqual(login_response.status_code, 200)
+        return login_response.cookies.get('session_id')
+
+    def test_8_conversations_and_paging(self):
+        sender_email = f"test{self._generate_random_string()}@fakecompany.co.uk"
+        receiver_email = f"test{self._generate_random_string()}@fakecompany.co.uk"
+        sender = self._register_and_login(sender_email)
+        receiver = self._register_and_login(receiver_email)
+
+        for i in range(5):
+            response = requests.post(f"{self.BASE_URL_MESSAGES}/send_message", headers={'session-id': sender},
+                                     json={'receiver_email': receiver_email, 'message': f"message {i}"})
+            self.assertEqual(response.status_code, 200)
+
+        # One conversation row with the last message and all five unread
+        conversations = requests.get(f"{self.BASE_URL_MESSAGES}/conversations", headers={'session-id': receiver}).json()
+        self.assertEqual(len(conversations["conversations"]), 1)
+        conversation = conversations["conversations"][0]
+        self.assertEqual(conversation["other_user_email"], sender_email)
+        self.assertEqual(conversation["left_message"], "message 4")
+        self.assertEqual(conversation["unread_count"], 5)
+        self.assertFalse(conversation["sent_by_me"])
+
+        # Walk the thread two at a time, newest page first, oldest first within a page
+        seen = []
+        params = {'user_email': sender_email, 'limit': 2}
+        while True:
+            page = requests.get(f"{self.BASE_URL_MESSAGES}/get_chat_messages", headers={'session-id': receiver},
+                                params=params).json()
+            seen = [message["left_message"] for message in page["messages"]] + seen
+            if "next_cursor" not in page:
+                break
+            params.update(page["next_cursor"])
+        self.assertEqual(seen, [f"message {i}" for i in range(5)])
+
+        conversations = requests.get(f"{self.BASE_URL_MESSAGES}/conversations", headers={'session-id': receiver}).json()
+        self.assertEqual(conversations["conversations"][0]["unread_count"], 0, "Opening the chat should mark it read")
+
+    def test_9_unread_long_poll(self):
+        sender_email = f"test{self._generate_random_string()}@fakecompany.co.uk"
+        receiver_email = f"test{self._generate_random_string()}@fakecompany.co.uk"
+        sender = self._register_and_login(sender_email)
+        receiver = self._register_and_login(receiver_email)
+
+        current = requests.get(f"{self.BASE_URL_MESSAGES}/unread_messages_count", headers={'session-id': receiver}).json()
+        self.assertEqual(current["unread_messages_count"], 0)
+
+        # Nothing changes, so the long-poll runs out with the same version
+        started = time.monotonic()
+        idle = requests.get(f"{self.BASE_URL_MESSAGES}/unread_messages_count/wait", headers={'session-id': receiver},
+                            params={'since': current["version"], 'timeout': 1}).json()
+        self.assertGreaterEqual(time.monotonic() - started, 1)
+        self.assertEqual(idle["version"], current["version"])
+
+        # A message sent while waiting wakes the poll straight away
+        sender_thread = threading.Timer(0.5, lambda: requests.post(
+            f"{self.BASE_URL_MESSAGES}/send_message", headers={'session-id': sender},
+            json={'receiver_email': receiver_email, 'message': "wake up"}))
+        sender_thread.start()
+        started = time.monotonic()
+        woken = requests.get(f"{self.BASE_URL_MESSAGES}/unread_messages_count/wait", headers={'session-id': receiver},
+                             params={'since': current["version"], 'timeout': 20}).json()
+        sender_thread.join()
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertEqual(woken["unread_messages_count"], 1)
+        self.assertGreater(woken["version"], current["version"])
+
+    def test_10_concurrent_login_limit(self):
+        # A burst from one address is capped per IP; the extra attempts are refused, not queued
+        statuses = []
+        def attempt():
+            statuses.append(requests.post(f"{self.BASE_URL_LOGIN}/login", headers={
+                'email': self.email,
+                'password': self.wrong_password
+            }).status_code)
+        threads = [threading.Thread(target=attempt) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(set(statuses) <= {401, 429, 503}, statuses)
+        self.assertIn(429, statuses)
+
+        # Once the burst is over the address can log in again
+        login_response = requests.post(f"{self.BASE_URL_LOGIN}/login", headers={
+            'email': self.email,
+            'password': self.password
+        })
+        self.assertEqual(login_response.status_code, 200)
+
+    def test_11_long_polls_do_not_hold_connections(self):
+        # More waiters than the service has pooled connections (DB_POOL_SIZE, 10)
+        waiters = [self._register_and_login(f"test{self._generate_random_string()}@fakecompany.co.uk")
+                   for _ in range(12)]
+        statuses = []
+        def wait(session_id):
+            current = requests.get(f"{self.BASE_URL_MESSAGES}/unread_messages_count", headers={'session-id': session_id}).json()
+            statuses.append(requests.get(f"{self.BASE_URL_MESSAGES}/unread_messages_count/wait",
+                                         headers={'session-id': session_id},
+                                         params={'since': current["version"], 'timeout': 8}).status_code)
+        threads = [threading.Thread(target=wait, args=(session_id,)) for session_id in waiters]
+        for thread in threads:
+            thread.start()
+        time.sleep(2)  # let every waiter reach the wait
+
+        # The other endpoints still get a connection while all of them wait
+        started = time.monotonic()
+        messages = requests.get(f"{self.BASE_URL_MESSAGES}/get_messages", headers={'session-id': waiters[0]})
+        self.assertEqual(messages.status_code, 200)
+        self.assertLess(time.monotonic() - started, 2)
+
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses, [200] * len(waiters))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -2,6 +2,11 @@ import unittest
 import requests
 import random
 import string
+import base64
+import hashlib
+import struct
+import time
+import zlib
 
 BASE_URL_EDITOR = "http://assets_editor:5011"
 BASE_URL_READER = "http://assets_reader:5010"
@@ -132,6 +137,16 @@ class TestAssets(unittest.TestCase):
             return response.json().get("default")
         return None
 
+    def make_png(self, width, height):
+        """A solid colour RGB PNG, so the test container doesn't need an imaging library."""
+        def chunk(kind, body):
+            return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+        raw = b"".join(b"\x00" + b"\x20\x60\xa0" * width for _ in range(height))
+        return (b"\x89PNG\r\n\x1a\n"
+                + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+                + chunk(b"IDAT", zlib.compress(raw))
+                + chunk(b"IEND", b""))
+
     def generate_random_name(self, length=10):
         letters = string.ascii_letters
         return ''.join(random.choice(letters) for i in range(length))
@@ -250,7 +265,20 @@ class TestAssets(unittest.TestCase):
         data = response.json()
         self.assertIn("image", data, msg="Preset details missing image after upload")
         self.assertEqual(data["image"].get("name"), "background.png", msg="Image name mismatch")
-        self.assertEqual(data["image"].get("data"), dummy_image_data, msg="Image data mismatch")
+        self.assertNotIn("data", data["image"], msg="Preset details should not embed the image")
+        self.assertEqual(data["image"].get("hash"), hashlib.sha256(base64.b64decode(dummy_image_data)).hexdigest(),
+                         msg="Image hash mismatch")
+
+        # The image itself is served as raw bytes from the versioned URL
+        image_response = requests.get(f"{BASE_URL_READER}{data['image']['url']}", cookies=cookies)
+        self.assertEqual(image_response.status_code, 200, msg="Failed to retrieve preset image")
+        self.assertEqual(image_response.content, base64.b64decode(dummy_image_data), msg="Image data mismatch")
+        self.assertEqual(image_response.headers.get("Content-Type"), "image/png")
+        self.assertIn("immutable", image_response.headers.get("Cache-Control", ""))
+
+        revalidated = requests.get(f"{BASE_URL_READER}{data['image']['url']}", cookies=cookies,
+                                   headers={"If-None-Match": image_response.headers.get("ETag")})
+        self.assertEqual(revalidated.status_code, 304, msg="Expected 304 for unchanged image")
 
     def test_08_rename_and_move_boxes(self):
         preset = self.create_preset("Preset for Box Modify")
@@ -322,5 +350,133 @@ class TestAssets(unittest.TestCase):
         self.assertEqual(str(json_data.get("default")), str(preset2['preset_id']),
                          msg="Default preset not updated correctly to preset2")
 
+    def test_10_preset_etag_revalidation(self):
+        preset = self.create_preset(self.generate_random_name())
+        url = f"{BASE_URL_READER}/presets/{preset['preset_id']}"
+        cookies = {"session_id": self.session_id}
+        first = requests.get(url, cookies=cookies)
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers.get("ETag")
+        self.assertTrue(etag, msg="Preset details missing ETag header")
+
+        # Unchanged preset revalidates to a 304 with no body
+        second = requests.get(url, cookies=cookies, headers={"If-None-Match": etag})
+        self.assertEqual(second.status_code, 304, msg="Expected 304 for unchanged preset")
+        self.assertEqual(second.content, b"")
+
+        # Renaming the preset changes the ETag
+        self.rename_preset(preset['preset_id'], self.generate_random_name())
+        third = requests.get(url, cookies=cookies, headers={"If-None-Match": etag})
+        self.assertEqual(third.status_code, 200, msg="Expected 200 once the preset changed")
+        self.assertNotEqual(third.headers.get("ETag"), etag)
+
+    def test_11_preset_image_derivatives(self):
+        preset = self.create_preset(self.generate_random_name())
+        png = self.make_png(600, 300)
+        self.upload_image(preset['preset_id'], "floorplan.png", base64.b64encode(png).decode("utf-8"))
+        cookies = {"session_id": self.session_id}
+
+        # Derivatives are built in the background, wait for them to show up on the preset
+        image = {}
+        for _ in range(30):
+            image = self.get_preset(preset['preset_id'])["image"]
+            if image.get("tiles"):
+                break
+            time.sleep(0.5)
+        self.assertEqual(image.get("thumbnails"), [256, 512], msg="Unexpected thumbnail widths")
+        self.assertEqual((image.get("width"), image.get("height")), (600, 300))
+
+        thumb = requests.get(f"{BASE_URL_READER}{image['url']}&width=200", cookies=cookies)
+        self.assertEqual(thumb.status_code, 200, msg="Failed to retrieve thumbnail")
+        self.assertEqual(thumb.headers.get("Content-Type"), "image/webp")
+        self.assertLess(len(thumb.content), len(png))
+
+        # Wider than every thumbnail falls back to the original
+        original = requests.get(f"{BASE_URL_READER}{image['url']}&width=2000", cookies=cookies)
+        self.assertEqual(original.content, png)
+
+        tiles = requests.get(f"{BASE_URL_READER}{image['tiles']}", cookies=cookies).json()
+        self.assertEqual(tiles["levels"], 3, msg="600px wide image should have 3 tile levels")
+        self.assertEqual(tiles["tile_size"], 256)
+        top = requests.get(f"{BASE_URL_READER}" + tiles["url"].format(level=2, x=2, y=1), cookies=cookies)
+        self.assertEqual(top.status_code, 200, msg="Failed to retrieve full resolution tile")
+        missing = requests.get(f"{BASE_URL_READER}" + tiles["url"].format(level=0, x=1, y=0), cookies=cookies)
+        self.assertEqual(missing.status_code, 404)
+
+    def test_12_front_page_cached(self):
+        url = f"{BASE_URL_READER}/home"
+        first = requests.get(url)
+        self.assertEqual(first.status_code, 200, msg="Failed to retrieve front page")
+        self.assertIn("config", first.json())
+        etag = first.headers.get("ETag")
+        self.assertTrue(etag, msg="Front page missing ETag header")
+
+        second = requests.get(url)
+        self.assertEqual(second.headers.get("ETag"), etag, msg="Unchanged front page changed ETag")
+        self.assertEqual(second.content, first.content)
+
+        revalidated = requests.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(revalidated.status_code, 304, msg="Expected 304 for unchanged front page")
+
+    def test_13_box_diff_keeps_ids(self):
+        preset = self.create_preset(self.generate_random_name())
+        boxes = [
+            {"roomID": "Room1", "label": "One", "top": 0, "left": 0, "width": 50, "height": 50, "colour": "#FF0000"},
+            {"roomID": "Room2", "label": "Two", "top": 0, "left": 60, "width": 50, "height": 50, "colour": "#00FF00"},
+        ]
+        first = self.patch_boxes(preset['preset_id'], boxes)
+        self.assertEqual(first["inserted"], 2)
+        ids = first["ids"]
+
+        # Move one box, drop the other and add a new one
+        stored = self.get_preset(preset['preset_id'])["boxes"]
+        moved = next(box for box in stored if box["id"] == ids[0])
+        moved["top"] = 100
+        new_box = {"roomID": "Room3", "label": "Three", "top": 0, "left": 120, "width": 50, "height": 50, "colour": "#0000FF"}
+        second = self.patch_boxes(preset['preset_id'], [moved, new_box])
+        self.assertEqual((second["inserted"], second["updated"], second["deleted"]), (1, 1, 1))
+        self.assertEqual(second["ids"][0], ids[0], msg="Moved box lost its id")
+
+        stored = {box["id"]: box for box in self.get_preset(preset['preset_id'])["boxes"]}
+        self.assertEqual(set(stored), set(second["ids"]))
+        self.assertEqual(stored[ids[0]]["top"], 100)
+
+        # Sending the same boxes again writes nothing
+        third = self.patch_boxes(preset['preset_id'], list(stored.values()))
+        self.assertEqual((third["inserted"], third["updated"], third["deleted"]), (0, 0, 0))
+
+    def test_14_batch_box_update(self):
+        presets = [self.create_preset(self.generate_random_name()) for _ in range(2)]
+        cookies = {"session_id": self.session_id}
+        url = f"{BASE_URL_EDITOR}/presets/boxes"
+        body = {"presets": [
+            {"preset_id": preset['preset_id'], "boxes": [
+                {"roomID": "Room1", "label": "Batch", "top": 0, "left": 0, "width": 10, "height": 10, "colour": "#123456"}
+            ]} for preset in presets
+        ]}
+        response = requests.patch(url, headers=self.headers, json=body, cookies=cookies)
+        self.assertEqual(response.status_code, 200, msg="Batch box update failed")
+        for preset in presets:
+            boxes = self.get_preset(preset['preset_id'])["boxes"]
+            self.assertEqual([box["label"] for box in boxes], ["Batch"])
+
+        # One bad preset rejects the whole batch
+        body["presets"].append({"preset_id": 999999, "boxes": []})
+        response = requests.patch(url, headers=self.headers, json=body, cookies=cookies)
+        self.assertEqual(response.status_code, 404)
+
+    def test_15_acl_cache_invalidated_on_delete(self):
+        preset = self.create_preset(self.generate_random_name())
+        box = {"roomID": "Room1", "label": "Cached", "top": 0, "left": 0, "width": 10, "height": 10, "colour": "#123456"}
+        self.patch_boxes(preset['preset_id'], [box])  # loads the preset's ACL into the cache
+
+        cookies = {"session_id": self.session_id}
+        response = requests.delete(f"{BASE_URL_EDITOR}/presets/{preset['preset_id']}", cookies=cookies)
+        self.assertEqual(response.status_code, 200, msg="Failed to delete preset")
+
+        response = requests.patch(f"{BASE_URL_EDITOR}/presets/{preset['preset_id']}/boxes",
+                                  headers=self.headers, json={"boxes": [box]}, cookies=cookies)
+        self.assertEqual(response.status_code, 404, msg="Deleted preset still authorised from the cache")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -6,11 +6,12 @@ import os
 import requests
 import random
 import string
+import struct
 
 class TestWarnings(unittest.TestCase):
     # MQTT configuration (using the same broker as in test_3_data.py)
-    MQTT_BROKER = "mqtt.flespi.io"
-    MQTT_PORT = 1883
+    MQTT_BROKER = os.getenv("MQTT_HOST", "mqtt.flespi.io")
+    MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
     MQTT_TOKEN = os.getenv("mqtt_token")
     
     # Service endpoints – note these use container names as in test_3_data.py
@@ -68,7 +69,7 @@ class TestWarnings(unittest.TestCase):
         client.username_pw_set(self.MQTT_TOKEN, None)
         client.connect(self.MQTT_BROKER, self.MQTT_PORT, 60)
         client.loop_start()
-        payload = json.dumps(data)
+        payload = data if isinstance(data, bytes) else json.dumps(data)
         client.publish(topic, payload)
         time.sleep(1)  # Allow time for the message to be sent
         client.loop_stop()
@@ -411,5 +412,20 @@ class TestWarnings(unittest.TestCase):
         response = requests.get(f"{self.WARNINGS_URL}/warnings/logs")
         self.assertEqual(response.status_code, 401)
 
+    # 16. Binary telemetry payloads trigger warnings like JSON ones
+    def test_16_binary_payload_triggers_warning(self):
+        warning_id = self.create_valid_warning_rule("_Binary")
+        topic = f"test/warnings/everyone/{warning_id}"
+        client = self.subscribe_to_warning_topic(topic)
+        # Same readings as test 10, encoded as version 1: version, PicoType, RoomID, then
+        # sound, light, temperature, IAQ, pressure, humidity as float32
+        room_data = struct.pack("<BBH6f", 1, 1, 101, 12, 50, 25, 20, 1013, 40)
+        self.publish_data(room_data, "feeds/hardware-data/test_room_binary")
+        time.sleep(5)
+        client.loop_stop()
+        client.disconnect()
+        self.assertIsNotNone(self.received_warning_message, "No warning message received via MQTT for a binary payload")
+        self.assertEqual(self.received_warning_message.get("Title"), "Triggered Warning", "Warning Title mismatch")
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,11 +6,14 @@ import os
 import requests
 import random
 import string
+import gzip
+import csv
+import io
 from datetime import datetime, timedelta
 
 class TestData(unittest.TestCase):
-    MQTT_BROKER = "mqtt.flespi.io"
-    MQTT_PORT = 1883
+    MQTT_BROKER = os.getenv("MQTT_HOST", "mqtt.flespi.io")
+    MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
     MQTT_TOPIC = "feeds/hardware-data/test"
     MQTT_TOKEN = os.getenv("mqtt_token")  # Replace with your actual MQTT token
     ACCOUNTS_URL = "http://account_registration:5001"
@@ -459,6 +462,109 @@ class TestData(unittest.TestCase):
             self.assertFalse(data["environment"],
                             f"Expected no environment data for room {room_id} as records are too old")
 
+    def test_14_summary_historical_snapshot(self):
+        """
+        Query /summary at a time that has fully elapsed so it is served from the snapshot index.
+        Asking for the same time twice must give the same answer (cached block vs fresh block).
+        """
+        snapshot_time = (datetime.utcnow() - timedelta(minutes=15)).isoformat() + "Z"
+        params = {"time": snapshot_time, "mode": "picos"}
+        first = requests.get(
+            f"{self.READER_URL}/summary",
+            params=params,
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(first.status_code, 200, "Expected 200 OK from historical /summary")
+        second = requests.get(
+            f"{self.READER_URL}/summary",
+            params=params,
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(second.status_code, 200, "Expected 200 OK from cached historical /summary")
+        self.assertEqual(first.json(), second.json(), "Cached snapshot differs from the first snapshot")
+        for room_id, data in first.json().items():
+            for occ in ["users", "luggage", "staff", "guard"]:
+                self.assertEqual(data[occ]["count"], len(data[occ]["id"]),
+                                 f"Count and id list disagree for {occ} in room {room_id}")
+
+    def test_15_movement_stream_matches_buffered(self):
+        """The streamed /movement response must have the same content as the buffered one."""
+        time_end = datetime.utcnow() - timedelta(minutes=1)
+        params = {
+            "time_start": (time_end - timedelta(minutes=30)).isoformat() + "Z",
+            "time_end": time_end.isoformat() + "Z"
+        }
+        buffered = requests.get(
+            f"{self.READER_URL}/movement",
+            params=params,
+            cookies={"session_id": self.session_cookie}
+        )
+        streamed = requests.get(
+            f"{self.READER_URL}/movement",
+            params={**params, "stream": "1"},
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(buffered.status_code, 200)
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(buffered.json(), streamed.json(), "Streamed movement differs from buffered movement")
+
+    def test_16_export_environment_csv(self):
+        """Export environment history and check the gzip CSV header and row shape."""
+        self.publish_data(self.room, "feeds/hardware-data/test_export_env")
+        time.sleep(3)
+        params = {
+            "table": "environment",
+            "start_time": (datetime.utcnow() - timedelta(hours=1)).isoformat() + "Z"
+        }
+        response = requests.get(
+            f"{self.READER_URL}/export",
+            params=params,
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Type"), "application/gzip")
+        rows = list(csv.reader(io.StringIO(gzip.decompress(response.content).decode("utf-8"))))
+        self.assertEqual(rows[0], ["picoID", "logged_at", "temperature", "sound", "light", "IAQ", "pressure", "humidity"])
+        for row in rows[1:]:
+            self.assertEqual(len(row), 8, f"Unexpected row shape {row}")
+
+    def test_17_export_invalid_table(self):
+        response = requests.get(
+            f"{self.READER_URL}/export",
+            params={"table": "users"},
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_18_summary_average_cache(self):
+        """
+        Two overlapping /summary/average requests over elapsed buckets must agree where they overlap,
+        and the second must be served (at least partly) from the bucket cache.
+        """
+        end = (datetime.utcnow() - timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        cookies = {"session_id": self.session_cookie}
+        first = requests.get(
+            f"{self.READER_URL}/summary/average",
+            params={"start_time": (end - timedelta(hours=6)).isoformat() + "Z",
+                    "end_time": end.isoformat() + "Z", "time_periods": "15min"},
+            cookies=cookies
+        )
+        self.assertEqual(first.status_code, 200, "Expected 200 OK from /summary/average")
+        before = requests.get(f"{self.READER_URL}/summary/average/cache", cookies=cookies).json()
+        second = requests.get(
+            f"{self.READER_URL}/summary/average",
+            params={"start_time": (end - timedelta(hours=3)).isoformat() + "Z",
+                    "end_time": (end + timedelta(minutes=30)).isoformat() + "Z", "time_periods": "15min"},
+            cookies=cookies
+        )
+        self.assertEqual(second.status_code, 200, "Expected 200 OK from overlapping /summary/average")
+        after = requests.get(f"{self.READER_URL}/summary/average/cache", cookies=cookies).json()
+        self.assertGreater(after["hits"], before["hits"], "Overlapping request did not hit the cache")
+        overlap_start = (end - timedelta(hours=3)).isoformat() + "Z"
+        for bucket, rooms in second.json().items():
+            if overlap_start <= bucket < end.isoformat() + "Z":
+                self.assertEqual(rooms, first.json().get(bucket), f"Cached bucket {bucket} differs")
+
     # --- Helper Methods ---
 
     def fetch_summary_from_server(self):
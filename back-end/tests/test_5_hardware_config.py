@@ -22,8 +22,8 @@ def on_mqtt_message(client, user_data, message):
         
 
 class TestData(unittest.TestCase):
-    MQTT_BROKER = "mqtt.flespi.io"
-    MQTT_PORT = 1883
+    MQTT_BROKER = os.getenv("MQTT_HOST", "mqtt.flespi.io")
+    MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
     MQTT_SERVER_TOPIC = "hardware_config/server_message/"
     MQTT_HARDWARE_TOPIC = "hardware_config/hardware_message/"
     MQTT_TOKEN = os.getenv("mqtt_token")  # Replace with your actual MQTT token
@@ -311,7 +311,7 @@ class TestData(unittest.TestCase):
                     elif (pico["picoID"] == "Test4"):
                         btID = hardware_message.message.pop("BluetoothID", None)
                         self.assertNotEqual(btID, None, "Expected a bluetooth id to be supplied for test 4");
-                        self.assertEqual(btID >= 1000, True, "Expected bluetooth id of test 4 to be below 1000")
+                        self.assertEqual(0 < btID < 1000, True, "Expected bluetooth id of test 4 to be below 1000")
                         self.assertDictEqual(hardware_message.message, {"ReadableID" : "Test7", "PicoType" : 1})
 
                     elif (pico["picoID"] == "Test5"):
@@ -566,6 +566,230 @@ class TestData(unittest.TestCase):
         self.delete_device_from_server(pico_device["picoID"])
 
 
+    def test_06_publisher_delivery(self):
+        # single device updates wait briefly for the broker to acknowledge the QoS 2 publish
+        patch_response = self.patch_device_in_server("Test9", {"readablePicoID" : "Test9"})
+        self.assertEqual(patch_response["delivered"], True, "Expected the broker to confirm the publish")
+
+        # renaming an empty group fans out to nobody
+        group_identifier = self.add_tracking_group_to_server("TestGrp" + self.random_string(5))["groupID"]
+        patch_response = self.patch_tracking_group_in_server(group_identifier, "TestGrp" + self.random_string(5))
+        self.assertEqual(patch_response["devices"], 0)
+        self.delete_tracking_group_from_server(group_identifier)
+
+        status = requests.get(
+            f"{self.HARDWARE_EDITING_URL}/publisher/status",
+            cookies={"session_id": self.session_cookie}
+        ).json()
+        self.assertEqual(status["connected"], True)
+        self.assertGreaterEqual(status["confirmed"], 1)
+        self.assertEqual(status["rejected"], 0)
+
+
+    def test_07_bulk_provisioning(self):
+        pico_ids = ["Test10", "Test11", "Test12", "Test13"]
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+
+        mqtt_client = self.set_up_mqtt_client()
+        for pico_id in pico_ids:
+            mqtt_client.subscribe(self.MQTT_SERVER_TOPIC + pico_id)
+            self.publish_data_to_mqtt(mqtt_client, {"PicoID" : pico_id}, self.MQTT_HARDWARE_TOPIC + pico_id)
+
+        max_attempts = 5
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == len(pico_ids):
+                break
+        subscribed_mqtt_messages.clear()
+
+        response = requests.post(
+            f"{self.HARDWARE_EDITING_URL}/provision/devices",
+            json={"devices" : [{"picoID" : "Test10", "picoType" : self.TRACKER_PICO},
+                               {"picoID" : "Test11", "picoType" : self.TRACKER_PICO},
+                               {"picoID" : "Test12", "picoType" : self.ENVIRONMENT_PICO},
+                               {"picoID" : "TestMissing", "picoType" : self.TRACKER_PICO}]},
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["unknown"], ["TestMissing"])
+        assigned = {device["picoID"] : device["bluetoothID"] for device in body["devices"]}
+        self.assertGreaterEqual(assigned["Test10"], 1000)
+        self.assertGreaterEqual(assigned["Test11"], 1000)
+        self.assertNotEqual(assigned["Test10"], assigned["Test11"])
+        self.assertTrue(0 < assigned["Test12"] < 1000)
+
+        # every provisioned device is told its new config
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == 3:
+                break
+        messages = {message.route : message.message for message in subscribed_mqtt_messages}
+        subscribed_mqtt_messages.clear()
+        self.assertEqual(messages[self.MQTT_SERVER_TOPIC + "Test11"]["BluetoothID"], assigned["Test11"])
+
+        # an unassigned device gives its ID back; free IDs are reused lowest first
+        self.patch_device_in_server("Test10", {"picoType" : self.UNASSIGNED_PICO})
+        response = requests.post(
+            f"{self.HARDWARE_EDITING_URL}/provision/devices",
+            json={"devices" : [{"picoID" : "Test13", "picoType" : self.TRACKER_PICO}]},
+            cookies={"session_id": self.session_cookie}
+        ).json()
+        self.assertLessEqual(response["devices"][0]["bluetoothID"], assigned["Test10"])
+
+        self.end_mqtt_client(mqtt_client)
+        subscribed_mqtt_messages.clear()
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+
+
+    def test_08_bulk_patch(self):
+        pico_ids = ["Test14", "Test15", "Test16"]
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+
+        mqtt_client = self.set_up_mqtt_client()
+        for pico_id in pico_ids:
+            mqtt_client.subscribe(self.MQTT_SERVER_TOPIC + pico_id)
+            self.publish_data_to_mqtt(mqtt_client, {"PicoID" : pico_id}, self.MQTT_HARDWARE_TOPIC + pico_id)
+
+        max_attempts = 5
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == len(pico_ids):
+                break
+        subscribed_mqtt_messages.clear()
+
+        group_name = "TestGrp" + self.random_string(5)
+        group_identifier = self.add_tracking_group_to_server(group_name)["groupID"]
+
+        response = requests.patch(
+            f"{self.HARDWARE_EDITING_URL}/patch/device/configs?wait=true",
+            json={"changes" : [{"picoID" : "Test14", "picoType" : self.TRACKER_PICO, "trackingGroupID" : group_identifier},
+                               {"picoID" : "Test15", "picoType" : self.TRACKER_PICO, "trackingGroupID" : group_identifier, "readablePicoID" : "BTTest15"},
+                               {"picoID" : "Test16", "readablePicoID" : "Test14"},
+                               {"picoID" : "TestMissing", "picoType" : self.TRACKER_PICO}]},
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["updated"], 2)
+        self.assertEqual(body["failed"], 2)
+        results = {result["picoID"] : result for result in body["results"]}
+        self.assertEqual([result["picoID"] for result in body["results"]], ["Test14", "Test15", "Test16", "TestMissing"])
+        self.assertEqual(results["Test14"]["status"], "updated")
+        self.assertEqual(results["Test14"]["delivered"], True)
+        self.assertGreaterEqual(results["Test15"]["bluetoothID"], 1000)
+        self.assertEqual(results["Test16"]["error"], "readablePicoID already in use")
+        self.assertEqual(results["TestMissing"]["error"], "Unknown picoID")
+
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == 2:
+                break
+        messages = {message.route : message.message for message in subscribed_mqtt_messages}
+        subscribed_mqtt_messages.clear()
+        hardware_message = messages[self.MQTT_SERVER_TOPIC + "Test15"]
+        self.assertEqual(hardware_message.pop("BluetoothID"), results["Test15"]["bluetoothID"])
+        self.assertDictEqual(hardware_message, {"ReadableID" : "BTTest15", "PicoType" : self.TRACKER_PICO, "TrackerGroup" : group_name})
+
+        configs = {config["picoID"] : config for config in self.fetch_device_summary_from_server()["configs"]}
+        self.assertEqual(configs["Test14"]["trackingGroupID"], group_identifier)
+        self.assertEqual(configs["Test16"]["readablePicoID"], "Test16")
+
+        self.end_mqtt_client(mqtt_client)
+        subscribed_mqtt_messages.clear()
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+        self.delete_tracking_group_from_server(group_identifier)
+
+
+    def get_configs_from_server(self, params):
+        response = requests.get(
+            f"{self.HARDWARE_EDITING_URL}/get/device/configs",
+            params=params,
+            cookies={"session_id": self.session_cookie}
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+
+    def test_09_paged_and_delta_configs(self):
+        pico_ids = ["Test17", "Test18"]
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+
+        mqtt_client = self.set_up_mqtt_client()
+        for pico_id in pico_ids:
+            mqtt_client.subscribe(self.MQTT_SERVER_TOPIC + pico_id)
+            self.publish_data_to_mqtt(mqtt_client, {"PicoID" : pico_id}, self.MQTT_HARDWARE_TOPIC + pico_id)
+
+        max_attempts = 5
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == len(pico_ids):
+                break
+        self.end_mqtt_client(mqtt_client)
+        subscribed_mqtt_messages.clear()
+
+        # devices registered on boot show up once the snapshot is refreshed
+        for attempt in range(20):
+            listing = self.get_configs_from_server({"prefix" : "Test1", "picoType" : self.UNASSIGNED_PICO})
+            if {"Test17", "Test18"} <= {config["picoID"] for config in listing["configs"]}:
+                break
+            time.sleep(2)
+
+        first_page = self.get_configs_from_server({"prefix" : "Test1", "limit" : 1})
+        self.assertEqual(len(first_page["configs"]), 1)
+        second_page = self.get_configs_from_server({"prefix" : "Test1", "limit" : 1, "after" : first_page["next_cursor"]})
+        self.assertGreater(second_page["configs"][0]["picoID"], first_page["configs"][0]["picoID"])
+
+        version = self.get_configs_from_server({})["version"]
+        self.patch_device_in_server("Test17", {"readablePicoID" : "Test17b"})
+        self.delete_device_from_server("Test18")
+
+        delta = self.get_configs_from_server({"since" : version})
+        self.assertEqual(delta["full"], False)
+        self.assertGreater(delta["version"], version)
+        self.assertEqual([config["readablePicoID"] for config in delta["configs"] if config["picoID"] == "Test17"], ["Test17b"])
+        self.assertIn("Test18", delta["deleted"])
+
+        unchanged = self.get_configs_from_server({"since" : delta["version"]})
+        self.assertEqual(unchanged["configs"], [])
+
+        self.delete_device_from_server("Test17")
+
+
+    def test_10_payload_format_negotiation(self):
+        pico_ids = ["Test19", "Test20"]
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+        subscribed_mqtt_messages.clear()
+
+        mqtt_client = self.set_up_mqtt_client()
+        for pico_id in pico_ids:
+            mqtt_client.subscribe(self.MQTT_SERVER_TOPIC + pico_id)
+        # only Test19 advertises the binary telemetry format
+        self.publish_data_to_mqtt(mqtt_client, {"PicoID" : "Test19", "PayloadFormats" : [0, 1]}, self.MQTT_HARDWARE_TOPIC + "Test19")
+        self.publish_data_to_mqtt(mqtt_client, {"PicoID" : "Test20"}, self.MQTT_HARDWARE_TOPIC + "Test20")
+
+        max_attempts = 5
+        for attempt in range(max_attempts):
+            time.sleep(2)
+            if len(subscribed_mqtt_messages) == len(pico_ids):
+                break
+        self.end_mqtt_client(mqtt_client)
+
+        replies = {message.route: message.message for message in subscribed_mqtt_messages}
+        subscribed_mqtt_messages.clear()
+        self.assertEqual(replies[self.MQTT_SERVER_TOPIC + "Test19"].get("PayloadFormat"), 1, "Expected Test19 to be given the binary format")
+        self.assertNotIn("PayloadFormat", replies[self.MQTT_SERVER_TOPIC + "Test20"], "Expected the reply to Test20 to be unchanged")
+
+        for pico_id in pico_ids:
+            self.delete_device_from_server(pico_id)
+
+
 if __name__ == '__main__':
 
     unittest.main()
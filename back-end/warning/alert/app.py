@@ -1,17 +1,18 @@
 import paho.mqtt.client as mqtt
 import json
 import os
-import mysql.connector
 from mysql.connector import Error
 import threading
 import time
 import random
+from shared import metrics, log, db, telemetry, broker
+
+logger = log.setup(f"warning_alert_node{os.getenv('NODE_ID', '1')}")
 
 # All rules are AND rules, so if one statement is false then we will be stopping
 rules = []
 roomData = {}
 
-db_connection = None
 rules_lock = threading.Lock()
 
 firstTime = True
@@ -24,51 +25,45 @@ state_file_path = "/var/lib/node_state/first_run"
 lock_file_path = "/var/lib/node_state/lock"
 tests_to_perform = []
 
+# Rules are evaluated on the MQTT thread, which keeps one pooled connection. The per-message
+# queries run on it as prepared statements.
+database = db.Database(f"warning_alert_node{node_id}", pool_size=2)
+
 def get_db_connection():
-    retry = 5
-    global db_connection
-    if db_connection and db_connection.is_connected():
-        return db_connection
-    for _ in range(retry):
-        try:
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-            if db_connection.is_connected():
-                return db_connection
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-    return db_connection
+    return database.connection()
 
 def reset_db_session():
-    global db_connection
-    if db_connection and db_connection.is_connected():
-        db_connection.reset_session()
+    # Ends the open read so the next query sees rows committed since; unlike reset_session
+    # this keeps the connection's prepared statements
+    connection = get_db_connection()
+    if connection is not None:
+        try:
+            connection.rollback()
+        except Error as e:
+            logger.warning("Error resetting database session: %s", e)
 
 def grabRules():
     global firstTime
     global rules
     with rules_lock:
         reset_db_session()
-        connection = get_db_connection()
-        if connection is None:
-            print("Database connection failed")
-            return
-
-        cursor = connection.cursor(dictionary=True)
-        
         # Check the updated flag
-        cursor.execute("SELECT updated FROM updated WHERE id = 1")
-        updated_flag = cursor.fetchone()["updated"]
+        try:
+            updated_flag = database.query_one("SELECT updated FROM updated WHERE id = 1", dictionary=True)["updated"]
+        except Error as e:
+            logger.error("Database connection failed: %s", e)
+            return
         
         if not firstTime and not updated_flag:
             # print("No updates to rules, skipping fetch")
             return
         
+        connection = get_db_connection()
+        if connection is None:
+            logger.error("Database connection failed")
+            return
+
+        cursor = connection.cursor(dictionary=True)
         cursor.execute("""
             SELECT r.id, r.name, r.test_only, rc.roomID, rc.variable, rc.upper_bound, rc.lower_bound, rm.authority, rm.title, rm.location, rm.severity, rm.summary
             FROM rule r
@@ -117,7 +112,7 @@ def grabRules():
             })
 
         rules = new_rules
-        print("Rules updated")
+        logger.info("Rules updated", extra={"rules": len(new_rules)})
         # print(json.dumps(rules, indent=2))  # Print the rules variable for verification
 
         # Reset the updated flag
@@ -185,7 +180,7 @@ def grabRoomCount(room_id, pico_type):
 
     pico_type_key = pico_type_keys.get(pico_type)
     if pico_type_key is None:
-        print(f"Invalid pico type: {pico_type}")
+        logger.warning("Invalid pico type: %s", pico_type)
         return 0
 
     return room_counts.get(pico_type, {}).get(room_id, 0)
@@ -225,7 +220,7 @@ def start_leader_timer(client):
 
     # Check if a leader timer already exists and is still active
     if leader_timer is not None and leader_timer.is_alive():
-        print("Leader timer already exists and is active")
+        logger.debug("Leader timer already exists and is active")
         return
 
     def become_leader():
@@ -233,7 +228,7 @@ def start_leader_timer(client):
         global leader_timer
         active = True
         client.publish(f"checkingwarnings/{node_id}", str(time.time()))
-        print("Node is now active")
+        logger.info("Node is now active")
         leader_timer = None
 
     delay = random.uniform(1, 5)  # Random delay between 1 and 5 seconds
@@ -242,23 +237,19 @@ def start_leader_timer(client):
 
 def store_test_rule_ids():
     reset_db_session()
-    connection = get_db_connection()
-    if connection is None:
-        print("Database connection failed")
+    try:
+        tests = database.query("SELECT * FROM tests WHERE result = 'not_done'", dictionary=True)
+    except Error as e:
+        logger.error("Database connection failed: %s", e)
         return
 
-    cursor = connection.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM tests WHERE result = 'not_done'")
-    tests = cursor.fetchall()
-    cursor.close()
-
     global tests_to_perform
     tests_to_perform = tests
 
 def store_test_result(test_id, result):
     connection = get_db_connection()
     if connection is None:
-        print("Database connection failed")
+        logger.error("Database connection failed")
         return
 
     status = "failure"
@@ -297,7 +288,7 @@ def on_message(client, user_data, message):
                         rule["last_sent"] = time.time()
                         break
         except Exception as e:
-            print("Error processing warnings subscription:", e)
+            logger.warning("Error processing warnings subscription: %s", e)
         return
 
     # Ignore own heartbeat messages
@@ -318,38 +309,48 @@ def on_message(client, user_data, message):
         client.publish(f"checkingwarnings/{node_id}", str(time.time()))
 
     # Process the message
-    print(f'message from "{message.topic}":')
-
-    # Decode message into utf-8
-    payload_str = message.payload.decode("utf-8", errors="ignore")
+    logger.debug("message received", extra={"topic": message.topic, "sample": 0.01})
 
-    # Make sure it is a json
-    try:
-        data = PicoData.parse_raw(payload_str)
-    except json.JSONDecodeError:
-        print("ERR: invalid json")
-        return
-    except ValidationError as e:
-        print("ERR: invalid structure", e)
-        return
-    except Exception as e:
-        print("Unknown error", e)
-        return
-    
-    pico_id = data.PicoID
-    pico_last_seen[pico_id] = time.time()
+    # Devices that negotiated it send the compact binary format (see shared/telemetry.py)
+    if telemetry.is_binary(message.payload):
+        try:
+            pico_type, room_id, env_data = telemetry.decode(message.payload)
+        except ValueError as e:
+            logger.warning("invalid binary payload: %s", e, extra={"topic": message.topic})
+            return
+        pico_id = telemetry.pico_id(message.topic)
+    else:
+        # Decode message into utf-8
+        payload_str = message.payload.decode("utf-8", errors="ignore")
 
-    if data.PicoType == 1:  # Room data
+        # Make sure it is a json
         try:
-            env_data = list(map(float, data.Data.split(',')))
-            if len(env_data) != 6:
-                print("ERR: invalid environment data length")
-                return
-        except ValueError:
-            print("ERR: invalid environment data format")
+            data = PicoData.parse_raw(payload_str)
+        except json.JSONDecodeError:
+            logger.warning("invalid json", extra={"topic": message.topic})
+            return
+        except ValidationError as e:
+            logger.warning("invalid structure: %s", e, extra={"topic": message.topic})
+            return
+        except Exception:
+            logger.exception("Unknown error")
             return
+        pico_id, room_id, pico_type = data.PicoID, data.RoomID, data.PicoType
+
+        if pico_type == 1:
+            try:
+                env_data = list(map(float, data.Data.split(',')))
+                if len(env_data) != 6:
+                    logger.warning("invalid environment data length", extra={"pico": pico_id})
+                    return
+            except ValueError:
+                logger.warning("invalid environment data format", extra={"pico": pico_id})
+                return
+
+    pico_last_seen[pico_id] = time.time()
 
-        key = str(data.RoomID)
+    if pico_type == 1:  # Room data
+        key = str(room_id)
         roomData[key] = {
             "sound": env_data[0],
             "light": env_data[1],
@@ -359,15 +360,15 @@ def on_message(client, user_data, message):
             "humidity": env_data[5]
         }
 
-    if data.PicoType in [2, 3, 4, 5]:  # Luggage, Users, Staff, Guard
-        new_room_id = str(data.RoomID)
+    if pico_type in [2, 3, 4, 5]:  # Luggage, Users, Staff, Guard
+        new_room_id = str(room_id)
         old_room_id = pico_locations.get(pico_id)
         old_pico_type = pico_types.get(pico_id)
 
-        if old_room_id != new_room_id or old_pico_type != data.PicoType:
-            update_room_counts(pico_id, old_pico_type, data.PicoType, old_room_id, new_room_id)
+        if old_room_id != new_room_id or old_pico_type != pico_type:
+            update_room_counts(pico_id, old_pico_type, pico_type, old_room_id, new_room_id)
             pico_locations[pico_id] = new_room_id
-            pico_types[pico_id] = data.PicoType
+            pico_types[pico_id] = pico_type
 
     # Check if the node should become active
     if not active:
@@ -376,7 +377,7 @@ def on_message(client, user_data, message):
         return
     
 
-    print("processing the rules")
+    logger.debug("processing the rules", extra={"rules": len(rules), "sample": 0.01})
     current_time = time.time()  # capture current time once
     for rule in rules:
         # Skip sending if rule was recently published within the past minute.
@@ -394,7 +395,7 @@ def on_message(client, user_data, message):
                 # print("Reading condition for: ",variable["variable"], "  lower:", variable["lower_bound"], ", upper: ", variable["upper_bound"])
                 if variable["variable"] in ["users", "guard", "luggage", "staff"]:
                     count = grabRoomCount(roomID, variable["variable"])
-                    print("Value:", count)
+                    logger.debug("room count", extra={"room": roomID, "variable": variable["variable"], "value": count, "sample": 0.01})
                     if count < variable["lower_bound"] or count > variable["upper_bound"]:
                         sendMessage = False
                         break
@@ -438,7 +439,7 @@ def on_message(client, user_data, message):
         rule["last_sent"] = time.time()
 
     if len(tests_to_perform) > 0:
-        print("tests", tests_to_perform)
+        logger.info("running tests", extra={"tests": [test["id"] for test in tests_to_perform]})
     # Perform tests
     for test in tests_to_perform:
         rule_id = test["rule_id"]
@@ -448,7 +449,7 @@ def on_message(client, user_data, message):
         # Fetch the rule details
         rule = next((r for r in rules if r["id"] == rule_id), None)
         if not rule:
-            print(f"Rule {rule_id} not found")
+            logger.warning("Rule %s not found", rule_id)
             continue
 
         # print(f"Running test for {rule_id}")
@@ -488,14 +489,14 @@ def on_message(client, user_data, message):
         store_test_result(test_id, test_result)
 
 def on_connect(client, user_data, connect_flags, result_code, properties):
-    print(f"Connected with result code {result_code}")
+    logger.info("Connected with result code %s", result_code)
 
     #subscribe to all hardware data feeds
     client.subscribe("feeds/hardware-data/#")
     client.subscribe("checkingwarnings/#")
     client.subscribe("warnings/#")          # New subscription
     client.subscribe("test/warnings/#")      # New subscription
-    print("Subscribed to hardware feeds and warnings topics")
+    logger.info("Subscribed to hardware feeds and warnings topics")
 
 #set up the client to recieve messages
 def main():
@@ -503,7 +504,7 @@ def main():
     
     # Check if this is the first run
     if not os.path.exists(state_file_path):
-        print("First run detected, setting node to active.")
+        logger.info("First run detected, setting node to active.")
         active = True
         with open(state_file_path, 'w') as f:
             f.write('This file indicates that the node has been run before.')
@@ -514,26 +515,26 @@ def main():
             with open(lock_file_path, 'w') as f:
                 f.write('This file indicates that the node is active.')
             active = True
-            print("Node is now active")
+            logger.info("Node is now active")
         else:
-            print("Lock file exists, node will not become active")
+            logger.info("Lock file exists, node will not become active")
 
     # MQTT connection
-    print("Getting access token")
     access_token = os.getenv("MQTT_TOKEN")
-    print("Access token found")
 
     if not access_token:
-        print("Error: Token not found")
+        logger.error("Token not found")
         return
 
     #set up the mqtt client
-    print("Starting mqtt client")
+    logger.info("Starting mqtt client")
     client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
     client.on_connect = on_connect
     client.on_message = on_message
+    metrics.instrument_mqtt_client(client)
+    metrics.serve_metrics(f"warning_alert_node{node_id}")
     client.username_pw_set(access_token, None)
-    client.connect("mqtt.flespi.io", 1883)
+    broker.connect(client)
 
     # Start background thread to send heartbeat messages
     threading.Thread(target=send_heartbeat, args=(client,), daemon=True).start()
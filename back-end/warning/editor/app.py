@@ -1,5 +1,4 @@
 from flask import Flask, request, jsonify, make_response
-import mysql.connector
 from flask_cors import CORS
 from mysql.connector import Error
 from datetime import datetime
@@ -8,32 +7,19 @@ import requests
 import time
 import paho.mqtt.client as mqtt
 import json
+from shared import metrics, log, db, broker
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
+metrics.instrument_flask(app, "warning_editor")
+logger = log.setup("warning_editor")
 
-# Establish a persistent connection to the database
-db_connection = None
+# Pooled connections; each request gets its own and returns it to the pool when it ends
+database = db.Database("warning_editor")
+database.init_app(app)
 
 def get_db_connection():
-    retry = 5
-    global db_connection
-    if db_connection and db_connection.is_connected():
-        return db_connection
-    for _ in range(retry):
-        try:
-            db_connection = mysql.connector.connect(
-                host=os.getenv('DB_HOST'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                database=os.getenv('DB_NAME')
-            )
-            if db_connection.is_connected():
-                return db_connection
-        except Error as e:
-            print(f"Error connecting to MySQL: {e}")
-            db_connection = None
-    return db_connection
+    return database.connection()
 
 
 def validate_session_cookie_edit(request):
@@ -41,13 +27,13 @@ def validate_session_cookie_edit(request):
     cookie = request.cookies.get("session_id")
 
     if not cookie:
-        print("No session_id cookie found.")
+        logger.debug("No session_id cookie found")
         return {"error": "Invalid cookie", "message": "Cookie missing"}, 401
 
-    print(f"Cookie found: {cookie}")
-    r = requests.get(VALIDATION_SITE, headers={"session-id": cookie})
+    with metrics.span("validate_cookie"):
+        r = requests.get(VALIDATION_SITE, headers={"session-id": cookie, **metrics.trace_headers()})
     if r.status_code != 200:
-        print("ERR: Invalid cookie detected")
+        logger.info("Invalid cookie detected")
         return {"error": "Invalid cookie"}, 401
     
     data = r.json()
@@ -433,14 +419,13 @@ def acknowledge_warning(id):
     cursor.close()
 
     # Publish to MQTT
-    mqtt_broker = "mqtt.flespi.io"
-    mqtt_port = 1883
     mqtt_topic = f"response/{id}"
     mqtt_token = os.getenv("mqtt_token")  # Replace with your actual MQTT token
 
     client = mqtt.Client(protocol=mqtt.MQTTv5)
+    metrics.instrument_mqtt_client(client)
     client.username_pw_set(mqtt_token, None)
-    client.connect(mqtt_broker, mqtt_port, 60)
+    broker.connect(client)
     client.loop_start()
 
     payload = json.dumps({
@@ -456,5 +441,5 @@ def acknowledge_warning(id):
     return jsonify({"message": "Response sent"}), 200
 
 if __name__ == '__main__':
-    get_db_connection()  # Ensure the connection is established at startup
+    database.pool()  # Ensure the database is reachable at startup
     app.run(host='0.0.0.0', port=5004)
\ No newline at end of file
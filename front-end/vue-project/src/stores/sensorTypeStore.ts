@@ -249,6 +249,24 @@ const applyDomainOverrides = async () => {
   await nextTick();
 };
 
+/**
+ * Device configs are kept between calls and refreshed with ?since=<version>,
+ * so only devices that changed since the last fetch are downloaded.
+ */
+const deviceConfigs = new Map<string, DeviceConfig>();
+let deviceConfigVersion: number | null = null;
+
+const fetchDeviceConfigs = async (): Promise<DeviceConfig[]> => {
+  const params = deviceConfigVersion === null ? {} : { since: deviceConfigVersion };
+  const response = await axios.get("/api/hardware/get/device/configs", { params, withCredentials: true });
+  const data: { configs: DeviceConfig[]; version: number; full: boolean; deleted?: string[] } = response.data;
+  if (data.full) deviceConfigs.clear();
+  data.configs.forEach(device => deviceConfigs.set(device.picoID, device));
+  (data.deleted || []).forEach(picoID => deviceConfigs.delete(picoID));
+  deviceConfigVersion = data.version;
+  return Array.from(deviceConfigs.values());
+};
+
 /**
  * Fetch and update sensor mappings dynamically from API.
  * We update two lists:
@@ -257,9 +275,7 @@ const applyDomainOverrides = async () => {
  */
 export const updateSensorMappings = async () => {
   try {
-    const response = await axios.get("/api/hardware/get/device/configs", { withCredentials: true });
-    const data: { configs: DeviceConfig[] } = response.data;
-    if (!data.configs) return;
+    const data = { configs: await fetchDeviceConfigs() };
     console.log("Fetched configs:", data.configs);
 
     // Build separatedSensors: one entry per device config (ungrouped)
@@ -6,11 +6,13 @@ export interface preset {
   owner_id: string | number,
   image: {
     name: string,
-    data: string,
+    hash: string | null,
+    url: string,
   },
 }
 
 export interface boxType {
+  id?: number,
   roomID: string,
   label: string,
   top: number,
@@ -46,9 +46,8 @@ export const usePresetStore = defineStore("presetStore", () => {
     }
 
     const processPresetImage = () => {
-      if (presetData.value.image?.data && presetData.value.image?.name) {
-        const imageType = presetData.value.image.name.split('.').pop();
-        presetImage.value = `data:image/${imageType};base64,${presetData.value.image.data}`;
+      if (presetData.value.image?.url) {
+        presetImage.value = `/api/assets-reader${presetData.value.image.url}`;
       } else {
         presetImage.value = "";
       }